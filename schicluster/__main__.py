@@ -486,6 +486,10 @@ def generate_scool_register_subparser(subparser):
                         help='number of cpus to parallel.')
     parser.add_argument('--batch_n', type=int, default=50, required=False, 
                         help='number of cells to deal with in each cpu process.')
+    parser.add_argument('--per_resolution_pass', dest='single_pass', action='store_false',
+                        help='If set, will read and filter the contacts separately for each resolution, '
+                             'instead of binning all the resolutions in a single pass.')
+    parser.set_defaults(single_pass=True)
 
 
 def prepare_imputation_register_subparser(subparser):
@@ -722,6 +726,10 @@ def merge_cell_raw_register_subparser(subparser):
                         help='0 based index of pos2 column.')
     parser.add_argument('--min_pos_dist', type=int, default=2500, required=False,
                         help='Minimum distance for a fragment to be considered.')
+    parser.add_argument('--cpu', type=int, default=1, required=False,
+                        help='Number of cpus to parallel.')
+    parser.add_argument('--batch_n', type=int, default=50, required=False,
+                        help='Number of cells binned in each parallel task.')
 
 
 def merge_cool_register_subparser(subparser):
@@ -735,6 +743,8 @@ def merge_cool_register_subparser(subparser):
                             '1. file_path. No header')
     parser_req.add_argument('--output_cool', type=str, default=None, required=True, 
                             help='Full path to output merged cool file')
+    parser.add_argument('--n_threads', type=int, default=1, required=False,
+                        help='Number of threads to read the input cool files in parallel')
 
 
 def filter_contacts_register_subparser(subparser):
@@ -805,6 +815,57 @@ def contact_distance_register_subparser(subparser):
                         help='0 based index of pos2 column.')
     parser.add_argument('--cpu', type=int, default=20, required=False, 
                         help='number of cpus to parallel.')
+    parser.add_argument('--chrom_decay', dest='chrom_decay', action='store_true', required=False,
+                        help='If set, also save the decay of each chromosome to {output_prefix}_chromdecay.hdf5')
+    parser.set_defaults(chrom_decay=False)
+
+
+def contacts_index_register_subparser(subparser):
+    parser = subparser.add_parser('contacts-index',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Convert text contact files into binary contact stores partitioned by "
+                                       "chromosome pair. The contact table saved in output_dir can be used by "
+                                       "filter-contact, generate-scool, contact-distance, merge-cell-raw, "
+                                       "compartment and gene-score tsv/raw modes and prepare-impute tsv mode.")
+
+    parser_req = parser.add_argument_group("required arguments")
+    parser_req.add_argument('--contact_table', type=str, default=None, required=True,
+                            help='Contain all the cell contact file information in two tab-separated columns: '
+                                 '1. cell_uid, 2. file_path. No header')
+    parser_req.add_argument('--output_dir', type=str, default=None, required=True,
+                            help='Output directory of the contact stores, '
+                                 'the new contact table is saved as {output_dir}/contact_table.tsv')
+    parser.add_argument('--chrom_size_path', type=str, default=None, required=False,
+                        help='If provided, only keep contacts on the chromosomes in this UCSC chrom size file')
+    parser.add_argument('--chr1', dest='chrom1', type=int, default=1, required=False,
+                        help='0 based index of chr1 column.')
+    parser.add_argument('--pos1', type=int, default=2, required=False,
+                        help='0 based index of pos1 column.')
+    parser.add_argument('--chr2', dest='chrom2', type=int, default=5, required=False,
+                        help='0 based index of chr2 column.')
+    parser.add_argument('--pos2', type=int, default=6, required=False,
+                        help='0 based index of pos2 column.')
+    parser.add_argument('--cpu', type=int, default=10, required=False,
+                        help='Number of cpus to parallel.')
+
+
+def compare_loop_register_subparser(subparser):
+    parser = subparser.add_parser('compare-loop',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="")
+
+    parser_req = parser.add_argument_group("required arguments")
+    parser_req.add_argument('--loop_paths', type=str, nargs='+', default=None, required=True,
+                            help='Two or more loop bedpe files to compare, separated by space. '
+                                 'File names without the ".bedpe" suffix are used as loop set names, '
+                                 'which must be unique.')
+    parser_req.add_argument('--output_prefix', type=str, default=None, required=True,
+                            help='Output prefix of the overlap table and the set specific loop bedpe files')
+    parser.add_argument('--dist', type=int, default=20000, required=False,
+                        help='Maximum distance between anchors of matched loops')
+    parser.add_argument('--chroms', type=str, nargs='+', default=None, required=False,
+                        help='Chromosomes to compare, if not provided, use all chromosomes in the loop files')
+
 
 def main():
     parser = argparse.ArgumentParser(description=DESCRIPTION,
@@ -893,6 +954,10 @@ def main():
         from .cool.remove_blacklist import filter_contacts_wrapper as func
     elif cur_command in ['contact-distance']:
         from .cool.contact_distance import contact_distance as func
+    elif cur_command in ['contacts-index']:
+        from .cool.contact_store import index_contacts as func
+    elif cur_command in ['compare-loop']:
+        from .loop.compare_loop import compare_loops as func
     else:
         log.debug(f'{cur_command} is not an valid sub-command')
         parser.parse_args(["-h"])
@@ -360,6 +360,13 @@ def merge_group_chunks_internal_subparser(subparser):
         required=False
     )
 
+    parser.add_argument(
+        "--cpu",
+        type=int,
+        default=6,
+        required=False
+    )
+
 
 def merge_raw_scool_internal_subparser(subparser):
     parser = subparser.add_parser('merge-raw-scool',
@@ -397,6 +404,12 @@ def merge_raw_scool_internal_subparser(subparser):
         default=1
     )
 
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=1
+    )
+
     parser.add_argument(
         '--add_trans',
         dest='add_trans',
@@ -472,6 +485,27 @@ def call_loop_internal_subparser(subparser):
         default=1
     )
 
+    parser.add_argument(
+        "--min_e_zscore",
+        type=float,
+        default=None,
+        help='Only keep candidates whose E z-score on the same diagonal is >= this value.'
+    )
+
+    parser.add_argument(
+        "--top_frac",
+        type=float,
+        default=None,
+        help='Only keep the top fraction of candidates ranked by E on each diagonal.'
+    )
+
+    parser.add_argument(
+        "--local_max_pad",
+        type=int,
+        default=None,
+        help='Only keep candidates that are the E maximum in the surrounding window of this pad.'
+    )
+
 
 def internal_main():
     parser = argparse.ArgumentParser(description=DESCRIPTION,
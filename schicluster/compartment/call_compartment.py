@@ -8,6 +8,8 @@ import pathlib
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import xarray as xr
 
+from ..cool.contact_store import read_contacts
+
 
 def get_cpg_profile(fasta_path, hdf_output_path, cell_url=None, chrom_size_path=None, resolution=100000):
     temp_bed_path = f'{hdf_output_path}_bins.bed'
@@ -82,8 +84,8 @@ def single_cell_compartment(cell_url, cpg_profile, calc_strength, output_prefix,
         chroms = pd.Index(cool.chromnames).intersection(cpg_profile['chrom'])
     elif mode=='tsv':
         chroms = chrom_sizes.index
-        data = pd.read_csv(cell_url, sep='\t', index_col=None, header=None, comment='#')
-        data = data.loc[(data[chrom1]==data[chrom2]) & data[chrom1].isin(chroms)]
+        data = read_contacts(cell_url, chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2,
+                             chroms=chroms, cis=True)
     all_comp = []
     scores = np.array([0, 0, 0])
     for chrom in chroms:
@@ -96,7 +98,7 @@ def single_cell_compartment(cell_url, cpg_profile, calc_strength, output_prefix,
             if chrfilter.sum()==0:
                 matrix = csr_matrix((n_bins, n_bins))
             else:
-                matrix = data.loc[data[chrom1]==chrfilter]
+                matrix = data.loc[chrfilter].copy()
                 matrix[[pos1, pos2]] = (matrix[[pos1, pos2]] - 1) // resolution
                 matrix = matrix.groupby(by=[pos1, pos2])[chrom1].count().reset_index()
                 matrix = csr_matrix((matrix[chrom1].astype(np.int32), (matrix[pos1], matrix[pos2])), (n_bins, n_bins))
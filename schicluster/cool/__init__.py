@@ -1,2 +1,3 @@
 from .scool import generate_scool
+from .contact_store import ContactStore, index_contacts, read_contacts
 from .utilities import *
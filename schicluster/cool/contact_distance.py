@@ -2,28 +2,73 @@ import sys
 import numpy as np
 import pandas as pd
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from .contact_store import read_contacts
 
-def compute_decay(cell_name, contact_path, bins, chrom_sizes, resolution, chrom1=1, chrom2=5, pos1=2, pos2=6):
-    # decay
-    data = pd.read_csv(contact_path, sep='\t', header=None, index_col=None)
-    data = data.loc[(data[chrom1]==data[chrom2]) & data[chrom1].isin(chrom_sizes.index)] # select cis-contact
-    hist = np.histogram(np.abs(data[pos2] - data[pos1]), bins)[0]
-    # sparsity
-    data[[pos1, pos2]] = data[[pos1, pos2]] // resolution
-    data = data.groupby(by=[chrom1, pos1, pos2])[chrom2].count().reset_index()
-    data = data.loc[data[pos1]!=data[pos2], chrom1].value_counts() # total number of contacts on each chromosoe
-    return [pd.DataFrame(data).set_axis([cell_name], axis=1), 
-            pd.DataFrame(hist, columns=[cell_name])]
-
-def contact_distance(contact_table, chrom_size_path, resolution, output_prefix, chrom1, chrom2, pos1, pos2, cpu):
+def compute_decay(cell_name, contact_path, bins, chrom_sizes, resolution, chrom1=1, chrom2=5, pos1=2, pos2=6,
+                  chrom_decay=False):
+    """
+    Contact distance decay and chromosome sparsity of one cell in a single vectorized pass over the cis contacts.
+
+    Returns
+    -------
+    sparsity
+        Number of non-diagonal pixels with contacts on each chromosome, ordered as chrom_sizes.
+    decay
+        Number of contacts in each distance bin, the same as np.histogram(distance, bins).
+    chrom_decay
+        If chrom_decay is true, array of shape (n_chroms, n_distance_bins) of the decay on each chromosome,
+        otherwise None.
+    """
+    chroms = chrom_sizes.index
+    n_chroms = chroms.size
+    n_dist_bins = bins.size - 1
+    data = read_contacts(contact_path, chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2,
+                         chroms=chroms, cis=True)  # select cis-contact
+    codes = chroms.get_indexer(data[chrom1]).astype(np.int64)
+    x = data[pos1].values.astype(np.int64)
+    y = data[pos2].values.astype(np.int64)
+
+    # decay, distance bin idx with the same edges as np.histogram, the last bin includes the right edge
+    dist = np.abs(y - x)
+    dist_idx = np.searchsorted(bins, dist, side='right') - 1
+    dist_idx[dist == bins[-1]] = n_dist_bins - 1
+    in_range = (dist_idx >= 0) & (dist_idx < n_dist_bins)
+    decay = np.bincount(dist_idx[in_range], minlength=n_dist_bins)
+    if chrom_decay:
+        chrom_decay = np.bincount(codes[in_range] * n_dist_bins + dist_idx[in_range],
+                                  minlength=n_chroms * n_dist_bins).reshape(n_chroms, n_dist_bins)
+    else:
+        chrom_decay = None
+
+    # sparsity, count unique non-diagonal pixels on each chromosome with encoded pixel keys
+    x //= resolution
+    y //= resolution
+    off_diag = x != y
+    n_pixel_bins = int(max(x.max(), y.max())) + 1 if x.size > 0 else 1
+    keys = np.unique((codes[off_diag] * n_pixel_bins + x[off_diag]) * n_pixel_bins + y[off_diag])
+    sparsity = np.bincount(keys // (n_pixel_bins * n_pixel_bins), minlength=n_chroms)
+    return sparsity, decay, chrom_decay
+
+
+def contact_distance(contact_table, chrom_size_path, resolution, output_prefix, chrom1, chrom2, pos1, pos2, cpu,
+                     chrom_decay=False):
     chrom_sizes = pd.read_csv(chrom_size_path, sep='\t', header=None, index_col=0)
     nbins = np.floor(np.log2(chrom_sizes[1].values.max() / 2500) / 0.125)
     bins = 2500 * np.exp2(0.125 * np.arange(nbins+1))
     #dist = int(chromsize[1].min() // res + 1)
     contact_table = pd.read_csv(contact_table, sep='\t', index_col=None, header=None)
+    cell_names = pd.Index(contact_table[0])
+    n_cells = cell_names.size
+    n_chroms = chrom_sizes.shape[0]
+    n_dist_bins = bins.size - 1
+
+    # results are written into cell x feature arrays as the cells finish
+    sparsity = np.zeros((n_cells, n_chroms), dtype=np.int64)
+    decay = np.zeros((n_cells, n_dist_bins), dtype=np.int64)
+    chrom_decay_data = np.zeros((n_cells, n_chroms, n_dist_bins), dtype=np.int64) if chrom_decay else None
     with ProcessPoolExecutor(cpu) as executor:
         futures = {}
-        for cell_name, contact_path in contact_table.values:
+        for i, (cell_name, contact_path) in enumerate(contact_table.values):
             future = executor.submit(
                 compute_decay,
                 cell_name=cell_name,
@@ -35,18 +80,25 @@ def contact_distance(contact_table, chrom_size_path, resolution, output_prefix,
                 pos1=pos1,
                 chrom2=chrom2,
                 pos2=pos2,
+                chrom_decay=chrom_decay,
             )
-            futures[future] = cell_name
+            futures[future] = i
 
-        sparsity, decay = [], []
         for future in as_completed(futures):
-            cell_name = futures[future]
-            xx, yy = future.result()
-            sparsity.append(xx)
-            decay.append(yy)
-            print(f'{cell_name} finished')
-            
-    sparsity = pd.concat(sparsity, axis = 1)[contact_table[0]].T
-    decay = pd.concat(decay, axis = 1)[contact_table[0]].T
+            i = futures[future]
+            cell_sparsity, cell_decay, cell_chrom_decay = future.result()
+            sparsity[i] = cell_sparsity
+            decay[i] = cell_decay
+            if chrom_decay:
+                chrom_decay_data[i] = cell_chrom_decay
+            print(f'{cell_names[i]} finished')
+
+    sparsity = pd.DataFrame(sparsity, index=cell_names, columns=chrom_sizes.index)
+    decay = pd.DataFrame(decay, index=cell_names)
     sparsity.to_hdf(f'{output_prefix}_chromsparsity.hdf5', key='data')
     decay.to_hdf(f'{output_prefix}_decay.hdf5', key='data')
+    if chrom_decay:
+        columns = pd.MultiIndex.from_product([chrom_sizes.index, range(n_dist_bins)], names=['chrom', 'bin'])
+        chrom_decay_data = pd.DataFrame(chrom_decay_data.reshape(n_cells, -1), index=cell_names, columns=columns)
+        chrom_decay_data.to_hdf(f'{output_prefix}_chromdecay.hdf5', key='data')
+    return
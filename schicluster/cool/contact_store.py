@@ -0,0 +1,298 @@
+import json
+import pathlib
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+CONTACT_STORE_INDEX = 'index.json'
+
+
+def is_contact_store(path):
+    """Whether the path is a contact store directory created by index_contacts."""
+    return (pathlib.Path(path) / CONTACT_STORE_INDEX).exists()
+
+
+class ContactStore:
+    """
+    Binary contact store of one cell.
+
+    The store is a directory with pos1.npy and pos2.npy int32 arrays and an index.json.
+    Contacts are sorted by chrom pair, the index records the [start, end) of each chrom pair,
+    so the positions of a chrom pair are read as zero-copy slices of the memory-mapped arrays.
+
+    Parameters
+    ----------
+    path
+        Path to the contact store directory.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path / CONTACT_STORE_INDEX) as f:
+            index = json.load(f)
+        self.chroms = index['chroms']
+        self.n_contacts = index['n_contacts']
+        self.pairs = {(chrom1, chrom2): (start, end) for chrom1, chrom2, start, end in index['pairs']}
+        self._pos1 = None
+        self._pos2 = None
+
+    def _load(self):
+        if self._pos1 is None:
+            if self.n_contacts == 0:
+                # np.load can not memory map empty arrays
+                self._pos1 = np.zeros(0, dtype=np.int32)
+                self._pos2 = np.zeros(0, dtype=np.int32)
+            else:
+                self._pos1 = np.load(self.path / 'pos1.npy', mmap_mode='r')
+                self._pos2 = np.load(self.path / 'pos2.npy', mmap_mode='r')
+        return self._pos1, self._pos2
+
+    def fetch(self, chrom1, chrom2=None):
+        """
+        Positions of the contacts on a chrom pair.
+
+        Parameters
+        ----------
+        chrom1
+            Chrom of the first anchor.
+        chrom2
+            Chrom of the second anchor, if None, use chrom1 (cis contacts).
+
+        Returns
+        -------
+        pos1, pos2
+            Read-only int32 arrays, empty if the chrom pair has no contacts.
+        """
+        if chrom2 is None:
+            chrom2 = chrom1
+        pos1, pos2 = self._load()
+        start, end = self.pairs.get((str(chrom1), str(chrom2)), (0, 0))
+        return pos1[start:end], pos2[start:end]
+
+    def to_dataframe(self, chrom1=1, pos1=2, chrom2=5, pos2=6, chroms=None, cis=False, all_columns=False):
+        """
+        Contacts in the same dataframe layout as the text contact file.
+
+        Parameters
+        ----------
+        chrom1
+            0 based index of chr1 column.
+        pos1
+            0 based index of pos1 column.
+        chrom2
+            0 based index of chr2 column.
+        pos2
+            0 based index of pos2 column.
+        chroms
+            If provided, only read contacts with both anchors on these chroms.
+        cis
+            If true, only read cis contacts.
+        all_columns
+            If true, return all the columns up to the largest column index,
+            columns not kept in the store are filled with ".".
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        if chroms is not None:
+            chroms = set(map(str, chroms))
+        pairs = [(_chrom1, _chrom2, start, end)
+                 for (_chrom1, _chrom2), (start, end) in self.pairs.items()
+                 if (not cis or _chrom1 == _chrom2)
+                 and (chroms is None or (_chrom1 in chroms and _chrom2 in chroms))]
+        pos1_data, pos2_data = self._load()
+        slices = [slice(start, end) for *_, start, end in pairs]
+        lengths = np.array([end - start for *_, start, end in pairs], dtype=np.int64)
+        chrom1_data = np.repeat(np.array([p[0] for p in pairs], dtype=object), lengths)
+        chrom2_data = np.repeat(np.array([p[1] for p in pairs], dtype=object), lengths)
+        if len(slices) == 1:
+            pos1_values = pos1_data[slices[0]]
+            pos2_values = pos2_data[slices[0]]
+        elif len(slices) > 1:
+            pos1_values = np.concatenate([pos1_data[s] for s in slices])
+            pos2_values = np.concatenate([pos2_data[s] for s in slices])
+        else:
+            pos1_values = np.zeros(0, dtype=np.int32)
+            pos2_values = np.zeros(0, dtype=np.int32)
+
+        columns = {chrom1: chrom1_data, pos1: pos1_values, chrom2: chrom2_data, pos2: pos2_values}
+        if all_columns:
+            n_rows = chrom1_data.size
+            columns = {col: columns.get(col, np.full(n_rows, '.', dtype=object))
+                       for col in range(max(columns) + 1)}
+        else:
+            columns = {col: columns[col] for col in sorted(columns)}
+        return pd.DataFrame(columns)
+
+
+def read_contacts(path, chrom1=1, pos1=2, chrom2=5, pos2=6, chroms=None, cis=False, all_columns=False):
+    """
+    Read contacts from a contact store, or from the text contact file if path is not a contact store.
+
+    Parameters
+    ----------
+    path
+        Path to the contact store directory or the text contact file.
+    chrom1
+        0 based index of chr1 column.
+    pos1
+        0 based index of pos1 column.
+    chrom2
+        0 based index of chr2 column.
+    pos2
+        0 based index of pos2 column.
+    chroms
+        If provided, only keep contacts with both anchors on these chroms.
+    cis
+        If true, only keep cis contacts.
+    all_columns
+        If true, read all the columns, otherwise only read the chrom and pos columns.
+
+    Returns
+    -------
+    pd.DataFrame
+        Contacts with the columns named by the 0 based column index.
+    """
+    if is_contact_store(path):
+        return ContactStore(path).to_dataframe(chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2,
+                                               chroms=chroms, cis=cis, all_columns=all_columns)
+
+    contacts = pd.read_csv(path, sep='\t', header=None, index_col=None, comment='#',
+                           usecols=None if all_columns else [chrom1, pos1, chrom2, pos2])
+    if cis:
+        contacts = contacts[contacts[chrom1] == contacts[chrom2]]
+    if chroms is not None:
+        contacts = contacts[contacts[chrom1].isin(chroms) & contacts[chrom2].isin(chroms)]
+    return contacts
+
+
+def write_contact_store(contact_path, output_path, chroms=None, chrom1=1, pos1=2, chrom2=5, pos2=6):
+    """
+    Convert a text contact file into a contact store.
+
+    Parameters
+    ----------
+    contact_path
+        Path to the text contact file.
+    output_path
+        Path to the output contact store directory.
+    chroms
+        If provided, only keep contacts with both anchors on these chroms, chrom pairs are ordered by chroms.
+    chrom1
+        0 based index of chr1 column.
+    pos1
+        0 based index of pos1 column.
+    chrom2
+        0 based index of chr2 column.
+    pos2
+        0 based index of pos2 column.
+    """
+    try:
+        contacts = pd.read_csv(contact_path, sep='\t', header=None, index_col=None, comment='#',
+                               usecols=[chrom1, pos1, chrom2, pos2],
+                               dtype={chrom1: str, pos1: np.int64, chrom2: str, pos2: np.int64})
+    except pd.errors.EmptyDataError:
+        contacts = pd.DataFrame({chrom1: pd.Series([], dtype=str), pos1: pd.Series([], dtype=np.int64),
+                                 chrom2: pd.Series([], dtype=str), pos2: pd.Series([], dtype=np.int64)})
+    if chroms is not None:
+        chroms = [str(chrom) for chrom in chroms]
+        contacts = contacts[contacts[chrom1].isin(chroms) & contacts[chrom2].isin(chroms)]
+    else:
+        chroms = sorted(set(contacts[chrom1].unique()) | set(contacts[chrom2].unique()))
+
+    int32_max = np.iinfo(np.int32).max
+    if contacts.shape[0] > 0 and max(contacts[pos1].abs().max(), contacts[pos2].abs().max()) > int32_max:
+        raise ValueError(f'{contact_path} has positions larger than int32 range.')
+
+    # sort contacts by chrom pair, keep the original order inside each chrom pair
+    chrom_codes = pd.Index(chroms)
+    code1 = chrom_codes.get_indexer(contacts[chrom1])
+    code2 = chrom_codes.get_indexer(contacts[chrom2])
+    order = np.lexsort((code2, code1))
+    code1 = code1[order]
+    code2 = code2[order]
+    pos1_values = contacts[pos1].values[order].astype(np.int32)
+    pos2_values = contacts[pos2].values[order].astype(np.int32)
+
+    pair_keys = code1.astype(np.int64) * len(chroms) + code2
+    unique_keys, starts = np.unique(pair_keys, return_index=True)
+    ends = np.append(starts[1:], pair_keys.size)
+    pairs = [[chroms[key // len(chroms)], chroms[key % len(chroms)], int(start), int(end)]
+             for key, start, end in zip(unique_keys.tolist(), starts.tolist(), ends.tolist())]
+
+    # write to a temp dir and rename, so an interrupted write never leaves a partial store
+    output_path = pathlib.Path(output_path)
+    temp_path = output_path.parent / f'{output_path.name}.temp'
+    if temp_path.exists():
+        shutil.rmtree(temp_path)
+    temp_path.mkdir(parents=True)
+    np.save(temp_path / 'pos1.npy', pos1_values)
+    np.save(temp_path / 'pos2.npy', pos2_values)
+    with open(temp_path / CONTACT_STORE_INDEX, 'w') as f:
+        json.dump({'chroms': chroms, 'n_contacts': int(pos1_values.size), 'pairs': pairs}, f)
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    temp_path.rename(output_path)
+    return
+
+
+def index_contacts(contact_table, output_dir, chrom_size_path=None,
+                   chrom1=1, pos1=2, chrom2=5, pos2=6, cpu=10):
+    """
+    Convert the text contact files into contact stores, so the contacts are parsed only once.
+
+    Parameters
+    ----------
+    contact_table
+        Contain all the cell contact file information in two tab-separated columns:
+        1. cell_uid, 2. file_path. No header
+    output_dir
+        Output directory of the contact stores. A new contact table "contact_table.tsv" with
+        the contact store paths is saved in output_dir, which can be used by the other commands.
+    chrom_size_path
+        If provided, only keep contacts on the chromosomes in the chrom size file.
+    chrom1
+        0 based index of chr1 column.
+    pos1
+        0 based index of pos1 column.
+    chrom2
+        0 based index of chr2 column.
+    pos2
+        0 based index of pos2 column.
+    cpu
+        Number of cpus to parallel.
+    """
+    contact_table = pd.read_csv(contact_table, sep='\t', header=None, index_col=None)
+    output_dir = pathlib.Path(output_dir).absolute()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    chroms = None
+    if chrom_size_path is not None:
+        chroms = pd.read_csv(chrom_size_path, sep='\t', index_col=0, header=None).index.tolist()
+
+    store_paths = {}
+    with ProcessPoolExecutor(cpu) as executor:
+        futures = {}
+        for cell, contact_path in contact_table.values:
+            output_path = f'{output_dir}/{cell}.contacts'
+            future = executor.submit(write_contact_store,
+                                     contact_path=contact_path,
+                                     output_path=output_path,
+                                     chroms=chroms,
+                                     chrom1=chrom1,
+                                     pos1=pos1,
+                                     chrom2=chrom2,
+                                     pos2=pos2)
+            futures[future] = cell
+            store_paths[cell] = output_path
+
+        for future in as_completed(futures):
+            future.result()
+            print(f'{futures[future]} finished')
+
+    pd.Series(store_paths).loc[contact_table[0]].to_csv(f'{output_dir}/contact_table.tsv',
+                                                        sep='\t', header=False)
+    return
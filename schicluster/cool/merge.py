@@ -1,43 +1,131 @@
 import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import cooler
 import numpy as np
 import pandas as pd
 from glob import glob
-from scipy.sparse import csr_matrix, diags
 from schicluster.cool.utilities import get_chrom_offsets
+from schicluster.cool.contact_store import read_contacts
 
-def load_cell_csv_to_csr(cell_path, chrom_offset, bins_df, resolution, chrom1, pos1, chrom2, pos2, min_pos_dist):
-    contacts = pd.read_csv(cell_path, header=None, index_col=None, sep='\t', comment='#', 
-                           usecols=[chrom1, pos1, chrom2, pos2])
-    contacts = contacts[contacts[chrom1].isin(chrom_offset) & contacts[chrom2].isin(chrom_offset)]
+def load_cell_pixel_keys(cell_path, chrom_offset, n_bins, resolution, chrom1, pos1, chrom2, pos2, min_pos_dist):
+    """Upper triangle pixel keys (bin1_id * n_bins + bin2_id) of each contact in one cell."""
+    contacts = read_contacts(cell_path, chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2,
+                             chroms=list(chrom_offset))
     pos_dist = (contacts[pos1] - contacts[pos2]).abs()
     contacts = contacts[(pos_dist > min_pos_dist) |  (contacts[chrom1] != contacts[chrom2])]
-    contacts['bin1_id'] = contacts[chrom1].map(chrom_offset) + (contacts[pos1] - 1) // resolution
-    contacts['bin2_id'] = contacts[chrom2].map(chrom_offset) + (contacts[pos2] - 1) // resolution
-    orderfilter = (contacts['bin1_id']>contacts['bin2_id'])
-    contacts.loc[orderfilter, ['bin1_id', 'bin2_id']] = contacts.loc[orderfilter, ['bin2_id', 'bin1_id']].values
-    
-    count = contacts.groupby(['bin1_id','bin2_id'])[chrom1].count().reset_index()
-    data = csr_matrix((count[chrom1].values, (count['bin1_id'].values, count['bin2_id'].values)), 
-                      shape=(bins_df.shape[0], bins_df.shape[0]))
-    return data
-
-def merge_cell_raw(cell_table, chrom_size_path, output_file, resolution=5000, 
-                   chrom1=1, pos1=2, chrom2=5, pos2=6, min_pos_dist=2500):
+    bin1_id = (contacts[chrom1].map(chrom_offset) + (contacts[pos1] - 1) // resolution).values.astype(np.int64)
+    bin2_id = (contacts[chrom2].map(chrom_offset) + (contacts[pos2] - 1) // resolution).values.astype(np.int64)
+    return np.minimum(bin1_id, bin2_id) * n_bins + np.maximum(bin1_id, bin2_id)
+
+
+def sum_pixels(*pixels):
+    """Sum (keys, counts) pixel arrays, return the sorted unique keys and the summed counts."""
+    keys = np.concatenate([_keys for _keys, _ in pixels])
+    counts = np.concatenate([_counts for _, _counts in pixels])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts, minlength=keys.size).astype(np.int64)
+    return keys, counts
+
+
+def merge_cell_batch(cell_paths, chrom_offset, n_bins, resolution, chrom1, pos1, chrom2, pos2, min_pos_dist):
+    """Bin the contacts of a group of cells and sum them into (keys, counts) pixel arrays."""
+    keys = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+        load_cell_pixel_keys(cell_path=cell_path, chrom_offset=chrom_offset, n_bins=n_bins, resolution=resolution,
+                             chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2, min_pos_dist=min_pos_dist)
+        for cell_path in cell_paths])
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys, counts.astype(np.int64)
+
+
+def _pixel_chunks(keys, counts, n_bins, chunk_size):
+    """Stream pixel dataframes of chunk_size pixels to cooler."""
+    for start in range(0, max(keys.size, 1), chunk_size):
+        chunk_keys = keys[start:start + chunk_size]
+        yield pd.DataFrame({'bin1_id': chunk_keys // n_bins,
+                            'bin2_id': chunk_keys % n_bins,
+                            'count': counts[start:start + chunk_size]})
+
+
+def merge_cell_raw(cell_table, chrom_size_path, output_file, resolution=5000,
+                   chrom1=1, pos1=2, chrom2=5, pos2=6, min_pos_dist=2500, cpu=1, batch_n=50,
+                   chunk_size=10000000):
+    """
+    Merge the raw contacts of cells into one cool file.
+
+    Cells are binned by groups of batch_n cells in parallel, the group pixels are then
+    summed pairwise as a tree reduction in the same process pool.
+
+    Parameters
+    ----------
+    cell_table
+        Contain all the cell contact file after blacklist removal in two tab-separated columns:
+        1. cell_uid, 2. file_path. No header
+    chrom_size_path
+        Path to UCSC chrom size file.
+    output_file
+        Path to the output cool file.
+    resolution
+        Resolution of cool file.
+    chrom1
+        0 based index of chr1 column.
+    pos1
+        0 based index of pos1 column.
+    chrom2
+        0 based index of chr2 column.
+    pos2
+        0 based index of pos2 column.
+    min_pos_dist
+        Minimum distance for a cis contact to be considered.
+    cpu
+        Number of cpus to parallel.
+    batch_n
+        Number of cells binned in each task.
+    chunk_size
+        Number of pixels in each chunk written to the cool file.
+    """
     chrom_sizes = pd.read_csv(chrom_size_path, sep='\t', index_col=0, header=None).squeeze(axis=1)
     bins_df = cooler.binnify(chrom_sizes, resolution)
     chrom_offset = get_chrom_offsets(bins_df)
+    n_bins = bins_df.shape[0]
     cell_list = pd.read_csv(cell_table, sep='\t', index_col=0, header=None).squeeze(axis=1)
-    data = csr_matrix((bins_df.shape[0], bins_df.shape[0]))
-    for xx,yy in zip(cell_list.values, cell_list.index):
-        data += load_cell_csv_to_csr(cell_path=xx, chrom_offset=chrom_offset, bins_df=bins_df, resolution=resolution, 
-                                     chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2, min_pos_dist=min_pos_dist)
-        print(yy)
-
-    data = data + diags(data.diagonal())
-    data = data.tocoo()
-    data = pd.DataFrame(np.array([data.row, data.col, data.data], dtype=int).T, 
-                        columns=['bin1_id', 'bin2_id', 'count'])
-
-    cooler.create_cooler(cool_uri=output_file, bins=bins_df, pixels=data, ordered=True)
+
+    with ProcessPoolExecutor(cpu) as exe:
+        pending = {}
+        for start in range(0, cell_list.size, batch_n):
+            batch = cell_list.iloc[start:start + batch_n]
+            future = exe.submit(merge_cell_batch,
+                                cell_paths=batch.values,
+                                chrom_offset=chrom_offset,
+                                n_bins=n_bins,
+                                resolution=resolution,
+                                chrom1=chrom1,
+                                pos1=pos1,
+                                chrom2=chrom2,
+                                pos2=pos2,
+                                min_pos_dist=min_pos_dist)
+            pending[future] = batch.index
+
+        # tree reduction, sum every two finished results in the pool until one result is left
+        ready = []
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                cells = pending.pop(future)
+                ready.append(future.result())
+                if cells is not None:
+                    for cell in cells:
+                        print(cell)
+            while len(ready) >= 2:
+                future = exe.submit(sum_pixels, ready.pop(), ready.pop())
+                pending[future] = None
+    if ready:
+        keys, counts = ready[0]
+    else:
+        keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # count the diagonal pixels twice, the same as adding the diagonal of the upper triangle matrix
+    counts[keys // n_bins == keys % n_bins] *= 2
+
+    cooler.create_cooler(cool_uri=output_file, bins=bins_df,
+                         pixels=_pixel_chunks(keys, counts, n_bins, chunk_size), ordered=True)
     return
@@ -1,45 +1,201 @@
+import numpy as np
 import pandas as pd
 from collections import defaultdict
-import pybedtools
 from functools import lru_cache
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import pathlib
 
+from .contact_store import is_contact_store, read_contacts
+
+
+@lru_cache()
+def prepare_chrom_index(chrom_size_path):
+    """Read the chrom names in chrom size file."""
+    chroms = pd.read_csv(chrom_size_path, sep='\t', index_col=0, header=None).index
+    return chroms
+
+
+@lru_cache()
+def prepare_1d_blacklist_dict(blacklist_bed):
+    """
+    Read 1D blacklist bed and merge the regions of each chrom.
+
+    Returns
+    -------
+    dict
+        Key is chrom, value is (starts, ends) int64 arrays of the sorted,
+        non-overlapping [start, end) regions.
+    """
+    blacklist_bed_df = pd.read_csv(blacklist_bed, sep='\t', index_col=None, header=None,
+                                   usecols=[0, 1, 2], dtype={0: str}, comment='#')
+    chrom_regions = {}
+    for chrom, sub_df in blacklist_bed_df.groupby(0, sort=False):
+        sub_df = sub_df.sort_values(1)
+        starts = sub_df[1].values.astype(np.int64)
+        ends = sub_df[2].values.astype(np.int64)
+        # a region starts a new merged region if it starts after all the previous regions end
+        prev_max_ends = np.maximum.accumulate(ends)
+        is_new = np.ones(starts.size, dtype=bool)
+        is_new[1:] = starts[1:] > prev_max_ends[:-1]
+        group = np.cumsum(is_new) - 1
+        merged_ends = np.zeros(is_new.sum(), dtype=np.int64)
+        np.maximum.at(merged_ends, group, ends)
+        chrom_regions[chrom] = (starts[is_new], merged_ends)
+    return chrom_regions
+
+
+def _is_1d_blacklist(chrom, pos, blacklist_1d):
+    """Whether each position falls in a 1D blacklist region (start <= pos < end)."""
+    judge = np.zeros(pos.size, dtype=bool)
+    if pos.size == 0:
+        return judge
+    chrom_idx = pd.Series(chrom).groupby(chrom, sort=False).indices
+    for _chrom, idx in chrom_idx.items():
+        if _chrom not in blacklist_1d:
+            continue
+        starts, ends = blacklist_1d[_chrom]
+        _pos = pos[idx]
+        # the last region starts at or before pos
+        loc = np.searchsorted(starts, _pos, side='right') - 1
+        judge[idx] = (loc >= 0) & (_pos < ends[loc.clip(min=0)])
+    return judge
+
+
+# pixel key of bin idx pair, bin2 idx takes the lower 32 bits
+_PIXEL_KEY_SHIFT = np.int64(2 ** 32)
+
+
+def _pixel_keys(bin1, bin2):
+    return np.asarray(bin1, dtype=np.int64) * _PIXEL_KEY_SHIFT + np.asarray(bin2, dtype=np.int64)
+
+
+def _rectangle_pixel_keys(bin1_starts, bin1_ends, bin2_starts, bin2_ends):
+    """Pixel keys of all the pixels in each [bin1_start, bin1_end) x [bin2_start, bin2_end) rectangle."""
+    bin1_starts = np.asarray(bin1_starts, dtype=np.int64)
+    bin2_starts = np.asarray(bin2_starts, dtype=np.int64)
+    n_rows = (np.asarray(bin1_ends, dtype=np.int64) - bin1_starts).clip(min=0)
+    n_cols = (np.asarray(bin2_ends, dtype=np.int64) - bin2_starts).clip(min=0)
+    n_pixels = n_rows * n_cols
+    # offset of each pixel inside its rectangle, row major
+    rect_idx = np.repeat(np.arange(n_pixels.size), n_pixels)
+    offsets = np.arange(n_pixels.sum()) - np.repeat(np.cumsum(n_pixels) - n_pixels, n_pixels)
+    bin1 = bin1_starts[rect_idx] + offsets // n_cols[rect_idx]
+    bin2 = bin2_starts[rect_idx] + offsets % n_cols[rect_idx]
+    return bin1, bin2
+
+
 @lru_cache()
 def prepare_2d_blacklist_dict(blacklist_bedpe, resolution=10000):
-    # read blacklist bed file, turn the region into bad pixel idx dict with resolution
+    """
+    Read 2D blacklist bedpe and turn the regions into bad pixels at resolution.
+
+    Returns
+    -------
+    dict
+        Key is (chrom1, chrom2) pair, value is the sorted unique int64 pixel keys
+        (bin1 * 2 ** 32 + bin2) of bad pixels. Both chrom pair orders are included.
+    """
     blacklist_bedpe_df = pd.read_csv(blacklist_bedpe, sep='\t', header=None)
 
     # turn region into region pixel idx
     blacklist_bedpe_df[1] //= resolution
     blacklist_bedpe_df[2] //= resolution
     # in case the region is smaller than resolution, add one so at least one pixel is bad
-    blacklist_bedpe_df.loc[2, (blacklist_bedpe_df[2] -
-                               blacklist_bedpe_df[1]) < 1] += 1
+    blacklist_bedpe_df.loc[(blacklist_bedpe_df[2] -
+                            blacklist_bedpe_df[1]) < 1, 2] += 1
     blacklist_bedpe_df[4] //= resolution
     blacklist_bedpe_df[5] //= resolution
     # in case the region is smaller than resolution, add one so at least one pixel is bad
-    blacklist_bedpe_df.loc[5, (blacklist_bedpe_df[5] -
-                               blacklist_bedpe_df[4]) < 1] += 1
+    blacklist_bedpe_df.loc[(blacklist_bedpe_df[5] -
+                            blacklist_bedpe_df[4]) < 1, 5] += 1
 
-    chrom_pair_bad_points = defaultdict(set)
-    for idx, row in blacklist_bedpe_df.iterrows():
-        for i in range(row[1], row[2]):
-            for j in range(row[4], row[5]):
-                chrom_pair_bad_points[row[0], row[3]].add((i, j))
-                # in case contact is not ordered as blacklist
-                chrom_pair_bad_points[row[3], row[0]].add((j, i))
+    chrom_pair_keys = defaultdict(list)
+    for (chrom1, chrom2), sub_df in blacklist_bedpe_df.groupby([0, 3], sort=False):
+        bin1, bin2 = _rectangle_pixel_keys(sub_df[1].values, sub_df[2].values,
+                                           sub_df[4].values, sub_df[5].values)
+        chrom_pair_keys[chrom1, chrom2].append(_pixel_keys(bin1, bin2))
+        # in case contact is not ordered as blacklist
+        chrom_pair_keys[chrom2, chrom1].append(_pixel_keys(bin2, bin1))
 
     # return a dict, key is chrom pair
+    chrom_pair_bad_points = {pair: np.unique(np.concatenate(keys))
+                             for pair, keys in chrom_pair_keys.items()}
     return chrom_pair_bad_points
 
 
-def _is_2d_blacklist(row, blacklist_2d):
-    chrom1, chrom2, pos1, pos2 = row
-    judge = (pos1, pos2) in blacklist_2d[(chrom1, chrom2)]
+def _is_2d_blacklist(chrom1, chrom2, bin1, bin2, blacklist_2d):
+    """Whether each contact pixel is in the 2D blacklist, checked per chrom pair with searchsorted."""
+    judge = np.zeros(bin1.size, dtype=bool)
+    if bin1.size == 0:
+        return judge
+    pair_df = pd.DataFrame({'chrom1': chrom1, 'chrom2': chrom2})
+    for (_chrom1, _chrom2), idx in pair_df.groupby(['chrom1', 'chrom2'], sort=False).indices.items():
+        bad_keys = blacklist_2d.get((_chrom1, _chrom2))
+        if bad_keys is None or bad_keys.size == 0:
+            continue
+        keys = _pixel_keys(bin1[idx], bin2[idx])
+        loc = np.searchsorted(bad_keys, keys).clip(max=bad_keys.size - 1)
+        judge[idx] = bad_keys[loc] == keys
     return judge
 
 
+def _anchor_keys(chrom, pos):
+    """Pack chrom code and position of one contact anchor into int64 key, None if the key may overflow."""
+    codes, uniques = pd.factorize(chrom)
+    pos = np.asarray(pos, dtype=np.int64)
+    pos = pos - pos.min()
+    span = int(pos.max()) + 1
+    # codes of NaN chrom are -1, shift all codes by one
+    if (uniques.size + 1) * span >= 2 ** 62:
+        return None
+    return (codes.astype(np.int64) + 1) * span + pos
+
+
+def duplicated_contacts(contacts, chrom1, pos1, chrom2, pos2):
+    """
+    Mark duplicated contacts, the same as contacts.duplicated(subset=[chrom1, pos1, chrom2, pos2]).
+
+    Each anchor is packed into an int64 key with integer chrom codes,
+    the first occurrence of each key pair is kept after a stable sort.
+    """
+    n = contacts.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    key1 = _anchor_keys(contacts[chrom1].values, contacts[pos1].values)
+    key2 = _anchor_keys(contacts[chrom2].values, contacts[pos2].values)
+    if key1 is None or key2 is None:
+        return contacts.duplicated(subset=[chrom1, pos1, chrom2, pos2]).values
+
+    # lexsort is stable, the first occurrence of each key pair comes first
+    order = np.lexsort((key2, key1))
+    key1 = key1[order]
+    key2 = key2[order]
+    is_dup_sorted = np.zeros(n, dtype=bool)
+    is_dup_sorted[1:] = (key1[1:] == key1[:-1]) & (key2[1:] == key2[:-1])
+    is_dup = np.empty(n, dtype=bool)
+    is_dup[order] = is_dup_sorted
+    return is_dup
+
+
+def init_blacklist_worker(chrom_size_path=None,
+                          blacklist_1d_path=None,
+                          blacklist_2d_path=None,
+                          resolution_2d=10000):
+    """
+    ProcessPoolExecutor initializer, build the chrom and blacklist indexes once in each worker process.
+
+    The indexes are kept in the lru_cache of the prepare functions,
+    so all the cells processed by the worker reuse them in filter_contacts.
+    """
+    if chrom_size_path is not None:
+        prepare_chrom_index(chrom_size_path)
+    if blacklist_1d_path is not None:
+        prepare_1d_blacklist_dict(blacklist_1d_path)
+    if blacklist_2d_path is not None:
+        prepare_2d_blacklist_dict(blacklist_2d_path, resolution=resolution_2d)
+    return
+
+
 def filter_contacts(contact_path,
                     chrom_size_path=None,
                     blacklist_1d_path=None,
@@ -52,19 +208,27 @@ def filter_contacts(contact_path,
                     pos1=2,
                     chrom2=5,
                     pos2=6):
+    if is_contact_store(contact_path) and output_path is not None:
+        # the contact store only keeps the chrom and pos columns, writing it back as a contact file
+        # would silently lose the other columns
+        raise ValueError(f'{contact_path} is a contact store, which only keeps the chrom and pos columns. '
+                         f'Filter the original contact file to save the filtered contacts to {output_path}.')
     try:
-        contacts = pd.read_csv(contact_path,
-                               header=None,
-                               sep='\t',
-                               dtype={
-                                   chrom1: str,
-                                   pos1: int,
-                                   chrom2: str,
-                                   pos2: int
-                               }, 
-                               index_col=None,
-                               comment='#',
-                               )
+        if is_contact_store(contact_path):
+            contacts = read_contacts(contact_path, chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2)
+        else:
+            contacts = pd.read_csv(contact_path,
+                                   header=None,
+                                   sep='\t',
+                                   dtype={
+                                       chrom1: str,
+                                       pos1: int,
+                                       chrom2: str,
+                                       pos2: int
+                                   }, 
+                                   index_col=None,
+                                   comment='#',
+                                   )
     except Exception as e:
         print(f'Got error when opening {contact_path}')
         raise e
@@ -72,50 +236,32 @@ def filter_contacts(contact_path,
 
     if remove_duplicates:
         # remove duplicates
-        contacts.drop_duplicates(subset=[chrom1, pos1, chrom2, pos2], inplace=True)
+        contacts = contacts[~duplicated_contacts(contacts, chrom1, pos1, chrom2, pos2)]
 
     if min_pos_dist>0:
         contacts = contacts[((contacts[pos2] - contacts[pos1]).abs() > min_pos_dist) |  (contacts[chrom1] != contacts[chrom2])]
 
-    chroms = pd.read_csv(chrom_size_path, sep='\t', index_col=0, header=None).index
+    chroms = prepare_chrom_index(chrom_size_path)
     # remove additional chroms not exist in chrom_size_path
     contacts = contacts[contacts[chrom1].isin(chroms) & contacts[chrom2].isin(chroms)].copy()
 
     if blacklist_1d_path is not None:
-        blacklist_bed_df = pd.read_csv(blacklist_1d_path, sep='\t', index_col=None, header=None)
-        blacklist_bed_df = blacklist_bed_df[blacklist_bed_df.iloc[:, 0].isin(chroms)].copy()
-        blacklist_bed = pybedtools.BedTool.from_dataframe(blacklist_bed_df).sort(g=chrom_size_path)
-
+        blacklist_1d = prepare_1d_blacklist_dict(blacklist_1d_path)
         # determine blacklist 1d (either side overlap with 1D blacklist)
-        left_bed_df = contacts[[chrom1, pos1, pos1]].reset_index().iloc[:, [1, 2, 3, 0]]
-        right_bed_df = contacts[[chrom2, pos2, pos2]].reset_index().iloc[:, [1, 2, 3, 0]]
-        left_bed_df.columns = ['chrom', 'start', 'end', 'id']
-        right_bed_df.columns = ['chrom', 'start', 'end', 'id']
-        contact_bed_df = pd.concat([left_bed_df, right_bed_df])
-        contact_bed = pybedtools.BedTool.from_dataframe(contact_bed_df).sort(g=chrom_size_path)
-        # collect contact ids with either side overlap with blacklist
-        bad_contacts = contact_bed.intersect(blacklist_bed, wa=True, u=True).to_dataframe()
-        if bad_contacts.shape[0] > 0:
-            bad_contacts = bad_contacts['name'].unique()
-        else:
-            # no bad contacts
-            bad_contacts = set()
+        is_blacklist_1d = _is_1d_blacklist(contacts[chrom1].values, contacts[pos1].values, blacklist_1d) | \
+            _is_1d_blacklist(contacts[chrom2].values, contacts[pos2].values, blacklist_1d)
         # remove bad contacts
-        contacts = contacts[~contacts.index.isin(bad_contacts)].copy()
-
-        pybedtools.cleanup()
+        contacts = contacts[~is_blacklist_1d].copy()
 
     if blacklist_2d_path is not None:
         chrom_2d_blacklist = prepare_2d_blacklist_dict(blacklist_2d_path, resolution=resolution_2d)
-        contacts_idx = contacts[[chrom1, chrom2, pos1, pos2]].copy()
         # turn contact location into bin idx with resolution
-        contacts_idx[pos1] //= resolution_2d
-        contacts_idx[pos2] //= resolution_2d
-
         # determine blacklist 2d (both side overlap with 2D blacklist)
-        is_blacklist_2d = contacts_idx.apply(_is_2d_blacklist,
-                                             blacklist_2d=chrom_2d_blacklist,
-                                             axis=1)
+        is_blacklist_2d = _is_2d_blacklist(chrom1=contacts[chrom1].values,
+                                           chrom2=contacts[chrom2].values,
+                                           bin1=contacts[pos1].values // resolution_2d,
+                                           bin2=contacts[pos2].values // resolution_2d,
+                                           blacklist_2d=chrom_2d_blacklist)
         contacts = contacts[~is_blacklist_2d].copy()
 
     print(f"{contact_path.split('/')[-1]}: {contacts.shape[0]} filtered contacts in scool.")
@@ -142,7 +288,9 @@ def filter_contacts_wrapper(contact_table=None,
     output_dir = pathlib.Path(output_dir).absolute()
     output_dir.mkdir(parents=True, exist_ok=True)    
         
-    with ProcessPoolExecutor(cpu) as executor:
+    with ProcessPoolExecutor(cpu,
+                             initializer=init_blacklist_worker,
+                             initargs=(chrom_size_path, blacklist_1d_path, blacklist_2d_path, resolution_2d)) as executor:
         futures = {}
         for xx,yy in contact_table.values:
             future = executor.submit(
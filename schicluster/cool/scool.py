@@ -1,18 +1,116 @@
 import re
-import subprocess
 import warnings
-from collections import Counter, defaultdict
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 import cooler
+import numpy as np
 import pandas as pd
 import pandas.errors
 from cooler import create_scool
 
-from .remove_blacklist import filter_contacts
+from .remove_blacklist import filter_contacts, init_blacklist_worker
 from .utilities import get_chrom_offsets
 
 
+def count_pixels(bin1_id, bin2_id):
+    """
+    Count contacts in each upper triangle pixel.
+
+    Parameters
+    ----------
+    bin1_id
+        Bin id of one side of the contacts.
+    bin2_id
+        Bin id of the other side of the contacts.
+
+    Returns
+    -------
+    pixel dataframe with bin1_id, bin2_id and count columns, bin1_id <= bin2_id,
+    sorted by bin1_id and bin2_id.
+    """
+    bin1_id = np.asarray(bin1_id, dtype=np.int64)
+    bin2_id = np.asarray(bin2_id, dtype=np.int64)
+    # put the smaller bin id as bin1, pixels in upper triangle
+    x = np.minimum(bin1_id, bin2_id)
+    y = np.maximum(bin1_id, bin2_id)
+    # encode pixel as one int64 key, np.unique returns sorted keys, so the pixels are sorted by (bin1, bin2)
+    n_bins = int(y.max()) + 1 if y.size > 0 else 1
+    keys, counts = np.unique(x * n_bins + y, return_counts=True)
+    pixel_df = pd.DataFrame({'bin1_id': keys // n_bins,
+                             'bin2_id': keys % n_bins,
+                             'count': counts})
+    return pixel_df
+
+
+def _filter_cell_contacts(path,
+                          chrom_offset,
+                          chrom_size_path,
+                          blacklist_1d_path,
+                          blacklist_2d_path,
+                          remove_duplicates,
+                          blacklist_resolution,
+                          chr1,
+                          chr2,
+                          pos1,
+                          pos2,
+                          min_pos_dist):
+    """Read and filter the contacts of one cell, return None if the contacts file is empty."""
+    try:
+        contacts = filter_contacts(path,
+                                   chrom_size_path=chrom_size_path,
+                                   blacklist_1d_path=blacklist_1d_path,
+                                   blacklist_2d_path=blacklist_2d_path,
+                                   remove_duplicates=remove_duplicates,
+                                   resolution_2d=blacklist_resolution,
+                                   chrom1=chr1,
+                                   pos1=pos1,
+                                   chrom2=chr2,
+                                   pos2=pos2)
+    except pandas.errors.EmptyDataError:
+        # empty contacts file
+        return None
+    pos_dist = (contacts[pos1] - contacts[pos2]).abs()
+
+    # filter
+    contacts = contacts[contacts[chr1].isin(chrom_offset)
+                        & contacts[chr2].isin(chrom_offset)
+                        & (contacts[pos1] > 0)
+                        & (contacts[pos2] > 0)]
+    # apply min_pos_dist filter on cis contact only
+    contacts = contacts[(pos_dist > min_pos_dist) |  # filter all close contact
+                        (contacts[chr1] != contacts[chr2])]  # but keep all trans
+    return contacts
+
+
+def _contacts_to_pixels(contacts, chrom_offset, resolution, chr1, chr2, pos1, pos2):
+    """Bin filtered contacts into the pixels of one resolution."""
+    if contacts is None:
+        return pd.DataFrame([], columns=['bin1_id', 'bin2_id', 'count'])
+    # calculate pixel
+    bin1_id = contacts[chr1].map(chrom_offset) + (contacts[pos1] - 1) // resolution
+    bin2_id = contacts[chr2].map(chrom_offset) + (contacts[pos2] - 1) // resolution
+    pixel_df = count_pixels(bin1_id.values, bin2_id.values)
+    return pixel_df
+
+
+def _compact_pixels(pixel_df):
+    """Pixel dataframe to (bin1_id, bin2_id, count) arrays with the smallest safe int dtype."""
+    arrays = []
+    for col in ['bin1_id', 'bin2_id', 'count']:
+        values = pixel_df[col].values
+        if values.size == 0 or values.max() < np.iinfo(np.int32).max:
+            values = values.astype(np.int32)
+        arrays.append(values)
+    return tuple(arrays)
+
+
+def _pixels_from_compact(arrays):
+    bin1_id, bin2_id, count = arrays
+    return pd.DataFrame({'bin1_id': bin1_id, 'bin2_id': bin2_id, 'count': count})
+
+
 def generate_scool_batch_data(cell_path_dict,
                               resolution,
                               chrom_offset,
@@ -21,59 +119,88 @@ def generate_scool_batch_data(cell_path_dict,
                               blacklist_2d_path,
                               remove_duplicates,
                               blacklist_resolution,
-                              output_path,
                               chr1=1,
                               chr2=5,
                               pos1=2,
                               pos2=6,
                               min_pos_dist=2500):
-    def single_cell_pixel(_path):
-        try:
-            contacts = filter_contacts(_path,
-                                       chrom_size_path=chrom_size_path,
-                                       blacklist_1d_path=blacklist_1d_path,
-                                       blacklist_2d_path=blacklist_2d_path,
-                                       remove_duplicates=remove_duplicates,
-                                       resolution_2d=blacklist_resolution,
-                                       chrom1=chr1,
-                                       pos1=pos1,
-                                       chrom2=chr2,
-                                       pos2=pos2)
-        except pandas.errors.EmptyDataError:
-            # empty contacts file
-            return pd.DataFrame([], columns=['bin1_id', 'bin2_id', 'count'])
-        pos_dist = (contacts[pos1] - contacts[pos2]).abs()
-
-        # filter
-        contacts = contacts[contacts[chr1].isin(chrom_offset)
-                            & contacts[chr2].isin(chrom_offset)
-                            & (contacts[pos1] > 0)
-                            & (contacts[pos2] > 0)]
-        # apply min_pos_dist filter on cis contact only
-        contacts = contacts[(pos_dist > min_pos_dist) |  # filter all close contact
-                            (contacts[chr1] != contacts[chr2])]  # but keep all trans
-
-        # calculate pixel
-        bin1_id = contacts[chr1].map(chrom_offset) + (contacts[pos1] - 1) // resolution
-        bin2_id = contacts[chr2].map(chrom_offset) + (contacts[pos2] - 1) // resolution
-        counter = Counter()
-        for x, y in zip(bin1_id, bin2_id):
-            if x > y:
-                x, y = y, x
-            counter[(x, y)] += 1
-        pixel_df = pd.Series(counter).reset_index()
-        pixel_df.columns = pd.Index(['bin1_id', 'bin2_id', 'count'])
-        pixel_df = pixel_df.sort_values(['bin1_id',
-                                         'bin2_id']).reset_index(drop=True)
-        return pixel_df
+    """Filter and bin the contacts of a batch of cells, return dict of cell id and compact pixel arrays."""
+    with warnings.catch_warnings():
+        # ignore the pandas warnings of contacts filtering
+        warnings.simplefilter("ignore")
+        cell_pixels = {}
+        for cell_id, path in cell_path_dict.items():
+            contacts = _filter_cell_contacts(path,
+                                             chrom_offset=chrom_offset,
+                                             chrom_size_path=chrom_size_path,
+                                             blacklist_1d_path=blacklist_1d_path,
+                                             blacklist_2d_path=blacklist_2d_path,
+                                             remove_duplicates=remove_duplicates,
+                                             blacklist_resolution=blacklist_resolution,
+                                             chr1=chr1, chr2=chr2,
+                                             pos1=pos1, pos2=pos2,
+                                             min_pos_dist=min_pos_dist)
+            pixel_df = _contacts_to_pixels(contacts, chrom_offset, resolution,
+                                           chr1=chr1, chr2=chr2, pos1=pos1, pos2=pos2)
+            cell_pixels[cell_id] = _compact_pixels(pixel_df)
+    return cell_pixels
 
+
+def generate_scool_batch_data_multi_resolution(cell_path_dict,
+                                               resolutions,
+                                               chrom_offsets,
+                                               chrom_size_path,
+                                               blacklist_1d_path,
+                                               blacklist_2d_path,
+                                               remove_duplicates,
+                                               blacklist_resolution,
+                                               chr1=1,
+                                               chr2=5,
+                                               pos1=2,
+                                               pos2=6,
+                                               min_pos_dist=2500):
+    """
+    Filter the contacts of each cell once and bin them into all the resolutions,
+    return a list of dict of cell id and compact pixel arrays, one dict for each resolution.
+    """
     with warnings.catch_warnings():
-        # ignore the
+        # ignore the pandas warnings of contacts filtering
         warnings.simplefilter("ignore")
-        with pd.HDFStore(output_path) as hdf:
-            for cell_id, path in cell_path_dict.items():
-                hdf[cell_id] = single_cell_pixel(path)
-    return
+        resolution_cell_pixels = [{} for _ in resolutions]
+        for cell_id, path in cell_path_dict.items():
+            # chrom names are the same in all resolutions, use any chrom_offset to filter
+            contacts = _filter_cell_contacts(path,
+                                             chrom_offset=chrom_offsets[0],
+                                             chrom_size_path=chrom_size_path,
+                                             blacklist_1d_path=blacklist_1d_path,
+                                             blacklist_2d_path=blacklist_2d_path,
+                                             remove_duplicates=remove_duplicates,
+                                             blacklist_resolution=blacklist_resolution,
+                                             chr1=chr1, chr2=chr2,
+                                             pos1=pos1, pos2=pos2,
+                                             min_pos_dist=min_pos_dist)
+            for resolution, chrom_offset, cell_pixels in zip(resolutions, chrom_offsets, resolution_cell_pixels):
+                pixel_df = _contacts_to_pixels(contacts, chrom_offset, resolution,
+                                               chr1=chr1, chr2=chr2, pos1=pos1, pos2=pos2)
+                cell_pixels[cell_id] = _compact_pixels(pixel_df)
+    return resolution_cell_pixels
+
+
+def _iter_batch_results(exe, func, batch_kwargs, max_pending):
+    """
+    Submit func for each batch kwargs and yield the results in submission order.
+
+    At most max_pending batches are in flight, each future is popped from the queue before its result is yielded,
+    so the parent only holds the pixels of a bounded number of batches.
+    """
+    batch_kwargs = iter(batch_kwargs)
+    pending = deque(exe.submit(func, **kwargs) for kwargs in islice(batch_kwargs, max_pending))
+    while pending:
+        result = pending.popleft().result()
+        # keep the workers busy while the caller handles the result
+        for kwargs in islice(batch_kwargs, 1):
+            pending.append(exe.submit(func, **kwargs))
+        yield result
 
 
 def generate_scool_single_resolution(cell_path_dict,
@@ -104,45 +231,103 @@ def generate_scool_single_resolution(cell_path_dict,
     for i, (cell, path) in enumerate(cell_path_dict.items()):
         chunk_dicts[i // batch_n][cell] = path
 
-    with ProcessPoolExecutor(cpu) as exe:
-        futures = {}
-        for batch, cell_path_dict in chunk_dicts.items():
-            batch_output = output_path + f'_{batch}'
-            f = exe.submit(generate_scool_batch_data,
-                           cell_path_dict=cell_path_dict,
-                           resolution=resolution,
-                           chrom_offset=chrom_offset,
-                           output_path=batch_output,
-                           chr1=chr1, chr2=chr2,
-                           pos1=pos1, pos2=pos2,
-                           min_pos_dist=min_pos_dist,
-                           chrom_size_path=chrom_size_path,
-                           blacklist_1d_path=blacklist_1d_path,
-                           blacklist_2d_path=blacklist_2d_path,
-                           remove_duplicates=remove_duplicates,
-                           blacklist_resolution=blacklist_resolution)
-            futures[f] = batch_output
-
-        for future in as_completed(futures):
-            # batch finished
-            batch_output = futures[future]
-            future.result()
-
-            # dump batch result into cool
-            cell_pixel_dict = {}
-            with pd.HDFStore(batch_output, mode='r') as hdf:
-                for cell_id in hdf.keys():
-                    cell_id = cell_id[1:]  # remove '/'
-                    cell_pixel_dict[cell_id] = hdf[cell_id]
+    # chrom and blacklist indexes are built once in each worker and reused by all its cells
+    with ProcessPoolExecutor(cpu,
+                             initializer=init_blacklist_worker,
+                             initargs=(chrom_size_path, blacklist_1d_path, blacklist_2d_path,
+                                       blacklist_resolution)) as exe:
+        batch_kwargs = (dict(cell_path_dict=cell_path_dict,
+                             resolution=resolution,
+                             chrom_offset=chrom_offset,
+                             chr1=chr1, chr2=chr2,
+                             pos1=pos1, pos2=pos2,
+                             min_pos_dist=min_pos_dist,
+                             chrom_size_path=chrom_size_path,
+                             blacklist_1d_path=blacklist_1d_path,
+                             blacklist_2d_path=blacklist_2d_path,
+                             remove_duplicates=remove_duplicates,
+                             blacklist_resolution=blacklist_resolution)
+                        for cell_path_dict in chunk_dicts.values())
+        for cell_pixels in _iter_batch_results(exe, generate_scool_batch_data, batch_kwargs,
+                                               max_pending=2 * cpu):
+            # batch finished, append its cells into scool directly
+            cell_pixel_dict = {cell_id: _pixels_from_compact(arrays)
+                               for cell_id, arrays in cell_pixels.items()}
             create_scool(output_path,
                          bins=bins_df,
                          cell_name_pixels_dict=cell_pixel_dict,
                          ordered=True,
                          mode='a')
-            subprocess.run(['rm', '-f', batch_output], check=True)
     return
 
 
+def generate_scool_multi_resolution(cell_path_dict,
+                                    chrom_size_path,
+                                    resolutions,
+                                    output_paths,
+                                    blacklist_1d_path,
+                                    blacklist_2d_path,
+                                    remove_duplicates,
+                                    blacklist_resolution,
+                                    chr1=1,
+                                    chr2=5,
+                                    pos1=2,
+                                    pos2=6,
+                                    min_pos_dist=2500,
+                                    batch_n=20,
+                                    cpu=1):
+    # parse chromosome sizes, prepare bin_df for each resolution
+    chrom_sizes = pd.read_csv(
+        chrom_size_path,
+        sep='\t',
+        index_col=0,
+        header=None).squeeze(axis=1)
+    bins_dfs = [cooler.binnify(chrom_sizes, resolution) for resolution in resolutions]
+    chrom_offsets = [get_chrom_offsets(bins_df) for bins_df in bins_dfs]
+
+    chunk_dicts = defaultdict(dict)
+    for i, (cell, path) in enumerate(cell_path_dict.items()):
+        chunk_dicts[i // batch_n][cell] = path
+
+    # chrom and blacklist indexes are built once in each worker and reused by all its cells
+    with ProcessPoolExecutor(cpu,
+                             initializer=init_blacklist_worker,
+                             initargs=(chrom_size_path, blacklist_1d_path, blacklist_2d_path,
+                                       blacklist_resolution)) as exe:
+        batch_kwargs = (dict(cell_path_dict=cell_path_dict,
+                             resolutions=resolutions,
+                             chrom_offsets=chrom_offsets,
+                             chr1=chr1, chr2=chr2,
+                             pos1=pos1, pos2=pos2,
+                             min_pos_dist=min_pos_dist,
+                             chrom_size_path=chrom_size_path,
+                             blacklist_1d_path=blacklist_1d_path,
+                             blacklist_2d_path=blacklist_2d_path,
+                             remove_duplicates=remove_duplicates,
+                             blacklist_resolution=blacklist_resolution)
+                        for cell_path_dict in chunk_dicts.values())
+        for resolution_cell_pixels in _iter_batch_results(exe, generate_scool_batch_data_multi_resolution,
+                                                          batch_kwargs, max_pending=2 * cpu):
+            # batch finished, append its cells into the scool of each resolution directly
+            for output_path, bins_df, cell_pixels in zip(output_paths, bins_dfs, resolution_cell_pixels):
+                cell_pixel_dict = {cell_id: _pixels_from_compact(arrays)
+                                   for cell_id, arrays in cell_pixels.items()}
+                create_scool(output_path,
+                             bins=bins_df,
+                             cell_name_pixels_dict=cell_pixel_dict,
+                             ordered=True,
+                             mode='a')
+    return
+
+
+def _scool_output_path(output_prefix, resolution):
+    resolution_str = str(resolution)
+    resolution_str = re.sub(r'000000$', 'M', resolution_str)
+    resolution_str = re.sub(r'000$', 'K', resolution_str)
+    output_path = f'{output_prefix}.{resolution_str}.scool'
+    return output_path
+
+
 def generate_scool(contacts_table,
                    output_prefix,
                    chrom_size_path,
@@ -157,7 +342,8 @@ def generate_scool(contacts_table,
                    pos2=6,
                    min_pos_dist=2500,
                    cpu=1,
-                   batch_n=50):
+                   batch_n=50,
+                   single_pass=True):
     """
     Generate single-resolution cool files from single-cell contact files recorded in contacts_table
 
@@ -197,6 +383,9 @@ def generate_scool(contacts_table,
         number of cpus to parallel.
     batch_n
         number of cells to deal with in each cpu process.
+    single_pass
+        If true, the contacts of each cell are read and filtered once and binned into all the resolutions.
+        If false, each resolution is generated separately.
 
     Returns
     -------
@@ -209,11 +398,27 @@ def generate_scool(contacts_table,
                                  sep='\t').squeeze(axis=1).to_dict()
     print(f'{len(cell_path_dict)} cells to process.')
 
+    if single_pass and len(resolutions) > 1:
+        output_paths = [_scool_output_path(output_prefix, resolution) for resolution in resolutions]
+        print('Generating', ', '.join(output_paths))
+        generate_scool_multi_resolution(cell_path_dict=cell_path_dict,
+                                        chrom_size_path=chrom_size_path,
+                                        resolutions=resolutions,
+                                        output_paths=output_paths,
+                                        batch_n=batch_n,
+                                        cpu=cpu,
+                                        chr1=chr1, chr2=chr2,
+                                        pos1=pos1, pos2=pos2,
+                                        min_pos_dist=min_pos_dist,
+                                        blacklist_1d_path=blacklist_1d_path,
+                                        blacklist_2d_path=blacklist_2d_path,
+                                        remove_duplicates=remove_duplicates,
+                                        blacklist_resolution=blacklist_resolution)
+        print('Finished', ', '.join(output_paths))
+        return
+
     for resolution in resolutions:
-        resolution_str = str(resolution)
-        resolution_str = re.sub(r'000000$', 'M', resolution_str)
-        resolution_str = re.sub(r'000$', 'K', resolution_str)
-        output_path = f'{output_prefix}.{resolution_str}.scool'
+        output_path = _scool_output_path(output_prefix, resolution)
 
         print('Generating', output_path)
         generate_scool_single_resolution(cell_path_dict=cell_path_dict,
@@ -1,5 +1,10 @@
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 import pandas as pd
+import xarray as xr
+import zarr
 from scipy.stats import f as f_dist
 
 
@@ -93,3 +98,162 @@ def merge_groups(loop_ds, group_map, da_name, group_dim='sample_id', group_n_dim
         '_sample_group': group_dim
     })
     return loop_ds
+
+
+def _one_way_anova_arrays(x, x2, n):
+    """One-way ANOVA on group mean arrays, x and x2 are in shape (loop, group), n is in shape (group, )."""
+    n_group = n.size
+    total_n = n.sum()
+    x_sum = (x * n).sum(axis=1)
+    x2_sum = (x2 * n).sum(axis=1)
+    sst = x2_sum - np.power(x_sum, 2) / total_n
+    ssw = ((x2 - np.power(x, 2)) * n).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = (sst / ssw - 1) * (total_n - n_group) / (n_group - 1)
+    p = f_dist(n_group - 1, total_n - n_group).sf(f)
+    return f, p
+
+
+def _merge_group_arrays(x, n, merge_matrix):
+    """Merge group mean arrays, same as merge_groups, merge_matrix is the (group, new_group) indicator matrix."""
+    new_n = n @ merge_matrix
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_x = (x * n) @ merge_matrix / new_n
+    return new_x, new_n
+
+
+def _anova_loop_chunk_worker(da_path,
+                             output_path,
+                             value_idx,
+                             value2_idx,
+                             n,
+                             merge_matrix,
+                             loop_start,
+                             loop_end):
+    # only load one loop chunk of the two value types
+    da = zarr.open(da_path, mode='r')
+    data = da.get_orthogonal_selection((slice(loop_start, loop_end), slice(None), [value_idx, value2_idx]))
+    x = data[..., 0].astype(np.float64)
+    x2 = data[..., 1].astype(np.float64)
+    if merge_matrix is not None:
+        x, _ = _merge_group_arrays(x, n, merge_matrix)
+        x2, n = _merge_group_arrays(x2, n, merge_matrix)
+    f, p = _one_way_anova_arrays(x, x2, n)
+
+    output = zarr.open_group(output_path, mode='r+')
+    output['F'][loop_start:loop_end] = f
+    output['P'][loop_start:loop_end] = p
+    return
+
+
+def chunked_one_way_anova(loop_ds_path,
+                          output_path,
+                          chroms,
+                          da_name,
+                          value_type,
+                          group_n=None,
+                          group_map=None,
+                          group_n_dim='group_n',
+                          group_dim='sample_id',
+                          loop_chunk_size=None,
+                          cpu=1):
+    """
+    Perform one-way ANOVA on the zarr loop dataset loop-chunk by loop-chunk.
+
+    Only one loop chunk of all groups is loaded at a time in each process,
+    F statistics and P-values are written to the output zarr as the chunks finish,
+    so the peak memory is bounded by the loop chunk size.
+
+    Parameters
+    ----------
+    loop_ds_path
+        Path to the loop dataset generated by create_loop_ds, contains one zarr dataset per chromosome.
+    output_path
+        Path to the output zarr, contains one dataset per chromosome with F and P variables along the loop dim.
+    chroms
+        Chromosomes to perform ANOVA on.
+    da_name
+        The name of the data array to perform ANOVA on.
+    value_type
+        The value type of the data array to perform ANOVA on.
+        both "{value_type}" and "{value_type}2" should be present in the "{da_name}_value_type" dimension.
+    group_n
+        A pd.Series of number of cells per group, indexed by group_dim.
+        If None, will use the group_n_dim coordinate in the loop dataset.
+    group_map
+        A pd.Series mapping from old group names to new group names, groups are merged before ANOVA.
+        If None, ANOVA is performed on the original groups.
+    group_n_dim
+        The name of the group number variable.
+    group_dim
+        The name of the group dimension.
+    loop_chunk_size
+        Number of loops in each chunk, if None, will use the loop chunk size of the loop dataset.
+    cpu
+        Number of processes to use.
+    """
+    if cpu > 1:
+        from numcodecs import blosc
+        blosc.use_threads = False
+
+    pathlib.Path(output_path).mkdir(exist_ok=True, parents=True)
+    for chrom in chroms:
+        chrom_path = f'{loop_ds_path}/{chrom}'
+        loop_ds = xr.open_zarr(chrom_path)
+        groups = loop_ds.get_index(group_dim)
+        value_types = loop_ds.get_index(f'{da_name}_value_type')
+        value_idx = value_types.get_loc(value_type)
+        value2_idx = value_types.get_loc(f'{value_type}2')
+        n_loop = loop_ds.sizes['loop']
+
+        if group_n is None:
+            n = loop_ds.coords[group_n_dim].to_pandas()
+        else:
+            n = group_n
+        n = n.reindex(groups).values.astype(np.float64)
+        if group_map is None:
+            merge_matrix = None
+        else:
+            new_groups = pd.Index(group_map.reindex(groups))
+            merge_matrix = pd.get_dummies(new_groups).values.astype(np.float64)
+
+        if loop_chunk_size is None:
+            chunk_size = loop_ds[da_name].encoding['chunks'][0]
+        else:
+            chunk_size = loop_chunk_size
+
+        # init output zarr, chunks are aligned with the worker loop chunks, so parallel writes do not overlap
+        chrom_output_path = f'{output_path}/{chrom}'
+        output = zarr.open_group(chrom_output_path, mode='w')
+        for name in ['F', 'P']:
+            z = output.zeros(name, shape=(n_loop,), chunks=(chunk_size,), dtype='float64')
+            z.attrs['_ARRAY_DIMENSIONS'] = ['loop']
+        for name in ['loop_bin1_id', 'loop_bin2_id']:
+            if name in loop_ds.coords:
+                z = output.array(name, loop_ds.coords[name].values, chunks=(chunk_size,))
+                z.attrs['_ARRAY_DIMENSIONS'] = ['loop']
+
+        with ProcessPoolExecutor(cpu) as exe:
+            futures = {}
+            for loop_start in range(0, n_loop, chunk_size):
+                loop_end = min(loop_start + chunk_size, n_loop)
+                future = exe.submit(_anova_loop_chunk_worker,
+                                    da_path=f'{chrom_path}/{da_name}',
+                                    output_path=chrom_output_path,
+                                    value_idx=value_idx,
+                                    value2_idx=value2_idx,
+                                    n=n,
+                                    merge_matrix=merge_matrix,
+                                    loop_start=loop_start,
+                                    loop_end=loop_end)
+                futures[future] = loop_start
+            for future in as_completed(futures):
+                loop_start = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Got error when calculating ANOVA of {chrom} loops {loop_start} to {loop_start + chunk_size}')
+                    raise e
+        zarr.consolidate_metadata(chrom_output_path)
+        print(f'{chrom} ANOVA finished, {n_loop} loops.')
+    return
@@ -3,10 +3,11 @@ import numpy as np
 import pandas as pd
 from scipy.sparse import triu, csr_matrix
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from ..cool.contact_store import read_contacts
 
 def gene_score_raw(cell_path, chrom_sizes, gene_meta, resolution, chrom1, pos1, chrom2, pos2):
-    data = pd.read_csv(cell_path, sep='\t', index_col=None, header=None, comment='#')
-    data = data.loc[(data[chrom1]==data[chrom2]) & data[chrom1].isin(chrom_sizes.index)]
+    data = read_contacts(cell_path, chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2,
+                         chroms=chrom_sizes.index, cis=True)
     result = []
     for chrom in chrom_sizes.index:
         n_bins = (chrom_sizes.loc[chrom] // resolution) + 1
@@ -14,7 +15,7 @@ def gene_score_raw(cell_path, chrom_sizes, gene_meta, resolution, chrom1, pos1,
         if chrfilter.sum()==0:
             D = csr_matrix((n_bins, n_bins))
         else:
-            D = data.loc[data[chrom1]==chrfilter]
+            D = data.loc[chrfilter].copy()
             D[[pos1, pos2]] = (D[[pos1, pos2]] - 1) // resolution
             D = D.groupby(by=[pos1, pos2])[chrom1].count().reset_index()
             D = csr_matrix((D[chrom1].astype(np.int32), (D[pos1], D[pos2])), (n_bins, n_bins))
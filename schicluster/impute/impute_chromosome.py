@@ -7,6 +7,8 @@ from scipy.ndimage import gaussian_filter
 import cooler
 import logging
 
+from ..cool.contact_store import read_contacts
+
 # from ..cool import write_coo
 
 
@@ -69,8 +71,8 @@ def impute_chromosome(chrom,
         else:
             print("ERROR : Must provide chrom_size_path if using contact file as input")
             return
-        A = pd.read_csv(contact_path, sep='\t', header=None, index_col=None, comment='#')[[chrom1, pos1, chrom2, pos2]]
-        A = A.loc[(A[chrom1]==chrom) & (A[chrom2]==chrom)]
+        A = read_contacts(contact_path, chrom1=chrom1, pos1=pos1, chrom2=chrom2, pos2=pos2,
+                          chroms=[chrom], cis=True)
         A[[pos1, pos2]] = (A[[pos1, pos2]] - 1) // resolution
         A = A.groupby(by=[pos1, pos2])[chrom1].count().reset_index()
         A = csr_matrix((A[chrom1].astype(np.int32), (A[pos1], A[pos2])), (n_bins, n_bins))
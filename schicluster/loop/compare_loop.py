@@ -1,36 +1,120 @@
+import pathlib
 import sys
+
 import numpy as np
 import pandas as pd
 
-chrom = [f'chr{i + 1}' for i in range(22)]
-loop1 = pd.read_csv(sys.argv[1], sep='\t', header=None, index_col=None).sort_values(by=[0, 1, 4])
-loop2 = pd.read_csv(sys.argv[2], sep='\t', header=None, index_col=None).sort_values(by=[0, 1, 4])
-loop1 = loop1[loop1[0].isin(chrom)]
-loop2 = loop2[loop2[0].isin(chrom)]
-res = loop1.iloc[0, 2] - loop1.iloc[0, 1]
-tot = 0
-dist = 20000
-loop0 = []
-for c in chrom:
-    tmp1 = loop1.loc[loop1[0] == c, [1, 4]].values
-    tmp2 = loop2.loc[loop2[0] == c, [1, 4]].values
-    j, tmp = 0, 0
-    for i in range(len(tmp1)):
-        while j <= (len(tmp2) - 1) and tmp2[j, 0] < (tmp1[i, 0] - dist):
-            j += 1
-        k = j
-        flag = 1
-        while k <= (len(tmp2) - 1) and tmp2[k, 0] <= (tmp1[i, 0] + dist):
-            if (tmp1[i, 1] - dist) <= tmp2[k, 1] <= (tmp1[i, 1] + dist):
-                tmp += 1
-                flag = 0
-                break
-            k += 1
-        if flag:
-            loop0.append([c, tmp1[i, 0], tmp1[i, 0] + res, c, tmp1[i, 1], tmp1[i, 1] + res])
-    tot += tmp
-
-print(tot, loop1.shape[0], tot / loop1.shape[0])
-if len(sys.argv) == 3:
-    np.savetxt('.'.join(sys.argv[1].split('.')[:-1]) + '.specific.bedpe',
-               loop0, fmt='%s', delimiter='\t')
+
+def read_loop_bedpe(path, chroms=None):
+    """Read loop bedpe file, only loops on the same chromosome (cis) are kept."""
+    loops = pd.read_csv(path, sep='\t', header=None, index_col=None, comment='#')
+    loops = loops[loops[0] == loops[3]]
+    if chroms is not None:
+        loops = loops[loops[0].isin(chroms)]
+    return loops.reset_index(drop=True)
+
+
+class _LoopIndex:
+    """Loops sorted by (chrom, anchor1) integer key, queried by searchsorted."""
+
+    def __init__(self, loops, chrom_codes, span):
+        codes = loops[0].map(chrom_codes).values.astype(np.int64)
+        x = loops[1].values.astype(np.int64)
+        y = loops[4].values.astype(np.int64)
+        keys = codes * span + x
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys
+        self.y = y
+        self.sorted_keys = keys[order]
+        self.sorted_y = y[order]
+        self.n_loops = keys.size
+
+    def match(self, other, dist):
+        """Whether each loop of self has a loop of other within dist on both anchors."""
+        lo = np.searchsorted(other.sorted_keys, self.keys - dist, side='left')
+        hi = np.searchsorted(other.sorted_keys, self.keys + dist, side='right')
+        counts = hi - lo
+        # expand all (self loop, other loop) pairs whose anchor1 distance <= dist
+        query_idx = np.repeat(np.arange(self.n_loops), counts)
+        pair_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        other_idx = np.arange(counts.sum()) - pair_starts + np.repeat(lo, counts)
+        hit = np.abs(other.sorted_y[other_idx] - self.y[query_idx]) <= dist
+        matched = np.bincount(query_idx[hit], minlength=self.n_loops) > 0
+        return matched
+
+
+def compare_loops(loop_paths, dist=20000, chroms=None, output_prefix=None):
+    """
+    Compare two or more loop sets, two loops are matched if both anchors are within dist.
+
+    Parameters
+    ----------
+    loop_paths
+        List of loop bedpe paths, or dict of loop set name and bedpe path.
+        If a list is provided, the file names without ".bedpe" suffix are used as set names,
+        which must be unique.
+    dist
+        Maximum distance between anchors of matched loops.
+    chroms
+        Chromosomes to compare, if None, use all chromosomes in the loop files.
+    output_prefix
+        If provided, save the overlap table to "{output_prefix}.overlap.tsv" and
+        the loops specific to each set to "{output_prefix}.{name}.specific.bedpe".
+
+    Returns
+    -------
+    overlap
+        Dataframe of pairwise overlap statistics,
+        overlap_ratio is the fraction of query loops matched by the reference loops.
+    specific
+        Dict of loop set name and loops not matched by any other set.
+    """
+    if not isinstance(loop_paths, dict):
+        names = [pathlib.Path(path).name.replace('.bedpe', '') for path in loop_paths]
+        duplicated = sorted({name for name in names if names.count(name) > 1})
+        if duplicated:
+            raise ValueError(f'Loop files have the same set name {duplicated}, '
+                             f'provide a dict of unique set name and bedpe path instead.')
+        loop_paths = dict(zip(names, loop_paths))
+    if len(loop_paths) < 2:
+        raise ValueError('At least two loop sets are needed for comparison.')
+
+    loops = {name: read_loop_bedpe(path, chroms=chroms) for name, path in loop_paths.items()}
+    all_chroms = sorted(set().union(*[set(df[0].unique()) for df in loops.values()]))
+    chrom_codes = {chrom: code for code, chrom in enumerate(all_chroms)}
+    max_pos = max([int(df[[1, 4]].values.max()) if df.shape[0] > 0 else 0 for df in loops.values()])
+    # chrom key span larger than any anchor +- dist, so loops on different chroms never match
+    span = max_pos + 2 * dist + 1
+    indexes = {name: _LoopIndex(df, chrom_codes, span) for name, df in loops.items()}
+
+    records = []
+    specific = {}
+    for query, query_index in indexes.items():
+        any_matched = np.zeros(query_index.n_loops, dtype=bool)
+        for reference, reference_index in indexes.items():
+            if query == reference:
+                continue
+            matched = query_index.match(reference_index, dist)
+            any_matched |= matched
+            n_overlap = int(matched.sum())
+            records.append([query, reference, query_index.n_loops, n_overlap,
+                            n_overlap / max(query_index.n_loops, 1)])
+        specific[query] = loops[query][~any_matched]
+    overlap = pd.DataFrame(records, columns=['query', 'reference', 'n_query', 'n_overlap', 'overlap_ratio'])
+
+    if output_prefix is not None:
+        overlap.to_csv(f'{output_prefix}.overlap.tsv', sep='\t', index=False)
+        for name, df in specific.items():
+            df.to_csv(f'{output_prefix}.{name}.specific.bedpe', sep='\t', index=False, header=False)
+    return overlap, specific
+
+
+if __name__ == '__main__':
+    # python compare_loop.py loop1.bedpe loop2.bedpe
+    # print the loop1 loops matched by loop2, save loop1 specific loops next to loop1
+    _overlap, _specific = compare_loops({'loop1': sys.argv[1], 'loop2': sys.argv[2]})
+    _row = _overlap.iloc[0]
+    print(_row['n_overlap'], _row['n_query'], _row['overlap_ratio'])
+    if len(sys.argv) == 3:
+        _specific['loop1'].to_csv('.'.join(sys.argv[1].split('.')[:-1]) + '.specific.bedpe',
+                                  sep='\t', index=False, header=False)
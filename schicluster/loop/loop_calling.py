@@ -1,19 +1,81 @@
 import cooler
 import numpy as np
 from scipy import stats
-from scipy.ndimage import convolve
+from scipy.ndimage import convolve, maximum_filter
 import pandas as pd
 import time
 from statsmodels.stats.multitest import multipletests
 from heapq import heappop, heapify
+from .loop_store import save_loop_table
 
 
 def fetch_chrom(cool, chrom) -> np.array:
     return cool.matrix(balance=False, sparse=True).fetch(chrom).toarray()
 
 
-def select_loop_candidates(cool_e, min_dist, max_dist, resolution, chrom):
-    """Select loop candidate pixel to perform t test"""
+def filter_loop_candidates(E, loop, min_e_zscore=None, top_frac=None, local_max_pad=None):
+    """
+    Pre-filter loop candidate pixels before the statistical tests.
+
+    Parameters
+    ----------
+    E
+        Dense E matrix of the chromosome.
+    loop
+        [xs, ys] of the loop candidate pixels.
+    min_e_zscore
+        Keep pixels whose E z-score among the candidates on the same diagonal is >= min_e_zscore.
+    top_frac
+        Keep the top fraction of pixels ranked by E on each diagonal.
+    local_max_pad
+        Keep pixels whose E is the maximum in the (2 * local_max_pad + 1) square window around it.
+
+    Returns
+    -------
+    Boolean mask of the candidates to keep.
+    """
+    values = E[loop]
+    diag = loop[1] - loop[0]
+    keep = np.ones(values.size, dtype=bool)
+    if values.size == 0:
+        return keep
+
+    diag_n = np.bincount(diag)
+    if min_e_zscore is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diag_mean = np.bincount(diag, weights=values) / diag_n
+            diag_var = np.bincount(diag, weights=values ** 2) / diag_n - diag_mean ** 2
+            diag_std = np.sqrt(np.clip(diag_var, 0, None))
+            zscore = (values - diag_mean[diag]) / diag_std[diag]
+        # diagonals with constant E have no outlier pixels
+        zscore[~np.isfinite(zscore)] = 0
+        keep &= zscore >= min_e_zscore
+
+    if top_frac is not None:
+        # rank pixels by E within each diagonal
+        order = np.lexsort((-values, diag))
+        sorted_diag = diag[order]
+        rank = np.arange(order.size) - np.searchsorted(sorted_diag, sorted_diag, side='left')
+        is_top = np.zeros(values.size, dtype=bool)
+        is_top[order] = rank < np.ceil(diag_n[sorted_diag] * top_frac)
+        keep &= is_top
+
+    if local_max_pad is not None:
+        # window maximum in one separable pass, windows are clipped at the matrix border
+        E_max = maximum_filter(E, size=2 * local_max_pad + 1, mode='nearest')
+        keep &= values >= E_max[loop]
+    return keep
+
+
+def select_loop_candidates(cool_e, min_dist, max_dist, resolution, chrom,
+                           min_e_zscore=None, top_frac=None, local_max_pad=None):
+    """
+    Select loop candidate pixel to perform t test.
+
+    If any pre-filter is set, only the candidates passing the pre-filter are returned,
+    n_candidates is the number of candidates on each diagonal before the pre-filter,
+    which is used as the number of tests in distance_fdr.
+    """
     E = fetch_chrom(cool_e, chrom)
     loop = np.where(E > 0)  # loop is [xs, ys] of E
 
@@ -22,7 +84,18 @@ def select_loop_candidates(cool_e, min_dist, max_dist, resolution, chrom):
                                  (loop[1] - loop[0]) < (max_dist / resolution))
     loop = (loop[0][dist_filter], loop[1][dist_filter])
     print(f'{chrom}\t{dist_filter.sum()} loop candidate pixels')
-    return E, loop
+
+    diag, counts = np.unique(loop[1] - loop[0], return_counts=True)
+    n_candidates = pd.Series(counts, index=diag * resolution)
+    if (min_e_zscore is not None) or (top_frac is not None) or (local_max_pad is not None):
+        keep = filter_loop_candidates(E, loop,
+                                      min_e_zscore=min_e_zscore,
+                                      top_frac=top_frac,
+                                      local_max_pad=local_max_pad)
+        loop = (loop[0][keep], loop[1][keep])
+        print(f'{chrom}\t{keep.sum()} loop candidate pixels kept after pre-filter '
+              f'({keep.sum() / max(keep.size, 1):.1%})')
+    return E, loop, n_candidates
 
 
 def paired_t_test(cool_t, cool_t2, chrom, loop, n_cells):
@@ -81,8 +154,20 @@ def call_loop_single_chrom(group_prefix,
                            min_dist=50000,
                            max_dist=10000000,
                            pad=5,
-                           gap=2):
-    """calculate t test and loop background for one chromosome"""
+                           gap=2,
+                           min_e_zscore=None,
+                           top_frac=None,
+                           local_max_pad=None):
+    """
+    calculate t test and loop background for one chromosome
+
+    Returns
+    -------
+    data
+        Loop candidate table.
+    n_candidates
+        Series of the number of candidates at each distance before the pre-filter.
+    """
     # matrix cool obj
     cool_e = cooler.Cooler(f'{group_prefix}.E.cool')
     cool_e2 = cooler.Cooler(f'{group_prefix}.E2.cool')
@@ -92,11 +177,14 @@ def call_loop_single_chrom(group_prefix,
 
     # call loop
     print(f'{chrom}\tSelecting loop candidates.')
-    E, loop = select_loop_candidates(cool_e=cool_e,
-                                     min_dist=min_dist,
-                                     max_dist=max_dist,
-                                     resolution=resolution,
-                                     chrom=chrom)
+    E, loop, n_candidates = select_loop_candidates(cool_e=cool_e,
+                                                   min_dist=min_dist,
+                                                   max_dist=max_dist,
+                                                   resolution=resolution,
+                                                   chrom=chrom,
+                                                   min_e_zscore=min_e_zscore,
+                                                   top_frac=top_frac,
+                                                   local_max_pad=local_max_pad)
 
     print(f'{chrom}\tDoing paired T test with the local background.')
     local_p_value, loop_t, local_d = paired_t_test(cool_t=cool_t,
@@ -134,7 +222,7 @@ def call_loop_single_chrom(group_prefix,
         'E_v': loop_v
     })
     data['chrom'] = chrom
-    return data
+    return data, n_candidates
 
 
 def filter_by_background(data, thres_bl, thres_donut, thres_h, thres_v,
@@ -205,33 +293,92 @@ def find_summit(loop, res, dist_thres):
     return loop
 
 
-def call_loops(group_prefix,
-               resolution,
-               output_prefix,
-               thres_bl=1.33,
-               thres_donut=1.33,
-               thres_h=1.2,
-               thres_v=1.2,
-               fdr_thres=0.1,
-               dist_thres=20000,
-               size_thres=1):
-    try:
-        group_q = f'{group_prefix}.Q.cool'
-        chroms = cooler.Cooler(group_q).chromnames
-    except OSError:
-        group_q = f'{group_prefix}.Q.mcool::/resolutions/10000'
-        chroms = cooler.Cooler(group_q).chromnames
+def _holm_sidak(p_values, n_tests):
+    """
+    Holm-Sidak step-down adjustment, the same as the multipletests default method,
+    with n_tests >= p_values.size tests in the family.
+    The tests not in p_values are treated as tests with p-value 1, which rank after all the given ones,
+    so the q-values are never smaller than the q-values of the full family.
+    """
+    order = np.argsort(p_values)
+    p_sorted = p_values[order]
+    with np.errstate(divide='ignore'):
+        q_sorted = -np.expm1(np.arange(n_tests, n_tests - p_sorted.size, -1) * np.log1p(-p_sorted))
+    q_sorted = np.minimum(np.maximum.accumulate(q_sorted), 1)
+    q_values = np.empty_like(q_sorted)
+    q_values[order] = q_sorted
+    return q_values
+
+
+def distance_fdr(total_loops, n_tests=None):
+    """
+    Group the loops by distance then calculate local and global FDR separately
+
+    Parameters
+    ----------
+    total_loops
+        Loop candidate table.
+    n_tests
+        Series of the number of tests at each distance. If the candidates are pre-filtered,
+        provide the number of candidates before the pre-filter, so the adjustment is over the full family.
+        If None, the number of candidates in total_loops is used.
+    """
+    total_loops.dropna(subset=['local_pval', 'global_pval'],
+                       how='any',
+                       inplace=True)
+    local_qs = []
+    global_qs = []
+    for dist in total_loops['distance'].unique():
+        p_values = total_loops.loc[total_loops['distance'] == dist,
+                                   ['local_pval', 'global_pval']]
+        if n_tests is None:
+            _, local_q, *_ = multipletests(p_values['local_pval'])
+            _, global_q, *_ = multipletests(p_values['global_pval'])
+        else:
+            n = max(int(n_tests[dist]), p_values.shape[0])
+            local_q = _holm_sidak(p_values['local_pval'].values, n)
+            global_q = _holm_sidak(p_values['global_pval'].values, n)
+        local_qs.append(pd.Series(local_q, index=p_values.index))
+        global_qs.append(pd.Series(global_q, index=p_values.index))
+    local_qs = pd.concat(local_qs).sort_index()
+    global_qs = pd.concat(global_qs).sort_index()
+    total_loops['local_qval'] = local_qs
+    total_loops['global_qval'] = global_qs
+    return total_loops
+
+
+def _call_total_loops(group_prefix,
+                      chroms,
+                      resolution=10000,
+                      min_dist=50000,
+                      max_dist=10000000,
+                      pad=5,
+                      gap=2,
+                      bkg_resolution=10000,
+                      thres_bl=1.33,
+                      thres_donut=1.33,
+                      thres_h=1.2,
+                      thres_v=1.2,
+                      min_e_zscore=None,
+                      top_frac=None,
+                      local_max_pad=None):
+    """Test the (pre-filtered) candidates of all the chromosomes, filter by background and calculate FDR."""
     total_loops = []
+    total_n_candidates = []
     for chrom in chroms:
         print(f'Calling loops of chromosome {chrom}')
-        data = call_loop_single_chrom(group_prefix,
-                                      chrom,
-                                      resolution=10000,
-                                      min_dist=50000,
-                                      max_dist=10000000,
-                                      pad=5,
-                                      gap=2)
+        data, n_candidates = call_loop_single_chrom(group_prefix,
+                                                    chrom,
+                                                    resolution=resolution,
+                                                    min_dist=min_dist,
+                                                    max_dist=max_dist,
+                                                    pad=pad,
+                                                    gap=gap,
+                                                    min_e_zscore=min_e_zscore,
+                                                    top_frac=top_frac,
+                                                    local_max_pad=local_max_pad)
         total_loops.append(data)
+        total_n_candidates.append(n_candidates)
     total_loops = pd.concat(total_loops).reset_index(drop=True)
 
     # add background judge info
@@ -241,29 +388,56 @@ def call_loops(group_prefix,
                                        thres_donut=thres_donut,
                                        thres_h=thres_h,
                                        thres_v=thres_v,
-                                       resolution=resolution)
+                                       resolution=bkg_resolution)
 
     # Group the loops by distance then calculate FDR separately
     print('Filtering loop by FDR.')
-    total_loops.dropna(subset=['local_pval', 'global_pval'],
-                       how='any',
-                       inplace=True)
-    local_qs = []
-    global_qs = []
-    for dist in total_loops['distance'].unique():
-        p_values = total_loops.loc[total_loops['distance'] == dist,
-                                   ['local_pval', 'global_pval']]
-        _, local_q, *_ = multipletests(p_values['local_pval'])
-        local_qs.append(pd.Series(local_q, index=p_values.index))
-        _, global_q, *_ = multipletests(p_values['global_pval'])
-        global_qs.append(pd.Series(global_q, index=p_values.index))
-    local_qs = pd.concat(local_qs).sort_index()
-    global_qs = pd.concat(global_qs).sort_index()
-    total_loops['local_qval'] = local_qs
-    total_loops['global_qval'] = global_qs
+    if (min_e_zscore is not None) or (top_frac is not None) or (local_max_pad is not None):
+        # candidates removed by the pre-filter still count as tests
+        n_tests = pd.concat(total_n_candidates).groupby(level=0).sum()
+        total_loops = distance_fdr(total_loops, n_tests=n_tests)
+    else:
+        total_loops = distance_fdr(total_loops)
+    return total_loops
 
-    # apply all the filters
-    total_loops.to_hdf(f'{output_prefix}.totalloop_info.hdf', key='data')
+
+def call_loops(group_prefix,
+               resolution,
+               output_prefix,
+               thres_bl=1.33,
+               thres_donut=1.33,
+               thres_h=1.2,
+               thres_v=1.2,
+               fdr_thres=0.1,
+               dist_thres=20000,
+               size_thres=1,
+               min_e_zscore=None,
+               top_frac=None,
+               local_max_pad=None):
+    try:
+        group_q = f'{group_prefix}.Q.cool'
+        chroms = cooler.Cooler(group_q).chromnames
+    except OSError:
+        group_q = f'{group_prefix}.Q.mcool::/resolutions/10000'
+        chroms = cooler.Cooler(group_q).chromnames
+    total_loops = _call_total_loops(group_prefix,
+                                    chroms,
+                                    resolution=10000,
+                                    min_dist=50000,
+                                    max_dist=10000000,
+                                    pad=5,
+                                    gap=2,
+                                    bkg_resolution=resolution,
+                                    thres_bl=thres_bl,
+                                    thres_donut=thres_donut,
+                                    thres_h=thres_h,
+                                    thres_v=thres_v,
+                                    min_e_zscore=min_e_zscore,
+                                    top_frac=top_frac,
+                                    local_max_pad=local_max_pad)
+
+    # save all the candidates in columnar format, consumers can query loops by region and filters
+    save_loop_table(total_loops, f'{output_prefix}.totalloop_info.zarr')
 
     # filter loops, save bedpe, and get summit
     filter_loops(total_loops,
@@ -320,3 +494,75 @@ def filter_loops(total_loops,
             f.write(pd.DataFrame([]).to_csv())
     return
 
+
+def evaluate_candidate_filter(group_prefix,
+                              chroms,
+                              resolution=10000,
+                              min_dist=50000,
+                              max_dist=10000000,
+                              pad=5,
+                              gap=2,
+                              thres_bl=1.33,
+                              thres_donut=1.33,
+                              thres_h=1.2,
+                              thres_v=1.2,
+                              fdr_thres=0.1,
+                              min_e_zscore=None,
+                              top_frac=None,
+                              local_max_pad=None):
+    """
+    Report the recall and precision of the loops called with the candidate pre-filter.
+
+    The unfiltered run and the filtered run go through the same path as call_loops,
+    the filtered run only tests the candidates kept by the pre-filter,
+    then the loop pixels of the two runs are compared.
+    FDR is calculated over the given chromosomes only, so use it as an estimate.
+
+    Returns
+    -------
+    Dataframe of per chromosome candidate and loop pixel numbers of the unfiltered and filtered runs.
+    """
+    kwargs = dict(resolution=resolution,
+                  min_dist=min_dist,
+                  max_dist=max_dist,
+                  pad=pad,
+                  gap=gap,
+                  bkg_resolution=resolution,
+                  thres_bl=thres_bl,
+                  thres_donut=thres_donut,
+                  thres_h=thres_h,
+                  thres_v=thres_v)
+    total_loops = _call_total_loops(group_prefix, chroms, **kwargs)
+    filtered_loops = _call_total_loops(group_prefix,
+                                       chroms,
+                                       min_e_zscore=min_e_zscore,
+                                       top_frac=top_frac,
+                                       local_max_pad=local_max_pad,
+                                       **kwargs)
+
+    def _loop_pixels(_data):
+        _data = _data.loc[_data['bkfilter']
+                          & (_data['local_qval'] < fdr_thres)
+                          & (_data['global_qval'] < fdr_thres)]
+        return _data.set_index(['chrom', 'x1', 'y1']).index
+
+    loops = _loop_pixels(total_loops)
+    filtered = _loop_pixels(filtered_loops)
+    shared = loops.intersection(filtered)
+
+    records = {}
+    for chrom in chroms:
+        records[chrom] = {
+            'candidates': (total_loops['chrom'] == chrom).sum(),
+            'candidates_kept': (filtered_loops['chrom'] == chrom).sum(),
+            'loops': (loops.get_level_values('chrom') == chrom).sum(),
+            'filtered_loops': (filtered.get_level_values('chrom') == chrom).sum(),
+            'shared_loops': (shared.get_level_values('chrom') == chrom).sum()
+        }
+    report = pd.DataFrame(records).T
+    report.loc['total'] = report.sum()
+    report['candidate_frac'] = report['candidates_kept'] / report['candidates']
+    report['recall'] = report['shared_loops'] / report['loops']
+    report['precision'] = report['shared_loops'] / report['filtered_loops']
+    print(report)
+    return report
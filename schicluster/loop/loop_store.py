@@ -0,0 +1,234 @@
+"""
+Columnar loop table stored in zarr.
+
+The loop table is partitioned by chromosome (one zarr group per chromosome),
+rows are sorted by distance band, then by x1 inside each band,
+and each column is saved as a chunked 1D array.
+The min and max of each column chunk are saved in the group attrs (zone map),
+so queries only read the chunks that may contain rows passing the filters.
+The sort order keeps the zone map of each chunk narrow on both distance and anchor position,
+so distance filters and region queries can both skip chunks.
+
+Loop tables of earlier versions were saved as "{prefix}.totalloop_info.hdf" pandas HDF files,
+read_loop_table falls back to the legacy HDF file when the zarr store does not exist.
+"""
+
+import operator
+import pathlib
+import warnings
+
+import numpy as np
+import pandas as pd
+import zarr
+
+LOOP_CHUNK_SIZE = 100000
+LOOP_DISTANCE_BAND = 1000000
+
+_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+
+
+def _chunk_min_max(values, chunk_size):
+    zone_map = []
+    for start in range(0, values.size, chunk_size):
+        chunk = values[start:start + chunk_size]
+        with warnings.catch_warnings():
+            # all nan chunk
+            warnings.simplefilter("ignore")
+            _min = np.nanmin(chunk)
+            _max = np.nanmax(chunk)
+        if np.isnan(_min) or np.isnan(_max):
+            # unknown range, the chunk will always be read
+            zone_map.append(None)
+        else:
+            zone_map.append([_min.item(), _max.item()])
+    return zone_map
+
+
+def _chunk_may_match(zone, op, value):
+    if zone is None:
+        return True
+    _min, _max = zone
+    if op == '<':
+        return _min < value
+    elif op == '<=':
+        return _min <= value
+    elif op == '>':
+        return _max > value
+    elif op == '>=':
+        return _max >= value
+    elif op == '==':
+        return _min <= value <= _max
+    elif op == '!=':
+        return not (_min == _max == value)
+    else:
+        raise ValueError(f'Unknown operator {op}, use one of {list(_OPERATORS.keys())}')
+
+
+def save_loop_table(total_loops, path, chunk_size=LOOP_CHUNK_SIZE, distance_band=LOOP_DISTANCE_BAND):
+    """
+    Save loop table to zarr, partitioned by chromosome and sorted by distance band and x1.
+
+    Parameters
+    ----------
+    total_loops
+        Loop table with "chrom", "distance" and "x1" columns.
+    path
+        Path to the output zarr dir, will be overwritten if exists.
+    chunk_size
+        Number of rows in each column chunk.
+    distance_band
+        Width of the distance bands in bp, rows are sorted by x1 inside each band.
+    """
+    root = zarr.open_group(str(path), mode='w')
+    columns = [col for col in total_loops.columns if col != 'chrom']
+    chroms = []
+    for chrom, chrom_df in total_loops.groupby('chrom', sort=False):
+        # lexsort is stable, the last key is the primary key
+        order = np.lexsort((chrom_df['distance'].values,
+                            chrom_df['x1'].values,
+                            chrom_df['distance'].values // distance_band))
+        chrom_df = chrom_df.iloc[order]
+        group = root.create_group(chrom)
+        zone_maps = {}
+        for col in columns:
+            values = chrom_df[col].values
+            group.array(col, values, chunks=(chunk_size,))
+            if values.dtype.kind in 'biuf':
+                zone_maps[col] = _chunk_min_max(values.astype(np.float64), chunk_size)
+        group.attrs['n_loops'] = chrom_df.shape[0]
+        group.attrs['chunk_size'] = chunk_size
+        group.attrs['distance_band'] = distance_band
+        group.attrs['zone_map'] = zone_maps
+        chroms.append(chrom)
+    root.attrs['chroms'] = chroms
+    root.attrs['columns'] = columns
+    zarr.consolidate_metadata(str(path))
+    return
+
+
+def _select_chunks(zone_maps, n_loops, chunk_size, filters):
+    """Ids of the chunks that may contain rows passing the filters, according to the zone map."""
+    chunk_ids = []
+    for chunk_id in range((n_loops + chunk_size - 1) // chunk_size):
+        if all(_chunk_may_match(zone_maps[col][chunk_id], op, value)
+               for col, op, value in filters if col in zone_maps):
+            chunk_ids.append(chunk_id)
+    return chunk_ids
+
+
+def _legacy_hdf_path(path):
+    """Path of the legacy HDF loop table to read, or None if the zarr store should be read."""
+    path = pathlib.Path(path)
+    if path.suffix == '.hdf':
+        return path
+    if path.suffix == '.zarr' and not path.exists() and path.with_suffix('.hdf').exists():
+        return path.with_suffix('.hdf')
+    return None
+
+
+def _read_legacy_loop_table(hdf_path, chroms, columns, filters):
+    data = pd.read_hdf(hdf_path)
+    judge = np.ones(data.shape[0], dtype=bool)
+    if chroms is not None:
+        judge &= data['chrom'].isin(chroms).values
+    for col, op, value in filters:
+        judge &= _OPERATORS[op](data[col].values, value)
+    data = data.loc[judge]
+    if columns is not None:
+        data = data[columns + ['chrom']]
+    return data.reset_index(drop=True)
+
+
+def read_loop_table(path, chroms=None, region=None, columns=None, filters=None):
+    """
+    Read loop table from zarr, only the chunks that may pass the filters are read.
+
+    Parameters
+    ----------
+    path
+        Path to the zarr dir saved by save_loop_table.
+        If the zarr dir does not exist, the legacy "*.hdf" loop table with the same prefix is read.
+    chroms
+        Chromosomes to read, if None, read all chromosomes.
+    region
+        (chrom, start, end) tuple, only read loops with both anchors inside the region.
+    columns
+        Columns to read, if None, read all columns.
+    filters
+        List of (column, operator, value) tuples, operator is one of "<", "<=", ">", ">=", "==", "!=".
+        Rows pass all the filters are returned.
+
+    Returns
+    -------
+    Loop table dataframe with "chrom" column.
+    """
+    if columns is not None:
+        columns = [col for col in columns if col != 'chrom']
+    filters = [] if filters is None else list(filters)
+    if region is not None:
+        region_chrom, start, end = region
+        chroms = [region_chrom]
+        filters += [('x1', '>=', start), ('y2', '<=', end)]
+
+    legacy_path = _legacy_hdf_path(path)
+    if legacy_path is not None:
+        for col, op, _ in filters:
+            if op not in _OPERATORS:
+                raise ValueError(f'Unknown operator {op}, use one of {list(_OPERATORS.keys())}')
+        return _read_legacy_loop_table(legacy_path, chroms=chroms, columns=columns, filters=filters)
+
+    root = zarr.open_consolidated(str(path), mode='r')
+    all_columns = root.attrs['columns']
+    if columns is None:
+        columns = all_columns
+    if chroms is None:
+        chroms = root.attrs['chroms']
+    for col, op, _ in filters:
+        if col not in all_columns:
+            raise KeyError(f'Filter column {col} not in loop table')
+        if op not in _OPERATORS:
+            raise ValueError(f'Unknown operator {op}, use one of {list(_OPERATORS.keys())}')
+
+    records = []
+    for chrom in chroms:
+        if chrom not in root:
+            continue
+        group = root[chrom]
+        n_loops = group.attrs['n_loops']
+        chunk_size = group.attrs['chunk_size']
+        zone_maps = group.attrs['zone_map']
+
+        # predicate pushdown with the chunk zone map
+        for chunk_id in _select_chunks(zone_maps, n_loops, chunk_size, filters):
+            chunk_start = chunk_id * chunk_size
+            chunk_slice = slice(chunk_start, chunk_start + chunk_size)
+            judge = np.ones(min(chunk_size, n_loops - chunk_start), dtype=bool)
+            chunk_values = {}
+            for col, op, value in filters:
+                if col not in chunk_values:
+                    chunk_values[col] = group[col][chunk_slice]
+                judge &= _OPERATORS[op](chunk_values[col], value)
+            if judge.sum() == 0:
+                continue
+
+            chunk_df = {}
+            for col in columns:
+                if col in chunk_values:
+                    values = chunk_values[col]
+                else:
+                    values = group[col][chunk_slice]
+                chunk_df[col] = values[judge]
+            chunk_df = pd.DataFrame(chunk_df)
+            chunk_df['chrom'] = chrom
+            records.append(chunk_df)
+
+    if len(records) == 0:
+        return pd.DataFrame([], columns=columns + ['chrom'])
+    return pd.concat(records).reset_index(drop=True)
@@ -1,12 +1,15 @@
 import time
+import shutil
 import h5py
 import cooler
 import pathlib
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix, load_npz, triu
-from ..cool import write_coo, get_chrom_offsets
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.sparse import csr_matrix, coo_matrix, load_npz, triu
+from cooler.util import parse_cooler_uri
+from ..cool import write_coo, get_chrom_offsets, chrom_iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing.util import Finalize
 
 """
 Matrix names
@@ -45,46 +48,137 @@ def merge_cells_for_single_chromosome(output_dir,
     return
 
 
-def read_single_cool_chrom(cool_path, chrom, chrom2=None):
-    # Used in chrom_sum_iterator, return the sum according to group_n_cells
-    # Also used in merge_raw_matrix and merge_group
-    # Output chrom matrix
-    cool = cooler.Cooler(str(cool_path))
-    selector = cool.matrix(balance=False, sparse=True)
-    if chrom2 is None:
-        matrix = triu(selector.fetch(chrom))
-    else:
-        if chrom == chrom2:
-            matrix = triu(selector.fetch(chrom, chrom2))
+class MultiCoolChromReader:
+    """
+    Read and sum the same chromosome block from multiple cool files.
+
+    Each input is opened once and its ``group_n_cells`` attr is cached,
+    chromosome blocks of all inputs are fetched on a thread pool
+    and reduced with a single concatenate-and-sum.
+
+    Parameters
+    ----------
+    cool_paths :
+        List of cool paths or cooler URIs (e.g. scool cell URIs).
+    n_threads :
+        Number of threads used to fetch blocks from the inputs.
+    """
+
+    def __init__(self, cool_paths, n_threads=1):
+        self.cool_paths = [str(p) for p in cool_paths]
+        self.n_threads = n_threads
+        self._h5s = []
+        self.cools = []
+        self.scales = []
+        for cool_path in self.cool_paths:
+            file_path, group_path = parse_cooler_uri(cool_path)
+            h5 = h5py.File(file_path, 'r')
+            self._h5s.append(h5)
+            self.cools.append(cooler.Cooler(h5[group_path]))
+            # group_n_cells of the group cools is stored in the file root attrs, also for the cooler URIs
+            self.scales.append(h5.attrs.get('group_n_cells', None))
+        self._executor = ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+
+    @property
+    def n_cells(self):
+        """Total number of cells, counted by group_n_cells if exists, otherwise 1 per cool."""
+        return sum(1 if scale is None else scale for scale in self.scales)
+
+    def _fetch_one(self, i, region1, region2, triu_k):
+        selector = self.cools[i].matrix(balance=False, sparse=True)
+        matrix = selector.fetch(region1, region2)
+        if triu_k is not None:
+            matrix = triu(matrix, k=triu_k)
+        matrix = matrix.tocoo()
+        scale = self.scales[i]
+        if scale is not None:
+            matrix.data = matrix.data * scale
+        return matrix
+
+    def fetch_sum_region(self, region1, region2, triu_k=None):
+        """
+        Sum the region1-by-region2 matrix over all the inputs.
+
+        Parameters
+        ----------
+        region1 :
+            Row region, chrom name or (chrom, start, end) tuple.
+        region2 :
+            Column region, chrom name or (chrom, start, end) tuple.
+        triu_k :
+            If not None, only keep pixels with col - row >= triu_k (local coordinates).
+
+        Returns
+        -------
+        Summed matrix in COO format, with sorted and unique coordinates.
+        """
+        def _fetch(i):
+            return self._fetch_one(i, region1, region2, triu_k)
+
+        if self._executor is None:
+            matrices = [_fetch(i) for i in range(len(self.cools))]
         else:
-            matrix = selector.fetch(chrom, chrom2)
-    with h5py.File(cool_path, 'r') as f:
-        if 'group_n_cells' in f.attrs:
-            matrix.data *= f.attrs['group_n_cells']
-    return matrix
+            matrices = list(self._executor.map(_fetch, range(len(self.cools))))
+        return self.sum_matrices(matrices)
+
+    def fetch_sum(self, chrom, chrom2=None):
+        """
+        Sum the chrom-by-chrom2 matrix over all the inputs.
+        Only the upper triangle is kept for cis matrix.
+
+        Returns
+        -------
+        Summed matrix in COO format, with sorted and unique coordinates.
+        """
+        region2 = chrom if chrom2 is None else chrom2
+        triu_k = 0 if region2 == chrom else None
+        return self.fetch_sum_region(chrom, region2, triu_k=triu_k)
+
+    @staticmethod
+    def sum_matrices(matrices):
+        """Concatenate COO matrices of the same shape and sum duplicated pixels once."""
+        shape = matrices[0].shape
+        row = np.concatenate([m.row for m in matrices])
+        col = np.concatenate([m.col for m in matrices])
+        data = np.concatenate([m.data for m in matrices])
+        # tocsr sums duplicates and sorts indices, so the tocoo result is ordered by row and col
+        return coo_matrix((data, (row, col)), shape=shape).tocsr().tocoo()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for h5 in self._h5s:
+            h5.close()
+        self._h5s = []
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 def chrom_sum_iterator(input_cool_list,
                        chrom_sizes,
                        chrom_offset, 
-                       total_cells):
+                       total_cells,
+                       n_threads=1):
     # Used in save_single_matrix_type, return the average over cells
     # total_cells need to be provided
     # Output chrom df
-    for chrom in chrom_sizes.keys():
-        cool_path = input_cool_list[0]
-        matrix = read_single_cool_chrom(cool_path, chrom)
-        for cool_path in input_cool_list[1:]:
-            matrix += read_single_cool_chrom(cool_path, chrom)
-        matrix = matrix.tocoo()
-        pixel_df = pd.DataFrame({
-            'bin1_id': matrix.row,
-            'bin2_id': matrix.col,
-            'count': matrix.data
-        })
-        pixel_df.iloc[:, :2] += chrom_offset[chrom]
-        pixel_df.iloc[:, -1] /= total_cells
-        yield pixel_df
+    with MultiCoolChromReader(input_cool_list, n_threads=n_threads) as reader:
+        for chrom in chrom_sizes.keys():
+            matrix = reader.fetch_sum(chrom)
+            pixel_df = pd.DataFrame({
+                'bin1_id': matrix.row,
+                'bin2_id': matrix.col,
+                'count': matrix.data
+            })
+            pixel_df.iloc[:, :2] += chrom_offset[chrom]
+            pixel_df.iloc[:, -1] /= total_cells
+            yield pixel_df
 
 
 def save_single_matrix_type(input_cool_list, 
@@ -92,14 +186,16 @@ def save_single_matrix_type(input_cool_list,
                             bins_df,
                             chrom_sizes,
                             chrom_offset,
-                            total_cells):
+                            total_cells,
+                            n_threads=1):
     # Used by merge_group_chunks_to_group_cools and merge_cool
     # total_cells need to be provided
     # Output cool
     chrom_iter = chrom_sum_iterator(input_cool_list,
                                     chrom_sizes,
                                     chrom_offset,
-                                    total_cells)
+                                    total_cells,
+                                    n_threads=n_threads)
     cooler.create_cooler(cool_uri=output_cool,
                          bins=bins_df,
                          pixels=chrom_iter,
@@ -110,7 +206,135 @@ def save_single_matrix_type(input_cool_list,
     return
  
 
-def merge_cool(input_cool_tsv_file, output_cool):
+# readers opened by the current worker process, keyed by the input cool list of one matrix type
+_WORKER_READERS = {}
+
+
+def _close_worker_readers():
+    for reader in _WORKER_READERS.values():
+        reader.close()
+    _WORKER_READERS.clear()
+    return
+
+
+def _init_worker_readers():
+    # Used as the process pool initializer of save_matrix_types_by_chrom,
+    # the readers only live for one call: they are closed when the pool shuts down and the worker exits.
+    _WORKER_READERS.clear()
+    Finalize(None, _close_worker_readers, exitpriority=10)
+    return
+
+
+def _get_worker_reader(input_cool_list):
+    # Used by _save_single_chrom_part, each worker opens the inputs of a matrix type once
+    # and reuses the reader for all the chromosomes it processes.
+    key = tuple(str(p) for p in input_cool_list)
+    reader = _WORKER_READERS.get(key)
+    if reader is None:
+        reader = MultiCoolChromReader(input_cool_list)
+        _WORKER_READERS[key] = reader
+    return reader
+
+
+def _save_single_chrom_part(input_cool_list, chrom, output_path, total_cells):
+    # Used by save_matrix_types_by_chrom, save one chromosome of one matrix type as pixel part
+    matrix = _get_worker_reader(input_cool_list).fetch_sum(chrom)
+    matrix.data = matrix.data / total_cells
+    write_coo(output_path, matrix)
+    return
+
+
+def _concat_chrom_parts(output_cool,
+                        part_dir,
+                        bins_df,
+                        chrom_sizes,
+                        chrom_offset,
+                        total_cells):
+    # Used by save_matrix_types_by_chrom, concatenate chromosome pixel parts into the final cool in order
+    cooler.create_cooler(cool_uri=output_cool,
+                         bins=bins_df,
+                         pixels=chrom_iterator(input_dir=part_dir,
+                                               chrom_order=list(chrom_sizes.keys()),
+                                               chrom_offset=chrom_offset,
+                                               chrom_wildcard='{chrom}.hdf'),
+                         ordered=True,
+                         dtypes={'count': np.float32})
+    with h5py.File(output_cool, 'a') as f:
+        f.attrs['group_n_cells'] = total_cells
+    shutil.rmtree(part_dir)
+    return
+
+
+def save_matrix_types_by_chrom(cool_lists,
+                               bins_df,
+                               chrom_sizes,
+                               chrom_offset,
+                               total_cells,
+                               cpu=1):
+    """
+    Merge multiple matrix types in parallel over chromosome x matrix type.
+
+    Each worker writes one chromosome of one matrix type to a pixel part,
+    the input cools of a matrix type are opened once per worker and shared by its chromosome tasks
+    (closed when the pool of this call shuts down),
+    once all chromosomes of a matrix type finished, the parts are concatenated into the final cool in order.
+
+    Parameters
+    ----------
+    cool_lists :
+        Dict of output cool path and its list of input cool paths.
+    bins_df :
+        Dataframe of bins.
+    chrom_sizes :
+        Chromosome sizes series.
+    chrom_offset :
+        Dictionary of chromosome offsets.
+    total_cells :
+        Total number of cells, the summed matrix will be divided by this number.
+    cpu :
+        Number of CPUs to use.
+    """
+    chroms = list(chrom_sizes.keys())
+    with ProcessPoolExecutor(cpu, initializer=_init_worker_readers) as exe:
+        futures = {}
+        part_dirs = {}
+        remaining = {}
+        for output_cool, input_cool_list in cool_lists.items():
+            part_dir = pathlib.Path(f'{output_cool}_parts')
+            part_dir.mkdir(exist_ok=True, parents=True)
+            part_dirs[output_cool] = part_dir
+            remaining[output_cool] = len(chroms)
+            for chrom in chroms:
+                future = exe.submit(_save_single_chrom_part,
+                                    input_cool_list=input_cool_list,
+                                    chrom=chrom,
+                                    output_path=str(part_dir / f'{chrom}.hdf'),
+                                    total_cells=total_cells)
+                futures[future] = output_cool
+
+        concat_futures = {}
+        for future in as_completed(futures):
+            output_cool = futures[future]
+            future.result()
+            remaining[output_cool] -= 1
+            if remaining[output_cool] == 0:
+                # all chromosomes of this matrix type finished
+                concat_future = exe.submit(_concat_chrom_parts,
+                                           output_cool=output_cool,
+                                           part_dir=str(part_dirs[output_cool]),
+                                           bins_df=bins_df,
+                                           chrom_sizes=chrom_sizes,
+                                           chrom_offset=chrom_offset,
+                                           total_cells=total_cells)
+                concat_futures[concat_future] = output_cool
+        for future in as_completed(concat_futures):
+            output_cool = concat_futures[future]
+            future.result()
+            print(f'Matrix {output_cool} generated')
+    return
+
+
+def merge_cool(input_cool_tsv_file, output_cool, n_threads=1):
     # Input could be cool files of single cell or average over cells
     # Output is average over cells
     # total_cell is counted over cools according to group_n_cells, otherwise 1
@@ -121,20 +345,16 @@ def merge_cool(input_cool_tsv_file, output_cool):
     bins_df = cool.bins()[["chrom", "start", "end"]][:]
     chrom_sizes = cool.chromsizes[:]
     chrom_offset = get_chrom_offsets(bins_df)
-    total_cells = 0
-    for cool_path in input_cool_list:
-        with h5py.File(cool_path, 'r') as f:
-            if 'group_n_cells' in f.attrs:
-                total_cells += f.attrs['group_n_cells']
-            else:
-                total_cells += 1
+    with MultiCoolChromReader(input_cool_list) as reader:
+        total_cells = reader.n_cells
 
     save_single_matrix_type(input_cool_list, 
                             output_cool,
                             bins_df,
                             chrom_sizes,
                             chrom_offset,
-                            total_cells)
+                            total_cells,
+                            n_threads=n_threads)
     return
 
 
@@ -142,7 +362,8 @@ def merge_group_chunks_to_group_cools(chrom_size_path,
                                       resolution,
                                       group,
                                       output_dir,
-                                      matrix_types=('E', 'E2', 'T', 'T2', 'Q', 'Q2')):
+                                      matrix_types=('E', 'E2', 'T', 'T2', 'Q', 'Q2'),
+                                      cpu=6):
     # Input is sum over cells per chunk
     # Output is average over cells of all chunks
     # total_cell is counted over cell_table.csv per chunk
@@ -163,23 +384,16 @@ def merge_group_chunks_to_group_cools(chrom_size_path,
     bins_df = cooler.binnify(chrom_sizes, resolution)
     chrom_offset = get_chrom_offsets(bins_df)
 
-    with ProcessPoolExecutor(6) as exe:
-        futures = {}
-        for matrix_type in matrix_types:
-            output_cool = str(group_dir / f'{group}.{matrix_type}.cool')
-            input_cool_list = [chunk_dir / f'{matrix_type}.cool' for chunk_dir in chunk_dirs]
-            future = exe.submit(save_single_matrix_type,
-                                input_cool_list=input_cool_list,
-                                output_cool=output_cool,
-                                bins_df=bins_df,
-                                chrom_sizes=chrom_sizes,
-                                chrom_offset=chrom_offset,
-                                total_cells=total_cells)
-            futures[future] = matrix_type
-        for future in as_completed(futures):
-            matrix_type = futures[future]
-            print(f'Matrix {matrix_type} generated')
-            future.result()
+    cool_lists = {
+        str(group_dir / f'{group}.{matrix_type}.cool'): [chunk_dir / f'{matrix_type}.cool' for chunk_dir in chunk_dirs]
+        for matrix_type in matrix_types
+    }
+    save_matrix_types_by_chrom(cool_lists=cool_lists,
+                               bins_df=bins_df,
+                               chrom_sizes=chrom_sizes,
+                               chrom_offset=chrom_offset,
+                               total_cells=total_cells,
+                               cpu=cpu)
     return
 
 
@@ -189,7 +403,8 @@ def merge_group_to_bigger_group_cools(chrom_size_path,
                                       output_dir,
                                       group_list,
                                       shuffle,
-                                      matrix_types=('E', 'E2', 'T', 'T2', 'Q', 'Q2')):
+                                      matrix_types=('E', 'E2', 'T', 'T2', 'Q', 'Q2'),
+                                      cpu=6):
     """
     Sum all the group average cool files,
     and finally divide the total number of cells to
@@ -214,21 +429,15 @@ def merge_group_to_bigger_group_cools(chrom_size_path,
     bins_df = cooler.binnify(chrom_sizes, resolution)
     chrom_offset = get_chrom_offsets(bins_df)
 
-    with ProcessPoolExecutor(6) as exe:
-        futures = {}
-        for matrix_type in matrix_types:
-            output_cool = str(group_dir / f'{group}.{matrix_type}.cool')
-            input_cool_list = [list(group_dir.glob(f'*/*.{matrix_type}.cool'))[0] for group_dir in group_list]
-            future = exe.submit(save_single_matrix_type,
-                                input_cool_list=input_cool_list,
-                                output_cool=output_cool,
-                                bins_df=bins_df,
-                                chrom_sizes=chrom_sizes,
-                                chrom_offset=chrom_offset,
-                                total_cells=total_cells)
-            futures[future] = matrix_type
-        for future in as_completed(futures):
-            matrix_type = futures[future]
-            print(f'Matrix {matrix_type} generated')
-            future.result()
+    cool_lists = {
+        str(group_dir / f'{group}.{matrix_type}.cool'): [list(_dir.glob(f'*/*.{matrix_type}.cool'))[0]
+                                                         for _dir in group_list]
+        for matrix_type in matrix_types
+    }
+    save_matrix_types_by_chrom(cool_lists=cool_lists,
+                               bins_df=bins_df,
+                               chrom_sizes=chrom_sizes,
+                               chrom_offset=chrom_offset,
+                               total_cells=total_cells,
+                               cpu=cpu)
     return
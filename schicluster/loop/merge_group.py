@@ -1,59 +1,8 @@
 import pathlib
-import time
-import numpy as np
-from scipy.sparse import csr_matrix, load_npz, triu
-from ..cool import write_coo, get_chrom_offsets
-from .merge_cell_to_group import read_single_cool_chrom
+from ..cool import get_chrom_offsets
+from .merge_cell_to_group import save_matrix_types_by_chrom
 import cooler
 import pandas as pd
-import h5py
-from concurrent.futures import ProcessPoolExecutor, as_completed
-
-
-def chrom_ave_iterator(chunk_dirs,
-                       chrom_sizes,
-                       chrom_offset,
-                       matrix_type,
-                       total_cells):
-    print(f'Reading matrix {matrix_type}')
-    for chrom in chrom_sizes.keys():
-        cool_path = list(chunk_dirs[0].glob(f'*/*.{matrix_type}.cool'))
-        with h5py.File(cool_path, 'r') as f:
-            matrix = read_single_cool_chrom(cool_path, chrom)
-        for chunk_dir in chunk_dirs[1:]:
-            cool_path = list(chunk_dir.glob(f'*/*.{matrix_type}.cool'))
-            matrix += read_single_cool_chrom(cool_path, chrom)
-        matrix = matrix.tocoo()
-        pixel_df = pd.DataFrame({
-            'bin1_id': matrix.row,
-            'bin2_id': matrix.col,
-            'count': matrix.data
-        })
-        pixel_df.iloc[:, :2] += chrom_offset[chrom]
-        pixel_df.iloc[:, -1] /= total_cells
-        yield pixel_df
-
-
-def save_single_matrix_type(cooler_path,
-                            bins_df,
-                            chunk_dirs,
-                            chrom_sizes,
-                            chrom_offset, 
-                            matrix_type,
-                            total_cells):
-    chrom_iter = chrom_ave_iterator(chunk_dirs,
-                                    chrom_sizes,
-                                    chrom_offset,
-                                    matrix_type,
-                                    total_cells)
-    cooler.create_cooler(cool_uri=cooler_path,
-                         bins=bins_df,
-                         pixels=chrom_iter,
-                         ordered=True,
-                         dtypes={'count': np.float32})
-    with h5py.File(cooler_path, 'a') as f:
-        f.attrs['group_n_cells'] = total_cells
-    return
 
 
 def merge_group_to_bigger_group_cools(chrom_size_path,
@@ -62,7 +11,8 @@ def merge_group_to_bigger_group_cools(chrom_size_path,
                                       output_dir,
                                       group_list,
                                       shuffle,
-                                      matrix_types=('E', 'E2', 'T', 'T2', 'Q', 'Q2')):
+                                      matrix_types=('E', 'E2', 'T', 'T2', 'Q', 'Q2'),
+                                      cpu=5):
     """
     Sum all the chunk sum cool files,
     and finally divide the total number of cells to
@@ -87,21 +37,15 @@ def merge_group_to_bigger_group_cools(chrom_size_path,
     bins_df = cooler.binnify(chrom_sizes, resolution)
     chrom_offset = get_chrom_offsets(bins_df)
 
-    with ProcessPoolExecutor(5) as exe:
-        futures = {}
-        for matrix_type in matrix_types:
-            cooler_path = str(group_dir / f'{group}.{matrix_type}.cool')
-            future = exe.submit(save_single_matrix_type,
-                                cooler_path=cooler_path,
-                                bins_df=bins_df,
-                                chunk_dirs=group_list,
-                                chrom_sizes=chrom_sizes,
-                                chrom_offset=chrom_offset,
-                                matrix_type=matrix_type,
-                                total_cells=total_cells)
-            futures[future] = matrix_type
-        for future in as_completed(futures):
-            matrix_type = futures[future]
-            print(f'Matrix {matrix_type} generated')
-            future.result()
+    cool_lists = {
+        str(group_dir / f'{group}.{matrix_type}.cool'): [list(chunk_dir.glob(f'*/*.{matrix_type}.cool'))[0]
+                                                         for chunk_dir in group_list]
+        for matrix_type in matrix_types
+    }
+    save_matrix_types_by_chrom(cool_lists=cool_lists,
+                               bins_df=bins_df,
+                               chrom_sizes=chrom_sizes,
+                               chrom_offset=chrom_offset,
+                               total_cells=total_cells,
+                               cpu=cpu)
     return
@@ -5,18 +5,25 @@ import cooler
 import h5py
 import shutil
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.sparse import hstack
 
 from ..cool import get_chrom_offsets
-from .merge_cell_to_group import read_single_cool_chrom
+from .merge_cell_to_group import MultiCoolChromReader
 
 
 def _chrom_sum_iterator(cell_urls,
                         chrom_sizes,
                         chrom_offset,
-                        add_trans=False):
+                        add_trans=False,
+                        n_threads=1,
+                        trans_chunk_size=50000000):
     """
     Iterate through the raw matrices and chromosomes of cells.
 
+    If add_trans, each chrom1 row block is emitted in bin order by
+    horizontally stacking the sorted chrom1-by-chrom2 blocks (chrom2 in offset order),
+    which is a linear merge of the already sorted pixels, instead of concat and sort the pixel dataframes.
+
     Parameters
     ----------
     cell_urls :
@@ -27,6 +34,11 @@ def _chrom_sum_iterator(cell_urls,
         Dictionary of chromosome offsets.
     add_trans :
         If true, will also iterate all the trans combinations (different chromosomes).
+    n_threads :
+        Number of threads to read the cells in parallel.
+    trans_chunk_size :
+        Size of the chrom1 row block in bp when add_trans, limits the memory usage.
+        Rounded down to a whole number of bins (at least one bin).
 
     Yields
     -------
@@ -36,16 +48,7 @@ def _chrom_sum_iterator(cell_urls,
 
     def _iter_1d(_chrom1, _chrom2):
         # sum together multiple chunks
-        # first
-        cell_url = cell_urls[0]
-        matrix = read_single_cool_chrom(cell_url, chrom=_chrom1, chrom2=_chrom2)
-
-        # others
-        if len(cell_urls) > 1:
-            for cell_url in cell_urls[1:]:
-                matrix += read_single_cool_chrom(cell_url, chrom=_chrom1, chrom2=_chrom2)
-
-        matrix = matrix.tocoo()
+        matrix = reader.fetch_sum(_chrom1, _chrom2)
         _pixel_df = pd.DataFrame({
             'bin1_id': matrix.row,
             'bin2_id': matrix.col,
@@ -61,24 +64,46 @@ def _chrom_sum_iterator(cell_urls,
             _pixel_df.iloc[:, 1] += chrom_offset[_chrom2]
         return _pixel_df
 
-    if add_trans:
-        # only iter upper triangle
-        # chrom order by offset, small to large
-        chroms = [k for k, v in sorted(chrom_offset.items(), key=lambda i: i[1])]
-        n_chroms = len(chroms)
-        for a in range(n_chroms):
-            chrom1 = chroms[a]
-            chrom1_dfs = []
-            for b in range(a, n_chroms):
-                chrom2 = chroms[b]
-                pixel_df = _iter_1d(chrom1, chrom2)
-                chrom1_dfs.append(pixel_df)
-            chrom1_df = pd.concat(chrom1_dfs).sort_values(by=['bin1_id', 'bin2_id'])
-            yield chrom1_df
-    else:
-        for chrom in chrom_sizes.keys():
-            pixel_df = _iter_1d(chrom, None)
-            yield pixel_df
+    if add_trans and trans_chunk_size <= 0:
+        raise ValueError(f'trans_chunk_size must be a positive number of bp, got {trans_chunk_size}.')
+
+    with MultiCoolChromReader(cell_urls, n_threads=n_threads) as reader:
+        if add_trans:
+            # only iter upper triangle
+            # chrom order by offset, small to large
+            chroms = [k for k, v in sorted(chrom_offset.items(), key=lambda i: i[1])]
+            n_chroms = len(chroms)
+            resolution = reader.cools[0].binsize
+            # row blocks are cut on whole bins, so no boundary bin is shared by two blocks
+            chunk_bins = max(1, trans_chunk_size // resolution)
+            for a in range(n_chroms):
+                chrom1 = chroms[a]
+                chrom1_size = chrom_sizes[chrom1]
+                for row_offset in range(0, (chrom1_size + resolution - 1) // resolution, chunk_bins):
+                    start = row_offset * resolution
+                    end = min(start + chunk_bins * resolution, chrom1_size)
+                    blocks = []
+                    for b in range(a, n_chroms):
+                        chrom2 = chroms[b]
+                        # cis block only keep upper triangle, in global coords col >= row + row_offset
+                        triu_k = row_offset if chrom2 == chrom1 else None
+                        matrix = reader.fetch_sum_region((chrom1, start, end), chrom2, triu_k=triu_k)
+                        blocks.append(matrix.tocsr())
+                    # chrom2 blocks are contiguous in bin order,
+                    # so the stacked csr is sorted by bin1 then bin2
+                    matrix = hstack(blocks, format='csr')
+                    matrix.sort_indices()
+                    matrix = matrix.tocoo()
+                    pixel_df = pd.DataFrame({
+                        'bin1_id': matrix.row + chrom_offset[chrom1] + row_offset,
+                        'bin2_id': matrix.col + chrom_offset[chrom1],
+                        'count': matrix.data
+                    })
+                    yield pixel_df
+        else:
+            for chrom in chrom_sizes.keys():
+                pixel_df = _iter_1d(chrom, None)
+                yield pixel_df
 
 
 def _save_single_matrix_type(cooler_path,
@@ -86,7 +111,8 @@ def _save_single_matrix_type(cooler_path,
                              cell_urls,
                              chrom_sizes,
                              chrom_offset,
-                             add_trans=False):
+                             add_trans=False,
+                             n_threads=1):
     """
     Save a single matrix type Cool file from merging multiple cell urls.
 
@@ -104,11 +130,14 @@ def _save_single_matrix_type(cooler_path,
         Dictionary of chromosome offsets.
     add_trans :
         Whether add trans matrix also.
+    n_threads :
+        Number of threads to read the cells in parallel.
     """
     chrom_iter = _chrom_sum_iterator(cell_urls,
                                      chrom_sizes,
                                      chrom_offset,
-                                     add_trans=add_trans)
+                                     add_trans=add_trans,
+                                     n_threads=n_threads)
     cooler.create_cooler(cool_uri=cooler_path,
                          bins=bins_df,
                          pixels=chrom_iter,
@@ -146,7 +175,7 @@ def make_raw_matrix_cell_table(cell_table, resolution_str='10K'):
 
 
 def merge_raw_scool_by_cluster(chrom_size_path, resolution, cell_table_path,
-                               output_dir, add_trans=False, cpu=1):
+                               output_dir, add_trans=False, cpu=1, n_threads=1):
     """
     Sum the raw matrix of cells, no normalization.
 
@@ -168,6 +197,8 @@ def merge_raw_scool_by_cluster(chrom_size_path, resolution, cell_table_path,
         Whether add trans matrix also.
     cpu :
         Number of CPUs to use.
+    n_threads :
+        Number of threads to read the cells of each group in parallel.
 
     """
     # determine chunk dirs for the group:
@@ -199,7 +230,8 @@ def merge_raw_scool_by_cluster(chrom_size_path, resolution, cell_table_path,
                                 cell_urls=cell_urls,
                                 chrom_sizes=chrom_sizes,
                                 chrom_offset=chrom_offset,
-                                add_trans=add_trans)
+                                add_trans=add_trans,
+                                n_threads=n_threads)
             futures[future] = cell_group
         for future in as_completed(futures):
             cell_group = futures[future]
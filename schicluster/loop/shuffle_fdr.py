@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 from scipy.sparse import load_npz, csr_matrix, save_npz, triu
 from scipy.stats import rankdata
+from .loop_store import save_loop_table, read_loop_table
 
 
 def _t_score(T, T2, tot):
@@ -113,8 +114,13 @@ def update_fdr_qval(chrom_size_path,
                                     sep='\t',
                                     index_col=0,
                                     header=None).squeeze(axis=1)
-    data: pd.DataFrame = pd.read_hdf(f'{real_group_prefix}.totalloop_info.hdf',
-                                     key='data')
+    # only read the chunks with bkfilter candidates in the distance range,
+    # the table only has the candidates kept by the call_loops pre-filter,
+    # so the shuffle FDR loops use the same pre-filter as the real loops
+    data: pd.DataFrame = read_loop_table(f'{real_group_prefix}.totalloop_info.zarr',
+                                         filters=[('bkfilter', '==', True),
+                                                  ('distance', '>=', (min_dist + 1) * res),
+                                                  ('distance', '<', max_dist * res)])
     data['global_qval'] = 1
     data['local_qval'] = 1
     data = data.loc[((data['distance'] // res) > min_dist)
@@ -129,7 +135,5 @@ def update_fdr_qval(chrom_size_path,
         tmp = load_npz(f'{shuffle_group_prefix}_{chrom}.permutefdrglobal.npz')
         data.loc[tmpfilter, 'global_qval'] = tmp[coord].A.ravel()
 
-    data.to_hdf(f'{real_group_prefix}.totalloop_info.hdf',
-                key='data',
-                format='table')
+    save_loop_table(data, f'{real_group_prefix}.totalloop_info.zarr')
     return data
@@ -62,7 +62,10 @@ def prepare_loop_snakemake(cell_table_path,
                            log_e=True,
                            shuffle=False,
                            raw_resolution_str=None,
-                           downsample_shuffle=None):
+                           downsample_shuffle=None,
+                           min_e_zscore=None,
+                           top_frac=None,
+                           local_max_pad=None):
     _cell_table_path = str(cell_table_path)
     sep = '\t' if _cell_table_path.endswith('tsv') else ','
     cell_table = pd.read_csv(cell_table_path, index_col=0, sep=sep, header=None,
@@ -136,12 +139,21 @@ def prepare_loop_snakemake(cell_table_path,
             cmd = f'snakemake -d {chunk_dir} --snakefile {chunk_dir}/Snakefile -j {cpu_per_job} --scheduler greedy'
             f.write(cmd + '\n')
 
+    # loop candidate pre-filter options of hic-internal call-loop
+    prefilter_str = ''
+    for name, value in [('min_e_zscore', min_e_zscore),
+                        ('top_frac', top_frac),
+                        ('local_max_pad', local_max_pad)]:
+        if value is not None:
+            prefilter_str += f' --{name} {value}'
+
     # prepare the second step that merge cell chunks into groups
     scool_parameters = dict(
         output_dir=f'"{output_dir}"',
         chrom_size_path=f'"{chrom_size_path}"',
         resolution=resolution,
-        shuffle=shuffle
+        shuffle=shuffle,
+        prefilter_str=f'"{prefilter_str}"'
     )
     parameters_str = '\n'.join(f'{k} = {v}'
                                for k, v in scool_parameters.items())
@@ -203,6 +215,9 @@ def call_loop(cell_table_path,
               fdr_thres=0.1,
               dist_thres=20000,
               size_thres=1,
+              min_e_zscore=None,
+              top_frac=None,
+              local_max_pad=None,
               cleanup=True):
     if shuffle and (black_list_path is None):
         raise ValueError('Please provide black_list_path when shuffle=True')
@@ -316,6 +331,9 @@ def merge_loop(group,
                fdr_thres=0.1,
                dist_thres=20000,
                size_thres=1,
+               min_e_zscore=None,
+               top_frac=None,
+               local_max_pad=None,
                cleanup=True):
 
     group_list = pd.read_csv(f'{output_dir}/group_list.txt', header=None, index_col=None)[0].values
@@ -341,6 +359,7 @@ def merge_loop(group,
 
     _merge_kwargs = {k: v for k, v in kwargs.items() if k in inspect.signature(merge_group_to_bigger_group_cools).parameters}
     _merge_kwargs['shuffle'] = False
+    _merge_kwargs['cpu'] = cpu_per_job
 #     print(_merge_kwargs)
     merge_group_to_bigger_group_cools(**_merge_kwargs)
     
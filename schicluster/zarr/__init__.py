@@ -1 +1,2 @@
-from .cool_ds import CoolDSSingleMatrixWriter, generate_cool_ds
+from .cool_ds import CoolDSSingleMatrixWriter, generate_cool_ds, load_chunk_occupancy, \
+    band_to_bin2, read_band_matrix, write_cool_ds_matrices, ChunkCache, CoolDS
@@ -1,5 +1,7 @@
+import os
 import pathlib
-import shutil
+import threading
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import cooler
@@ -7,13 +9,438 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import zarr
-from cooler.util import read_chromsizes, binnify
+from cooler.util import read_chromsizes, binnify, parse_region_string
 from numcodecs import Blosc
 
-SMALL_SAMPLE_CHUNK = 1
 COMPRESSOR_C_LEVEL = 3
 
 
+def _cool_chrom_extents(h5):
+    """Bin extent of each chrom in an opened cool."""
+    names = h5['chroms/name'][:].astype(str)
+    chrom_offset = h5['indexes/chrom_offset'][:]
+    return {name: (chrom_offset[i], chrom_offset[i + 1]) for i, name in enumerate(names)}
+
+
+def _cool_chunk_occupancy(cool_path, pairs, bin_chunk_size, n_diags):
+    """
+    Get the (bin1 chunk, bin2 chunk) pairs holding any pixel for each chrom1-by-chrom2 matrix.
+
+    Only the bin1 offset index and the bin2_id column of the cool pixel table are read,
+    the pixels of each row chrom are read once and shared by all the pairs with that chrom.
+    If n_diag of a pair is not None, the second chunk index is the diagonal chunk of the cis band layout.
+
+    Returns
+    -------
+    List of (chunk_pairs, row_chrom) for each pair,
+    row_chrom is the chrom stored as the row of the pair's pixels in the cool.
+    """
+    cool = cooler.Cooler(cool_path)
+    results = [None] * len(pairs)
+    with cool.open('r') as h5:
+        extents = _cool_chrom_extents(h5)
+        # cooler only stores the upper triangle in the genome-wide bin order,
+        # if chrom2 is before chrom1, the pixels are stored with chrom2 as the row
+        row_groups = {}
+        for pair_idx, (chrom1, chrom2) in enumerate(pairs):
+            swap = extents[chrom2][0] < extents[chrom1][0]
+            row_chrom = chrom2 if swap else chrom1
+            row_groups.setdefault(row_chrom, []).append((pair_idx, swap))
+
+        for row_chrom, row_pairs in row_groups.items():
+            row_start, row_end = extents[row_chrom]
+            bin1_offset = h5['indexes/bin1_offset'][row_start:row_end + 1]
+            bin2_ids = h5['pixels/bin2_id'][bin1_offset[0]:bin1_offset[-1]]
+            bin1_ids = np.repeat(np.arange(row_start, row_end), np.diff(bin1_offset))
+            for pair_idx, swap in row_pairs:
+                chrom1, chrom2 = pairs[pair_idx]
+                col_start, col_end = extents[chrom1] if swap else extents[chrom2]
+                judge = (bin2_ids >= col_start) & (bin2_ids < col_end)
+                rows = bin1_ids[judge] - row_start
+                cols = bin2_ids[judge] - col_start
+                if swap:
+                    rows, cols = cols, rows
+                n_diag = n_diags[pair_idx]
+                if n_diag is not None:
+                    # cis band layout, bin2 becomes the diagonal offset
+                    cols = cols - rows
+                    judge = cols < n_diag
+                    rows, cols = rows[judge], cols[judge]
+                rows = rows // bin_chunk_size
+                cols = cols // bin_chunk_size
+                chunk_pairs = np.unique(np.stack([rows, cols], axis=1), axis=0)
+                results[pair_idx] = (chunk_pairs, row_chrom)
+    return results
+
+
+def _save_row_band_worker(cool_paths,
+                          row_chrom,
+                          bin_start,
+                          bin_end,
+                          targets,
+                          sample_start,
+                          value_idx,
+                          bin_chunk_size,
+                          data_dtype):
+    """
+    Read the stored pixels of one row chrom bin chunk once per sample, and fan them out to the matrices.
+
+    Parameters
+    ----------
+    cool_paths :
+        Cool paths of the samples in this sample range.
+    row_chrom :
+        Chrom of the rows.
+    bin_start, bin_end :
+        Row bin range inside row_chrom, one bin chunk.
+    targets :
+        List of (zarr_path, chrom1, chrom2, dim1_size, dim2_size, n_diag) of the matrices
+        with row_chrom as chrom1 or chrom2.
+    sample_start :
+        Sample index of the first cool in the zarr.
+    value_idx :
+        Value type index in the zarr.
+    bin_chunk_size :
+        Chunk size of the bin dimensions.
+    data_dtype :
+        Data type of the matrix.
+    """
+    # cooler only stores the upper triangle, the pixels with bin1 in the row chunk
+    # hold the row chunk of chrom pairs stored with row_chrom as row,
+    # and the column chunk of the chrom pairs stored with row_chrom as column,
+    # so the zarr chunks touched by this task are never touched by other tasks.
+    target_pixels = [[] for _ in targets]
+    for sample_idx, cool_path in enumerate(cool_paths):
+        cool = cooler.Cooler(cool_path)
+        with cool.open('r') as h5:
+            extents = _cool_chrom_extents(h5)
+            row_offset = extents[row_chrom][0]
+            bin1_offset = h5['indexes/bin1_offset'][row_offset + bin_start:row_offset + bin_end + 1]
+            pixel_slice = slice(bin1_offset[0], bin1_offset[-1])
+            rows = h5['pixels/bin1_id'][pixel_slice] - row_offset
+            bin2_ids = h5['pixels/bin2_id'][pixel_slice]
+            values = h5['pixels/count'][pixel_slice]
+
+        for target_idx, (_, chrom1, chrom2, _, _, n_diag) in enumerate(targets):
+            transpose = chrom1 != row_chrom
+            col_start, col_end = extents[chrom1] if transpose else extents[chrom2]
+            judge = (bin2_ids >= col_start) & (bin2_ids < col_end)
+            dim1 = rows[judge]
+            dim2 = bin2_ids[judge] - col_start
+            data = values[judge]
+            if transpose:
+                dim1, dim2 = dim2, dim1
+            if n_diag is not None:
+                # cis band layout, bin2 becomes the diagonal offset
+                dim2 = dim2 - dim1
+                judge = dim2 < n_diag
+                dim1, dim2, data = dim1[judge], dim2[judge], data[judge]
+            target_pixels[target_idx].append((dim1, dim2, np.full(dim1.size, sample_idx), data))
+
+    # route pixels to the (bin1, bin2, sample) chunks through an in-memory chunk buffer
+    n_sample = len(cool_paths)
+    n_chunks = 0
+    for (zarr_path, _, _, dim1_size, dim2_size, _), pixels in zip(targets, target_pixels):
+        dim1, dim2, samples, data = [np.concatenate(arrays) for arrays in zip(*pixels)]
+        if dim1.size == 0:
+            continue
+        n_dim2_chunks = (dim2_size + bin_chunk_size - 1) // bin_chunk_size
+        chunk_keys = (dim1 // bin_chunk_size) * n_dim2_chunks + dim2 // bin_chunk_size
+        order = np.argsort(chunk_keys, kind='stable')
+        chunk_keys = chunk_keys[order]
+        chunk_ids, chunk_starts = np.unique(chunk_keys, return_index=True)
+        chunk_ends = np.append(chunk_starts[1:], chunk_keys.size)
+
+        zarr_da = zarr.open(zarr_path, mode='r+')
+        for chunk_id, start, end in zip(chunk_ids, chunk_starts, chunk_ends):
+            idx = order[start:end]
+            dim1_start = chunk_id // n_dim2_chunks * bin_chunk_size
+            dim2_start = chunk_id % n_dim2_chunks * bin_chunk_size
+            dim1_end = min(dim1_start + bin_chunk_size, dim1_size)
+            dim2_end = min(dim2_start + bin_chunk_size, dim2_size)
+            buffer = np.zeros((dim1_end - dim1_start, dim2_end - dim2_start, n_sample), dtype=data_dtype)
+            buffer[dim1[idx] - dim1_start, dim2[idx] - dim2_start, samples[idx]] = data[idx]
+            # flush the full chunk to the final array
+            zarr_da[dim1_start:dim1_end, dim2_start:dim2_end, sample_start:sample_start + n_sample, value_idx] = buffer
+        n_chunks += chunk_ids.size
+    return n_chunks
+
+
+def write_cool_ds_matrices(writers, cpu=1):
+    """
+    Write many CoolDS matrices with one shared process pool.
+
+    All the matrices are planned up front, each sample cool is opened once per task
+    and its pixels are fanned out to all the matrices sharing the same samples and chunk grid.
+
+    Parameters
+    ----------
+    writers :
+        List of CoolDSSingleMatrixWriter created with execute=False.
+    cpu :
+        Number of CPUs to use.
+    """
+    # config blosc compressor when run multi-processing
+    # see zarr doc here: https://zarr.readthedocs.io/en/stable/tutorial.html#configuring-blosc
+    if cpu > 1:
+        from numcodecs import blosc
+        blosc.use_threads = False
+
+    _writers = []
+    for writer in writers:
+        if writer.append and writer.n_sample == writer.sample_offset:
+            print(f'No new samples to append to {writer.path}.')
+        else:
+            _writers.append(writer)
+    writers = _writers
+
+    # writers sharing the same samples and chunk grid are written by the same tasks
+    groups = {}
+    for writer in writers:
+        key = (writer.sample_offset, writer.bin_chunk_size, writer.sample_chunk_size,
+               tuple((cool_type, value_type, tuple(table[value_type].tolist()))
+                     for cool_type, table in writer.cool_tables.items()
+                     for value_type in writer.value_types[cool_type]))
+        groups.setdefault(key, []).append(writer)
+    groups = list(groups.values())
+
+    with ProcessPoolExecutor(cpu) as executor:
+        # get chunk occupancy from the sparse inputs before any matrix is loaded
+        futures = {}
+        for group_idx, group in enumerate(groups):
+            first = group[0]
+            pairs = [(writer.chrom1, writer.chrom2) for writer in group]
+            n_diags = [writer.n_diag for writer in group]
+            for cool_type, cool_table in first.cool_tables.items():
+                for value_idx, value_type in enumerate(first.value_types[cool_type]):
+                    for sample_idx, cool_path in enumerate(cool_table[value_type]):
+                        future = executor.submit(_cool_chunk_occupancy,
+                                                 cool_path=cool_path,
+                                                 pairs=pairs,
+                                                 bin_chunk_size=first.bin_chunk_size,
+                                                 n_diags=n_diags)
+                        sample_chunk = (first.sample_offset + sample_idx) // first.sample_chunk_size
+                        futures[future] = (group_idx, cool_type, value_idx, sample_chunk)
+
+        records = [{cool_type: [np.zeros((0, 4), dtype=int)] for cool_type in writer.cool_tables.keys()}
+                   for group in groups for writer in group]
+        writer_idx_offset = np.cumsum([0] + [len(group) for group in groups])
+        # (group, cool type, value type, sample chunk) -> set of (row chrom, row chunk) having pixels
+        row_chunks = {}
+        for future in as_completed(futures):
+            group_idx, cool_type, value_idx, sample_chunk = futures[future]
+            results = future.result()
+            task_row_chunks = row_chunks.setdefault((group_idx, cool_type, value_idx, sample_chunk), set())
+            for writer_idx, (writer, (chunk_pairs, row_chrom)) in enumerate(zip(groups[group_idx], results)):
+                records[writer_idx_offset[group_idx] + writer_idx][cool_type].append(
+                    np.column_stack([chunk_pairs,
+                                     np.full(chunk_pairs.shape[0], sample_chunk),
+                                     np.full(chunk_pairs.shape[0], value_idx)]))
+                row_chunk_col = 0 if row_chrom == writer.chrom1 else 1
+                task_row_chunks.update((row_chrom, chunk) for chunk in np.unique(chunk_pairs[:, row_chunk_col]))
+
+        for writer_idx, writer in enumerate([writer for group in groups for writer in group]):
+            writer.occupancy = {cool_type: np.unique(np.concatenate(chunks).astype(int), axis=0)
+                                for cool_type, chunks in records[writer_idx].items()}
+            writer._init_zarr()
+
+        # read sparse pixels of each sample once and write them to the final zarr chunks directly,
+        # each task handles one occupied row chunk of one sample range, empty chunks are never written
+        futures = {}
+        for group_idx, group in enumerate(groups):
+            first = group[0]
+            sample_ranges = {start // first.sample_chunk_size: (start, end) for start, end in first._sample_ranges()}
+            row_n_bins = {}
+            for writer in group:
+                row_n_bins[writer.chrom1] = writer.chrom1_n_bins
+                row_n_bins[writer.chrom2] = writer.chrom2_n_bins
+            for (_group_idx, cool_type, value_idx, sample_chunk), task_row_chunks in row_chunks.items():
+                if _group_idx != group_idx:
+                    continue
+                sample_start, sample_end = sample_ranges[sample_chunk]
+                value_type = first.value_types[cool_type][value_idx]
+                cool_paths = first.cool_tables[cool_type][value_type].iloc[
+                             sample_start - first.sample_offset:sample_end - first.sample_offset].tolist()
+                for row_chrom, row_chunk in sorted(task_row_chunks):
+                    bin_start = int(row_chunk) * first.bin_chunk_size
+                    bin_end = min(bin_start + first.bin_chunk_size, row_n_bins[row_chrom])
+                    targets = [(f'{writer.path}/{cool_type}',
+                                writer.chrom1,
+                                writer.chrom2,
+                                writer.chrom1_n_bins,
+                                writer.chrom2_n_bins if writer.n_diag is None else writer.n_diag,
+                                writer.n_diag)
+                               for writer in group if row_chrom in (writer.chrom1, writer.chrom2)]
+                    future = executor.submit(_save_row_band_worker,
+                                             cool_paths=cool_paths,
+                                             row_chrom=row_chrom,
+                                             bin_start=bin_start,
+                                             bin_end=bin_end,
+                                             targets=targets,
+                                             sample_start=sample_start,
+                                             value_idx=value_idx,
+                                             bin_chunk_size=first.bin_chunk_size,
+                                             data_dtype=first.data_dtype)
+                    futures[future] = (cool_type, value_type, row_chrom, bin_start, sample_start, sample_end)
+
+        for future in as_completed(futures):
+            cool_type, value_type, row_chrom, bin_start, sample_start, sample_end = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Got error when saving {cool_type} {value_type} '
+                      f'{row_chrom} bin {bin_start} to {bin_start + groups[0][0].bin_chunk_size} '
+                      f'sample_id {sample_start} to {sample_end}')
+                raise e
+
+    for writer in writers:
+        if writer.append:
+            writer._commit_append()
+        # touch success file
+        final_success_flag = writer.log_dir_path / "_WRITE_SUCCESS"
+        final_success_flag.touch()
+    return
+
+
+def load_chunk_occupancy(zarr_path, cool_type):
+    """
+    Load the chunk occupancy index of a CoolDS matrix.
+
+    Parameters
+    ----------
+    zarr_path :
+        Path to the CoolDS single matrix zarr, e.g. "{output_dir}/chr1".
+    cool_type :
+        Cool type (data array name) in the zarr.
+
+    Returns
+    -------
+    Boolean array with shape (bin1 chunks, bin2 chunks, sample chunks, value types),
+    True if the chunk holds any nonzero pixel, False chunks are absent in the zarr.
+    If the zarr has no occupancy index, all chunks are True.
+    """
+    z = zarr.open(str(zarr_path), mode='r')[cool_type]
+    if 'occupancy' not in z.attrs:
+        return np.ones(z.cdata_shape, dtype=bool)
+    occupancy = np.zeros(z.cdata_shape, dtype=bool)
+    chunks = np.array(z.attrs.get('occupancy', []), dtype=int).reshape(-1, 4)
+    occupancy[chunks[:, 0], chunks[:, 1], chunks[:, 2], chunks[:, 3]] = True
+    return occupancy
+
+
+def consolidate_metadata_atomic(path):
+    """
+    Consolidate zarr metadata of path, the new metadata is written to a temp key first
+    and then replaces ".zmetadata", so readers never see a partially written metadata file.
+    """
+    path = pathlib.Path(path)
+    tmp_key = f'.zmetadata.{os.getpid()}.tmp'
+    zarr.consolidate_metadata(zarr.DirectoryStore(str(path)), metadata_key=tmp_key)
+    os.replace(path / tmp_key, path / '.zmetadata')
+    return
+
+
+def band_diag_range(bin1_start, bin1_end, bin2_start, bin2_end, n_diag):
+    """Diagonal range [start, end) of the band layout covering the bin1-by-bin2 region."""
+    diag_start = min(max(0, bin2_start - bin1_end + 1), n_diag)
+    diag_end = max(min(n_diag, bin2_end - bin1_start), diag_start)
+    return diag_start, diag_end
+
+
+def band_to_bin2(band, bin1_start, bin2_start, bin2_end, diag_start=0):
+    """
+    Convert band layout values to bin1-by-bin2 coordinates.
+
+    Parameters
+    ----------
+    band :
+        Array with bin1 and diag as the first two dimensions,
+        value at [i, k] is the contact between bin1_start + i and bin1_start + i + diag_start + k.
+    bin1_start :
+        Bin1 index of the first row in band.
+    bin2_start :
+        Start bin2 index of the output.
+    bin2_end :
+        End bin2 index of the output.
+    diag_start :
+        Diagonal offset of the first column in band.
+
+    Returns
+    -------
+    Array with shape (bin1, bin2, *band.shape[2:]),
+    only the upper triangle within the band is filled, the rest is zero.
+    """
+    n_bin1, n_diag = band.shape[:2]
+    matrix = np.zeros((n_bin1, bin2_end - bin2_start) + band.shape[2:], dtype=band.dtype)
+    rows, diags = np.meshgrid(np.arange(n_bin1), np.arange(n_diag), indexing='ij')
+    bin2 = bin1_start + rows + diag_start + diags
+    judge = (bin2 >= bin2_start) & (bin2 < bin2_end)
+    matrix[rows[judge], bin2[judge] - bin2_start] = band[rows[judge], diags[judge]]
+    return matrix
+
+
+def read_band_matrix(zarr_path, cool_type, bin1_start, bin1_end, bin2_start, bin2_end):
+    """
+    Read a bin1-by-bin2 region from a band layout CoolDS matrix.
+
+    Parameters
+    ----------
+    zarr_path :
+        Path to the CoolDS single matrix zarr saved with max_distance, e.g. "{output_dir}/chr1".
+    cool_type :
+        Cool type (data array name) in the zarr.
+    bin1_start, bin1_end, bin2_start, bin2_end :
+        Region in chromosome bin index.
+
+    Returns
+    -------
+    Array with shape (bin1, bin2, sample_id, value_type).
+    """
+    z = zarr.open(str(zarr_path), mode='r')[cool_type]
+    if z.attrs.get('layout') != 'band':
+        raise ValueError(f'{zarr_path}/{cool_type} is not saved in band layout.')
+    n_diag = z.attrs['n_diag']
+    # cis matrix, bin1 and bin2 have the same size
+    bin1_end = min(bin1_end, z.shape[0])
+    bin2_end = min(bin2_end, z.shape[0])
+    diag_start, diag_end = band_diag_range(bin1_start, bin1_end, bin2_start, bin2_end, n_diag)
+    band = z[bin1_start:bin1_end, diag_start:diag_end]
+    return band_to_bin2(band, bin1_start, bin2_start, bin2_end, diag_start=diag_start)
+
+
+def _clear_uncommitted_samples(z, n_committed):
+    """
+    Remove the values of the samples after n_committed in the data array z,
+    which are left by an interrupted append, and shrink the sample dimension to n_committed.
+
+    Chunks only holding removed samples are deleted, chunks shared with committed samples
+    are zeroed after n_committed, so they do not reappear when the sample dimension grows again.
+    """
+    if z.shape[2] <= n_committed:
+        return
+    bin1_chunk, bin2_chunk, sample_chunk, _ = z.chunks
+    first_chunk = n_committed // sample_chunk
+    for key in zarr.storage.listdir(z.store, z.path):
+        if key.startswith('.'):
+            continue
+        i, j, k, v = map(int, key.split('.'))
+        if k < first_chunk:
+            continue
+        if k * sample_chunk >= n_committed:
+            del z.store[f'{z.path}/{key}']
+        else:
+            z[i * bin1_chunk:(i + 1) * bin1_chunk,
+              j * bin2_chunk:(j + 1) * bin2_chunk,
+              n_committed:(k + 1) * sample_chunk,
+              v] = 0
+    if 'occupancy' in z.attrs:
+        occupancy = np.array(z.attrs['occupancy'], dtype=int).reshape(-1, 4)
+        occupancy = occupancy[occupancy[:, 2] * sample_chunk < n_committed]
+        z.attrs['occupancy'] = occupancy.tolist()
+    z.resize(z.shape[0], z.shape[1], n_committed, z.shape[3])
+    return
+
+
 class CoolDSSingleMatrixWriter:
     def __init__(self,
                  path,
@@ -27,7 +454,9 @@ class CoolDSSingleMatrixWriter:
                  bin_chunk_size=510,
                  sample_chunk_size=50,
                  data_dtype='float32',
-                 cpu=1):
+                 max_distance=None,
+                 cpu=1,
+                 execute=True):
         """
         Write a single chrom1-by-chrom2 matrix to CoolDS zarr.
 
@@ -36,17 +465,20 @@ class CoolDSSingleMatrixWriter:
         path :
             Path to the zarr dir.
         cool_table_path :
-            Path to the cool table with four columns: sample, value_type, path, cool_type
+            Path to the cool table with four columns: sample, value_type, path, cool_type,
+            or the cool table dataframe already read.
         value_types :
             Dict of cool types and their value types.
         chrom_sizes_path :
-            Path to the chrom sizes file.
+            Path to the chrom sizes file, or the chrom sizes series already read.
         chrom1 :
             Chrom1 name.
         chrom2 :
             Chrom2 name. If None, chrom1 will be used.
         mode :
-            Mode to open the zarr.
+            Mode to open the zarr. If "a" and the zarr already exists, append the samples not in the zarr:
+            the sample dimension is resized and only the chunks of new samples are written,
+            chunk sizes and layout are taken from the existing zarr.
         cooler_bin_size :
             Cooler bin size.
         bin_chunk_size :
@@ -55,16 +487,27 @@ class CoolDSSingleMatrixWriter:
             Chunk size of the sample dimension.
         data_dtype :
             Data type of the matrix.
+        max_distance :
+            If provided, cis matrix is saved in the band layout with dims (bin1, diag, sample_id, value_type),
+            only the diagonals with distance <= max_distance are saved.
+            Use band_to_bin2 or read_band_matrix to convert back to bin1-by-bin2 coordinates.
         cpu :
             Number of CPUs to use.
+        execute :
+            Whether to write the matrix now. If False, only the writer is planned,
+            write many planned writers together with write_cool_ds_matrices.
         """
         self.path = path
         self.root = zarr.open(path, mode=mode)
         self.log_dir_path = None
+        self.occupancy = None
         self.mode = mode
         self.value_types = value_types
         self.cool_tables, self.sample_ids = self._read_cool_table(cool_table_path)
         self.n_sample = self.sample_ids.size
+        # samples before sample_offset already exist in the zarr, only used in append mode
+        self.sample_offset = 0
+        self.append = mode == 'a' and 'sample_id' in self.root
         self.n_cpu = cpu
 
         self.bin_chunk_size = bin_chunk_size
@@ -87,14 +530,28 @@ class CoolDSSingleMatrixWriter:
         self.chrom1_n_bins = self.chrom1_bins.shape[0]
         self.chrom2_n_bins = self.chrom2_bins.shape[0]
 
-        self.execute()
+        # band layout for cis matrix
+        self.max_distance = max_distance
+        if max_distance is not None and self.chrom1 == self.chrom2:
+            self.n_diag = min(int(max_distance) // self.cooler_bin_size + 1, self.chrom1_n_bins)
+        else:
+            self.n_diag = None
+
+        if self.append:
+            self._read_existing_zarr()
+
+        if execute:
+            self.execute()
 
     def _read_cool_table(self, cool_table_path):
         value_types = self.value_types
         # get cool tables for each cool type
-        cool_paths = pd.read_csv(cool_table_path,
-                                 header=None,
-                                 names=['sample', 'value_type', 'path', 'cool_type'])
+        if isinstance(cool_table_path, pd.DataFrame):
+            cool_paths = cool_table_path
+        else:
+            cool_paths = pd.read_csv(cool_table_path,
+                                     header=None,
+                                     names=['sample', 'value_type', 'path', 'cool_type'])
 
         _cool_tables = {}
         sample_ids = []
@@ -123,11 +580,50 @@ class CoolDSSingleMatrixWriter:
 
     def _read_chrom_info(self, chrom_sizes_path):
         # chrom length and bins info
-        chrom_sizes = read_chromsizes(chrom_sizes_path)
+        if isinstance(chrom_sizes_path, pd.Series):
+            chrom_sizes = chrom_sizes_path
+        else:
+            chrom_sizes = read_chromsizes(chrom_sizes_path)
         chrom_bins = binnify(chrom_sizes, self.cooler_bin_size)
         n_bins = chrom_bins.shape[0]
         return chrom_sizes, chrom_bins, n_bins
 
+    def _read_existing_zarr(self):
+        """Read the existing zarr in append mode, keep only the new samples in the cool tables."""
+        attrs = self.root.attrs
+        assert attrs['chrom1'] == self.chrom1 and attrs['chrom2'] == self.chrom2, \
+            f'Existing zarr {self.path} is {attrs["chrom1"]}-{attrs["chrom2"]} matrix.'
+        assert attrs['cooler_bin_size'] == self.cooler_bin_size, \
+            f'Existing zarr {self.path} has different cooler_bin_size {attrs["cooler_bin_size"]}.'
+        for cool_type, value_type_list in self.value_types.items():
+            existing_value_types = self.root[f"{cool_type}_value_type"][:].tolist()
+            assert existing_value_types == list(value_type_list), \
+                f'{cool_type} value types {value_type_list} differ from existing zarr {existing_value_types}.'
+
+        # chunk grid and layout must follow the existing zarr
+        self.bin_chunk_size = attrs['bin_chunk_size']
+        self.sample_chunk_size = attrs['sample_chunk_size']
+        self.n_diag = attrs.get('n_diag', None)
+
+        existing_sample_ids = pd.Index(self.root['sample_id'][:])
+        new_sample_ids = self.sample_ids[~self.sample_ids.isin(existing_sample_ids)]
+        n_skip = self.sample_ids.size - new_sample_ids.size
+        if n_skip > 0:
+            print(f'{n_skip} samples already exist in {self.path}, skip them.')
+        self.cool_tables = {cool_type: table.loc[new_sample_ids].copy()
+                            for cool_type, table in self.cool_tables.items()}
+        self.sample_offset = existing_sample_ids.size
+        self.sample_ids = existing_sample_ids.append(new_sample_ids)
+        self.n_sample = self.sample_ids.size
+        return
+
+    def _sample_ranges(self):
+        """Sample ranges to write, aligned to the sample chunk grid, starting from sample_offset."""
+        edges = np.concatenate([[self.sample_offset, self.n_sample],
+                                np.arange(0, self.n_sample, self.sample_chunk_size)])
+        edges = np.unique(edges[edges >= self.sample_offset])
+        return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
     def _add_root_attrs(self):
         self.root.attrs['chrom1'] = self.chrom1
         self.root.attrs['chrom2'] = self.chrom2
@@ -138,6 +634,8 @@ class CoolDSSingleMatrixWriter:
         self.root.attrs['cooler_bin_size'] = self.cooler_bin_size
         self.root.attrs['bin_chunk_size'] = self.bin_chunk_size
         self.root.attrs['sample_chunk_size'] = self.sample_chunk_size
+        self.root.attrs['layout'] = 'full' if self.n_diag is None else 'band'
+        self.root.attrs['n_diag'] = self.n_diag
 
     def _init_zarr(self):
         root = zarr.open(self.path, mode=self.mode)
@@ -151,13 +649,17 @@ class CoolDSSingleMatrixWriter:
         if success_flag.exists():
             print("Zarr structure already initiated. Skipping...")
 
+        if self.append:
+            self._resize_zarr(root)
+            return
+
         # create sample_id
         sample_id = root.require_dataset("sample_id",
                                          shape=(self.n_sample,),
                                          chunks=(self.n_sample,),
                                          dtype="<U256")
         sample_id[:] = list(self.sample_ids)
-        sample_id.attrs["_ARRAY_DIMENSIONS"] = "sample_id"
+        sample_id.attrs["_ARRAY_DIMENSIONS"] = ["sample_id"]
 
         # create empty da
         for cool_type, value_type_list in self.value_types.items():
@@ -172,189 +674,77 @@ class CoolDSSingleMatrixWriter:
             value_type_da.attrs["_ARRAY_DIMENSIONS"] = [value_dim]
 
             # data
-            z = root.require_dataset(
-                cool_type,
-                shape=(self.chrom1_n_bins, self.chrom2_n_bins, self.n_sample, n_value_type),
-                chunks=(self.bin_chunk_size, self.bin_chunk_size, self.sample_chunk_size, 1),
-                dtype=self.data_dtype
-            )
-            z.attrs["_ARRAY_DIMENSIONS"] = ["bin1", "bin2", "sample_id", value_dim]
+            if self.n_diag is None:
+                z = root.require_dataset(
+                    cool_type,
+                    shape=(self.chrom1_n_bins, self.chrom2_n_bins, self.n_sample, n_value_type),
+                    chunks=(self.bin_chunk_size, self.bin_chunk_size, self.sample_chunk_size, 1),
+                    dtype=self.data_dtype
+                )
+                z.attrs["_ARRAY_DIMENSIONS"] = ["bin1", "bin2", "sample_id", value_dim]
+                z.attrs["layout"] = "full"
+            else:
+                # band layout, value at [bin1, diag] is the contact between bin1 and bin1 + diag
+                z = root.require_dataset(
+                    cool_type,
+                    shape=(self.chrom1_n_bins, self.n_diag, self.n_sample, n_value_type),
+                    chunks=(self.bin_chunk_size, self.bin_chunk_size, self.sample_chunk_size, 1),
+                    dtype=self.data_dtype
+                )
+                z.attrs["_ARRAY_DIMENSIONS"] = ["bin1", "diag", "sample_id", value_dim]
+                z.attrs["layout"] = "band"
+                z.attrs["n_diag"] = self.n_diag
+            # chunk occupancy index, list of [bin1 chunk, bin2 chunk, sample chunk, value type] holding pixels
+            z.attrs["occupancy"] = self.occupancy[cool_type].tolist()
 
         # add root attrs
         self._add_root_attrs()
 
         # consolidate metadata
-        zarr.consolidate_metadata(self.path)
+        consolidate_metadata_atomic(self.path)
 
         # touch success flag
         success_flag.touch()
         return
 
-    def _save_cool_to_temp_zarr(self, cool_paths, output_path, cool_type, value_type, triu):
-        da_list = []
-        for sample, cool_path in cool_paths.items():
-            cool = cooler.Cooler(cool_path)
-            matrix = cool.matrix(balance=False, sparse=False).fetch(self.chrom1, self.chrom2).astype(self.data_dtype)
-            assert matrix.shape == (self.chrom1_n_bins, self.chrom2_n_bins)
-
-            # keep only the upper triangle of the matrix
-            if triu:
-                matrix = np.triu(matrix)
-
-            # da.dims {'bin1': n_bins, 'bin2': n_bins, 'sample_id': 1, 'value_type': 1}
-            da = xr.DataArray(matrix, dims=['bin1', 'bin2']).chunk({
-                'bin1': self.bin_chunk_size,
-                'bin2': self.bin_chunk_size
-            }).expand_dims(dim={
-                'sample_id': [sample],
-                f'{cool_type}_value_type': [value_type]
-            }).transpose('bin1', 'bin2', 'sample_id', f'{cool_type}_value_type')
-            da_list.append(da)
-        da = xr.concat(da_list, dim='sample_id')
-        ds = xr.Dataset({cool_type: da})
-        ds.to_zarr(output_path, mode='w')
-        return
-
-    def _save_small_sample_chunks(self):
-        with ProcessPoolExecutor(self.n_cpu) as executor:
-            futures = {}
-            for cool_type, cool_table in self.cool_tables.items():
-                for value_type, sample_cool_path in cool_table.items():
-                    for chunk_start in range(0, self.n_sample, SMALL_SAMPLE_CHUNK):
-                        sample_chunk = self.sample_ids[chunk_start:chunk_start + SMALL_SAMPLE_CHUNK]
-                        cool_paths = sample_cool_path.loc[sample_chunk]
-                        output_path = f'{self.chrom1}_{self.chrom2}_{cool_type}_{value_type}_{chunk_start}_temp.zarr'
-                        if self.chrom2 is None or self.chrom1 == self.chrom2:
-                            # save upper triangle only if matrix is cis contacts
-                            triu = True
-                        else:
-                            triu = False
-                        future = executor.submit(self._save_cool_to_temp_zarr,
-                                                 cool_paths=cool_paths,
-                                                 output_path=output_path,
-                                                 cool_type=cool_type,
-                                                 value_type=value_type,
-                                                 triu=triu)
-                        futures[future] = [cool_type, value_type, chunk_start, output_path]
-
-            temp_zarr_records = []
-            for future in as_completed(futures):
-                cool_type, value_type, chunk_start, output_path = futures[future]
-                try:
-                    future.result()
-                except Exception as exc:
-                    print(f"Cool type {cool_type} value_type {value_type} "
-                          f"chunk_start {chunk_start} generated an exception: {exc}")
-                    raise exc
-                else:
-                    temp_zarr_records.append([cool_type, value_type, chunk_start, output_path])
-
-        temp_zarr_records = pd.DataFrame(temp_zarr_records, columns=['cool_type',
-                                                                     'value_type',
-                                                                     'chunk_start',
-                                                                     'output_path'])
-        return temp_zarr_records
-
-    @staticmethod
-    def _save_single_bin_chunk_worker(ds_paths,
-                                      zarr_path,
-                                      cool_type,
-                                      bin1_slice,
-                                      bin2_slice,
-                                      sample_id_slice,
-                                      value_idx):
-        ds = xr.open_mfdataset(ds_paths, concat_dim='sample_id', combine='nested', engine='zarr')
-        zarr_da = zarr.open(zarr_path, mode="r+")
-        # ds only contains one value type
-        _data = ds[cool_type][bin1_slice, bin2_slice, sample_id_slice, 0].load()
-        if (_data != 0).sum() == 0:
-            # TODO this can be improved, as many bins are empty, but _data.load() still takes significant time
-            return
-
-        zarr_da[bin1_slice, bin2_slice, sample_id_slice, value_idx] = _data
-        return
-
-    def _save_single_bin_chunk(self, zarr_path, path_array, cool_type):
-        with ProcessPoolExecutor(self.n_cpu) as executor:
-            futures = {}
-            for value_idx, (_, paths) in enumerate(path_array.items()):
-                ds = xr.open_mfdataset(paths, concat_dim='sample_id', combine='nested', engine='zarr')
-                bin1_idx = ds.get_index('bin1')
-                bin2_idx = ds.get_index('bin2')
-                sample_id_idx = ds.get_index('sample_id')
-                for bin1_start in range(0, bin1_idx.size, self.bin_chunk_size):
-                    for bin2_start in range(0, bin2_idx.size, self.bin_chunk_size):
-                        for sample_id_start in range(0, sample_id_idx.size, self.sample_chunk_size):
-                            bin1_slice = slice(bin1_start, bin1_start + self.bin_chunk_size)
-                            bin2_slice = slice(bin2_start, bin2_start + self.bin_chunk_size)
-                            sample_id_slice = slice(sample_id_start, sample_id_start + self.sample_chunk_size)
-                            future = executor.submit(self._save_single_bin_chunk_worker,
-                                                     ds_paths=paths.tolist(),
-                                                     zarr_path=zarr_path,
-                                                     cool_type=cool_type,
-                                                     bin1_slice=bin1_slice,
-                                                     bin2_slice=bin2_slice,
-                                                     sample_id_slice=sample_id_slice,
-                                                     value_idx=value_idx)
-                            futures[future] = (bin1_start, bin2_start, sample_id_start)
-
-            for future in as_completed(futures):
-                bin1_start, bin2_start, sample_id_start = futures[future]
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f'Got error when saving bin1 {bin1_start} to {bin1_start + self.bin_chunk_size} '
-                          f'bin2 {bin2_start} to {bin2_start + self.bin_chunk_size} '
-                          f'sample_id {sample_id_start} to {sample_id_start + self.sample_chunk_size}')
-                    raise e
-        return
+    def _resize_zarr(self, root):
+        """
+        Resize the sample dimension of the existing data arrays for the new samples.
 
-    def _save_small_sample_chunks_ds_to_final_zarr(self, temp_zarr_records):
-        for cool_type, path_df in temp_zarr_records.groupby('cool_type'):
-            # make sure the temp zarr paths are in the correct order
-            path_array = path_df.pivot(
-                index='chunk_start', columns='value_type', values='output_path'
-            ).sort_index()[self.value_types[cool_type]]
-
-            zarr_path = f'{self.path}/{cool_type}/'
-            self._save_single_bin_chunk(zarr_path=zarr_path,
-                                        path_array=path_array,
-                                        cool_type=cool_type)
+        sample_id is only extended in _commit_append after all the data is written,
+        the values left after the existing samples by an interrupted append are removed first.
+        """
+        for cool_type in self.value_types.keys():
+            z = root[cool_type]
+            _clear_uncommitted_samples(z, self.sample_offset)
+            z.resize(z.shape[0], z.shape[1], self.n_sample, z.shape[3])
         return
 
-    def _write_data(self):
-        # config blosc compressor when run multi-processing
-        # see zarr doc here: https://zarr.readthedocs.io/en/stable/tutorial.html#configuring-blosc
-        if self.n_cpu > 1:
-            from numcodecs import blosc
-            blosc.use_threads = False
-
-        final_success_flag = self.log_dir_path / "_WRITE_SUCCESS"
-        if final_success_flag.exists():
-            print("Data already written. Skipping...")
-
-        # first, convert cool to temp zarr,
-        # where the whole matrix is loaded into memory,
-        # and sample_id chunk size is small (to limit memory usage)
-        temp_zarr_records = self._save_small_sample_chunks()
-
-        # second, write temp zarr to final zarr,
-        # where the matrix is chunked into small chunks (self.bin_chunk_size, to limit memory usage),
-        # and sample_id chunk size is final (self.sample_chunk_size)
-        self._save_small_sample_chunks_ds_to_final_zarr(temp_zarr_records=temp_zarr_records)
-
-        # remove temp zarr files
-        for _, row in temp_zarr_records.iterrows():
-            shutil.rmtree(row['output_path'])
+    def _commit_append(self):
+        """
+        Merge the occupancy index of new samples into the existing zarr attrs, add the new sample ids
+        and consolidate metadata. Called after all the data of the new samples is written,
+        so the samples in sample_id always have complete data.
+        """
+        root = zarr.open(self.path, mode='r+')
+        for cool_type in self.value_types.keys():
+            z = root[cool_type]
+            if 'occupancy' not in z.attrs:
+                # the existing zarr has no occupancy index, keep it unknown
+                continue
+            existing = np.array(z.attrs['occupancy'], dtype=int).reshape(-1, 4)
+            occupancy = np.unique(np.concatenate([existing, self.occupancy[cool_type]]), axis=0)
+            z.attrs["occupancy"] = occupancy.tolist()
 
-        # touch success file
-        final_success_flag.touch()
+        sample_id = root['sample_id']
+        sample_id.resize(self.n_sample)
+        sample_id[self.sample_offset:] = list(self.sample_ids[self.sample_offset:])
+        consolidate_metadata_atomic(self.path)
         return
 
     def execute(self):
         """Execute the pipeline."""
-        self._init_zarr()
-        self._write_data()
+        write_cool_ds_matrices([self], cpu=self.n_cpu)
         return
 
 
@@ -368,6 +758,7 @@ def generate_cool_ds(output_dir,
                      bin_chunk_size=510,
                      sample_chunk_size=50,
                      data_dtype='float32',
+                     max_distance=None,
                      cpu=1):
     """
     Generate a CoolDS zarr dataset from cool files.
@@ -385,7 +776,8 @@ def generate_cool_ds(output_dir,
     trans_matrix :
         Whether generate trans-contacts (chrom1 != chrom2) matrix
     mode :
-        Mode to open the zarr.
+        Mode to open the zarr. Use "a" to append new samples in the cool table to an existing CoolDS,
+        samples already in the CoolDS are skipped.
     cooler_bin_size :
         Cooler bin size.
     bin_chunk_size :
@@ -394,6 +786,9 @@ def generate_cool_ds(output_dir,
         Chunk size of the sample dimension.
     data_dtype :
         Data type of the matrix.
+    max_distance :
+        If provided, cis matrices are saved in the band layout (bin1, diag, sample_id, value_type),
+        only the diagonals with distance <= max_distance are saved. Trans matrices are not affected.
     cpu :
         Number of CPUs to use.
     """
@@ -406,8 +801,14 @@ def generate_cool_ds(output_dir,
     output_dir = pathlib.Path(output_dir).absolute().resolve()
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    # read the cool table and chrom sizes once for all the chrom pairs
     chrom_sizes = read_chromsizes(chrom_sizes_path)
+    cool_table = pd.read_csv(cool_table_path,
+                             header=None,
+                             names=['sample', 'value_type', 'path', 'cool_type'])
 
+    # plan all the chrom pairs up front, then write them with one shared process pool
+    writers = []
     for chrom1 in chrom_sizes.index:
         for chrom2 in chrom_sizes.index:
             if not trans_matrix:
@@ -418,16 +819,302 @@ def generate_cool_ds(output_dir,
             else:
                 path = output_dir / f'{chrom1}-{chrom2}'
 
-            CoolDSSingleMatrixWriter(path,
-                                     cool_table_path=cool_table_path,
-                                     value_types=value_types,
-                                     chrom_sizes_path=chrom_sizes_path,
-                                     chrom1=chrom1,
-                                     chrom2=chrom2,
-                                     mode=mode,
-                                     cooler_bin_size=cooler_bin_size,
-                                     bin_chunk_size=bin_chunk_size,
-                                     sample_chunk_size=sample_chunk_size,
-                                     data_dtype=data_dtype,
-                                     cpu=cpu)
+            writer = CoolDSSingleMatrixWriter(path,
+                                              cool_table_path=cool_table,
+                                              value_types=value_types,
+                                              chrom_sizes_path=chrom_sizes,
+                                              chrom1=chrom1,
+                                              chrom2=chrom2,
+                                              mode=mode,
+                                              cooler_bin_size=cooler_bin_size,
+                                              bin_chunk_size=bin_chunk_size,
+                                              sample_chunk_size=sample_chunk_size,
+                                              data_dtype=data_dtype,
+                                              max_distance=max_distance,
+                                              cpu=cpu,
+                                              execute=False)
+            writers.append(writer)
+    write_cool_ds_matrices(writers, cpu=cpu)
     return
+
+
+class ChunkCache:
+    def __init__(self, max_bytes=1024 ** 3):
+        """
+        Thread-safe LRU cache of decompressed zarr chunks, bounded by the total bytes of cached chunks.
+
+        Parameters
+        ----------
+        max_bytes :
+            Maximum total bytes of cached chunks, least recently used chunks are evicted first.
+        """
+        self.max_bytes = int(max_bytes)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load_func):
+        """Get chunk by key, call load_func() to load the chunk if it is not cached."""
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                self.hits += 1
+                return self._chunks[key]
+            self.misses += 1
+
+        # load outside the lock, so other threads can read cached chunks meanwhile
+        chunk = load_func()
+        # cached chunks are shared, prevent in-place modification by the caller
+        chunk.flags.writeable = False
+        if chunk.nbytes > self.max_bytes:
+            return chunk
+
+        with self._lock:
+            if key not in self._chunks:
+                self._chunks[key] = chunk
+                self.n_bytes += chunk.nbytes
+                while self.n_bytes > self.max_bytes:
+                    _, evicted = self._chunks.popitem(last=False)
+                    self.n_bytes -= evicted.nbytes
+        return chunk
+
+    def clear(self):
+        """Remove all cached chunks and reset metrics."""
+        with self._lock:
+            self._chunks.clear()
+            self.n_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self):
+        """Cache hit/miss metrics."""
+        with self._lock:
+            n_query = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / n_query if n_query > 0 else 0.,
+                    'n_chunks': len(self._chunks),
+                    'n_bytes': self.n_bytes,
+                    'max_bytes': self.max_bytes}
+
+
+class CoolDS:
+    def __init__(self, path, cache=None, cache_bytes=1024 ** 3):
+        """
+        Lazy region and sample query over a CoolDS dataset generated by generate_cool_ds.
+
+        Parameters
+        ----------
+        path :
+            Path to the CoolDS output dir, containing one zarr for each chrom or chrom pair.
+        cache :
+            ChunkCache instance, can be shared by multiple CoolDS and threads.
+            If None, a new cache with cache_bytes is created.
+        cache_bytes :
+            Maximum bytes of the new cache.
+        """
+        self.path = pathlib.Path(path).absolute()
+        self.cache = ChunkCache(cache_bytes) if cache is None else cache
+        self._matrices = {}
+        self._occupancy = {}
+        self._lock = threading.Lock()
+
+    def _open_matrix(self, chrom1, chrom2):
+        key = (chrom1, chrom2)
+        with self._lock:
+            if key not in self._matrices:
+                name = chrom1 if chrom1 == chrom2 else f'{chrom1}-{chrom2}'
+                matrix_path = self.path / name
+                if not matrix_path.exists():
+                    self._matrices[key] = None
+                elif (matrix_path / '.zmetadata').exists():
+                    self._matrices[key] = zarr.open_consolidated(str(matrix_path), mode='r')
+                else:
+                    self._matrices[key] = zarr.open(str(matrix_path), mode='r')
+            return self._matrices[key]
+
+    def _get_occupancy(self, chrom1, chrom2, cool_type):
+        key = (chrom1, chrom2, cool_type)
+        with self._lock:
+            if key not in self._occupancy:
+                name = chrom1 if chrom1 == chrom2 else f'{chrom1}-{chrom2}'
+                self._occupancy[key] = load_chunk_occupancy(self.path / name, cool_type)
+            return self._occupancy[key]
+
+    def _any_matrix(self):
+        for path in sorted(self.path.iterdir()):
+            if (path / '.zattrs').exists() or (path / '.zmetadata').exists():
+                attrs = zarr.open(str(path), mode='r').attrs
+                return self._open_matrix(attrs['chrom1'], attrs['chrom2'])
+        raise FileNotFoundError(f'No CoolDS matrix found in {self.path}')
+
+    @property
+    def sample_ids(self):
+        """Sample ids in the order of the sample_id dimension."""
+        return pd.Index(self._any_matrix()['sample_id'][:])
+
+    def value_types(self, cool_type):
+        """Value types of the cool type."""
+        return pd.Index(self._any_matrix()[f'{cool_type}_value_type'][:])
+
+    @staticmethod
+    def _parse_region(region):
+        if isinstance(region, str):
+            chrom, start, end = parse_region_string(region)
+        else:
+            chrom, start, end = region
+        return chrom, start, end
+
+    def _read_block(self, root, chrom1, chrom2, cool_type, dim1_range, dim2_range, sample_idx, value_idx):
+        """Read [dim1 range, dim2 range, sample_idx, value_idx] of the 4D array through the chunk cache."""
+        z = root[cool_type]
+        occupancy = self._get_occupancy(chrom1, chrom2, cool_type)
+        dim1_chunk, dim2_chunk, sample_chunk, value_chunk = z.chunks
+        start1, end1 = dim1_range
+        start2, end2 = dim2_range
+        block = np.zeros((end1 - start1, end2 - start2, sample_idx.size, value_idx.size), dtype=z.dtype)
+        if block.size == 0:
+            return block
+
+        sample_chunks = sample_idx // sample_chunk
+        value_chunks = value_idx // value_chunk
+        for c1 in range(start1 // dim1_chunk, (end1 - 1) // dim1_chunk + 1):
+            chunk_start1 = c1 * dim1_chunk
+            slice1 = slice(max(start1, chunk_start1) - chunk_start1, min(end1, chunk_start1 + dim1_chunk) - chunk_start1)
+            out1 = slice(max(start1, chunk_start1) - start1, min(end1, chunk_start1 + dim1_chunk) - start1)
+            for c2 in range(start2 // dim2_chunk, (end2 - 1) // dim2_chunk + 1):
+                chunk_start2 = c2 * dim2_chunk
+                slice2 = slice(max(start2, chunk_start2) - chunk_start2,
+                               min(end2, chunk_start2 + dim2_chunk) - chunk_start2)
+                out2 = slice(max(start2, chunk_start2) - start2, min(end2, chunk_start2 + dim2_chunk) - start2)
+                for sc in np.unique(sample_chunks):
+                    sample_out = np.where(sample_chunks == sc)[0]
+                    for vc in np.unique(value_chunks):
+                        if not occupancy[c1, c2, sc, vc]:
+                            # empty chunk, never written
+                            continue
+                        value_out = np.where(value_chunks == vc)[0]
+                        chunk_key = (str(self.path), chrom1, chrom2, cool_type, c1, c2, sc, vc)
+                        chunk = self.cache.get(chunk_key, lambda: np.asarray(z.blocks[c1, c2, sc, vc]))
+                        data = chunk[slice1, slice2][:, :, sample_idx[sample_out] - sc * sample_chunk]
+                        data = data[..., value_idx[value_out] - vc * value_chunk]
+                        block[out1, out2, sample_out[:, None], value_out[None, :]] = data
+        return block
+
+    def _read_stored(self, chrom1, chrom2, cool_type, bin1_range, bin2_range, sample_idx, value_idx):
+        """Read the stored values of the bin1-by-bin2 region, handles band layout and swapped trans pair."""
+        root = self._open_matrix(chrom1, chrom2)
+        if root is None:
+            swapped = self._open_matrix(chrom2, chrom1)
+            if swapped is None:
+                raise KeyError(f'{chrom1}-{chrom2} matrix not found in {self.path}')
+            block = self._read_stored(chrom2, chrom1, cool_type, bin2_range, bin1_range, sample_idx, value_idx)
+            return block.transpose(1, 0, 2, 3)
+
+        z = root[cool_type]
+        if z.attrs.get('layout', 'full') == 'band':
+            diag_start, diag_end = band_diag_range(*bin1_range, *bin2_range, z.attrs['n_diag'])
+            band = self._read_block(root, chrom1, chrom2, cool_type, bin1_range, (diag_start, diag_end),
+                                    sample_idx, value_idx)
+            return band_to_bin2(band, bin1_range[0], *bin2_range, diag_start=diag_start)
+        else:
+            return self._read_block(root, chrom1, chrom2, cool_type, bin1_range, bin2_range,
+                                    sample_idx, value_idx)
+
+    def fetch(self, region1, region2=None, samples=None, value_types=None, cool_type=None, agg=None):
+        """
+        Fetch the matrix of a region pair.
+
+        Parameters
+        ----------
+        region1 :
+            Region string like "chr1:1000000-2000000" or "chr1", or (chrom, start, end) tuple.
+        region2 :
+            Same as region1, if None, use region1.
+        samples :
+            Sample ids to fetch, if None, fetch all samples.
+        value_types :
+            Value types to fetch, a single value type or a list, if None, fetch all value types.
+        cool_type :
+            Cool type (data array name) to fetch, can be omitted if the dataset only has one cool type.
+        agg :
+            Aggregate across samples, "sum" or "mean". If None, return each sample.
+
+        Returns
+        -------
+        DataArray with dims (bin1, bin2, sample_id, value_type), bin1 and bin2 coords are chrom bin index.
+        The sample_id dim is removed if agg is provided.
+        Cis matrices are returned symmetric, although only the upper triangle is stored.
+        """
+        if region2 is None:
+            region2 = region1
+        chrom1, start1, end1 = self._parse_region(region1)
+        chrom2, start2, end2 = self._parse_region(region2)
+        matrix_root = self._open_matrix(chrom1, chrom2)
+        if matrix_root is None:
+            matrix_root = self._open_matrix(chrom2, chrom1)
+            if matrix_root is None:
+                raise KeyError(f'{chrom1}-{chrom2} matrix not found in {self.path}')
+            chrom1_key, chrom2_key = 'chrom2', 'chrom1'
+        else:
+            chrom1_key, chrom2_key = 'chrom1', 'chrom2'
+        bin_size = matrix_root.attrs['cooler_bin_size']
+        chrom1_n_bins = matrix_root.attrs[f'{chrom1_key}_n_bins']
+        chrom2_n_bins = matrix_root.attrs[f'{chrom2_key}_n_bins']
+
+        if cool_type is None:
+            cool_types = [k for k, v in matrix_root.arrays() if v.ndim == 4]
+            if len(cool_types) != 1:
+                raise ValueError(f'Multiple cool types {cool_types} in CoolDS, please provide cool_type.')
+            cool_type = cool_types[0]
+
+        # bin ranges
+        bin1_range = (0 if start1 is None else start1 // bin_size,
+                      chrom1_n_bins if end1 is None else min(-(-end1 // bin_size), chrom1_n_bins))
+        bin2_range = (0 if start2 is None else start2 // bin_size,
+                      chrom2_n_bins if end2 is None else min(-(-end2 // bin_size), chrom2_n_bins))
+
+        # sample and value type index
+        all_samples = pd.Index(matrix_root['sample_id'][:])
+        if samples is None:
+            samples = all_samples
+        else:
+            samples = pd.Index(np.atleast_1d(samples))
+        sample_idx = all_samples.get_indexer(samples)
+        if (sample_idx < 0).any():
+            raise KeyError(f'Samples {samples[sample_idx < 0].tolist()} not in CoolDS')
+        all_value_types = pd.Index(matrix_root[f'{cool_type}_value_type'][:])
+        if value_types is None:
+            value_types = all_value_types
+        else:
+            value_types = pd.Index(np.atleast_1d(value_types))
+        value_idx = all_value_types.get_indexer(value_types)
+        if (value_idx < 0).any():
+            raise KeyError(f'Value types {value_types[value_idx < 0].tolist()} not in {cool_type}')
+
+        data = self._read_stored(chrom1, chrom2, cool_type, bin1_range, bin2_range, sample_idx, value_idx)
+        if chrom1 == chrom2:
+            # only the upper triangle is stored, fill the lower triangle with the transposed region
+            lower = self._read_stored(chrom1, chrom2, cool_type, bin2_range, bin1_range, sample_idx, value_idx)
+            bin1 = np.arange(*bin1_range)[:, None]
+            bin2 = np.arange(*bin2_range)[None, :]
+            lower = lower.transpose(1, 0, 2, 3)
+            data = np.where((bin1 > bin2)[..., None, None], lower, data)
+
+        data = xr.DataArray(data,
+                            dims=['bin1', 'bin2', 'sample_id', 'value_type'],
+                            coords={'bin1': np.arange(*bin1_range),
+                                    'bin2': np.arange(*bin2_range),
+                                    'sample_id': samples,
+                                    'value_type': value_types})
+        if agg is None:
+            return data
+        elif agg == 'sum':
+            return data.sum(dim='sample_id')
+        elif agg == 'mean':
+            return data.mean(dim='sample_id')
+        else:
+            raise ValueError(f'Unknown agg {agg}, use "sum" or "mean".')
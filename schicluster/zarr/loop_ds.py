@@ -1,9 +1,11 @@
+import multiprocessing
 import pathlib
+import shutil
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
 
 import dask.array as da
 import numpy as np
 import pandas as pd
-import ray
 import xarray as xr
 import zarr
 
@@ -20,34 +22,59 @@ def load_cool_ds_chrom(paths, chrom):
     return ds
 
 
-def init_empty_loop_array(
-        cool_ds, loop_mask, value_types, da_name, output_path, chrom, loop_chunk_size=50000
-):
-    bin1_chunk_size, bin2_chunk_size, sample_chunk_size, _ = cool_ds[da_name].encoding[
-        "chunks"
-    ]
+def get_loop_coords(cool_ds, loop_mask, da_name):
+    """
+    Get loop pixel coords ordered by bin chunk, the same order as the loop dimension in loop ds.
+
+    Returns
+    -------
+    loop_x, loop_y
+        Bin1 and bin2 index of each loop pixel.
+    loop_chunks
+        Array of (bin1_start, bin2_start, loop_start, loop_end) for each bin chunk having loops,
+        loops in loop_x[loop_start:loop_end] are inside the bin chunk.
+    """
+    bin1_chunk_size, bin2_chunk_size, *_ = cool_ds[da_name].encoding["chunks"]
     bin1_idx = cool_ds.get_index("bin1")
     bin2_idx = cool_ds.get_index("bin2")
-    sample_idx = cool_ds.get_index("sample_id")
+    n_bin2_chunks = (bin2_idx.size + bin2_chunk_size - 1) // bin2_chunk_size
 
+    # sparse loop coords, the mask is loaded by bin1 chunk rows to limit memory
     loop_x = []
     loop_y = []
-    # get loop coords, and make sure the order is by bin chunk,
-    # the same order as when iterate bin and save real data
     for bin1_start in range(0, bin1_idx.size, bin1_chunk_size):
         bin1_chunk = bin1_idx[bin1_start: bin1_start + bin1_chunk_size]
-        for bin2_start in range(0, bin2_idx.size, bin2_chunk_size):
-            bin2_chunk = bin2_idx[bin2_start: bin2_start + bin2_chunk_size]
-            loop_chunk = loop_mask.sel(
-                {"bin1": bin1_chunk, "bin2": bin2_chunk}
-            ).to_pandas()
-            _loop_x, _loop_y = np.where(loop_chunk)
-            if _loop_x.size > 0:
-                loop_x.append(_loop_x + bin1_start)
-                loop_y.append(_loop_y + bin2_start)
-
+        mask = np.asarray(loop_mask.sel({"bin1": bin1_chunk, "bin2": bin2_idx}).values)
+        _loop_x, _loop_y = np.nonzero(mask)
+        loop_x.append(_loop_x + bin1_start)
+        loop_y.append(_loop_y)
     loop_x = np.concatenate(loop_x)
     loop_y = np.concatenate(loop_y)
+
+    # order by bin chunk, then by bin1 and bin2 inside the chunk,
+    # the same order as when iterate bin and save real data
+    chunk_key = (loop_x // bin1_chunk_size) * n_bin2_chunks + loop_y // bin2_chunk_size
+    order = np.lexsort((loop_y, loop_x, chunk_key))
+    loop_x = loop_x[order]
+    loop_y = loop_y[order]
+    chunk_key = chunk_key[order]
+
+    # chunk boundaries on the sorted loops
+    chunk_ids = np.unique(chunk_key)
+    loop_starts = np.searchsorted(chunk_key, chunk_ids, side='left')
+    loop_ends = np.searchsorted(chunk_key, chunk_ids, side='right')
+    loop_chunks = np.column_stack([chunk_ids // n_bin2_chunks * bin1_chunk_size,
+                                   chunk_ids % n_bin2_chunks * bin2_chunk_size,
+                                   loop_starts,
+                                   loop_ends])
+    return loop_x, loop_y, loop_chunks
+
+
+def init_empty_loop_array(
+        cool_ds, loop_x, loop_y, value_types, da_name, output_path, chrom, loop_chunk_size=50000
+):
+    *_, sample_chunk_size, _ = cool_ds[da_name].encoding["chunks"]
+    sample_idx = cool_ds.get_index("sample_id")
     n_loop = loop_x.size
 
     empty_loop_array = xr.DataArray(
@@ -67,21 +94,37 @@ def init_empty_loop_array(
     return
 
 
-@ray.remote
+def save_loop_coords(loop_x, loop_y, loop_chunks, coords_dir):
+    """Save loop coords as .npy files, so the sample chunk tasks can memory-map them."""
+    coords_dir = pathlib.Path(coords_dir)
+    coords_dir.mkdir(exist_ok=True, parents=True)
+    np.save(coords_dir / 'loop_x.npy', loop_x)
+    np.save(coords_dir / 'loop_y.npy', loop_y)
+    np.save(coords_dir / 'loop_chunks.npy', loop_chunks)
+    return
+
+
+def load_loop_coords(coords_dir):
+    """Memory-map the loop coords saved by save_loop_coords."""
+    coords_dir = pathlib.Path(coords_dir)
+    return tuple(np.load(coords_dir / f'{name}.npy', mmap_mode='r')
+                 for name in ['loop_x', 'loop_y', 'loop_chunks'])
+
+
 def save_sample_chunk(
         output_path,
         cool_ds_paths,
-        loop_position_ds_path,
         sample_chunk,
         sample_start,
         chrom,
         da_name,
         value_types,
+        loop_coords_dir
 ):
     ds = load_cool_ds_chrom(cool_ds_paths, chrom)
-    loop_ds = xr.open_zarr(f"{loop_position_ds_path}/{chrom}/")
-    loop_mask = loop_ds["loop"] > 0
     output_da = zarr.open(f"{output_path}/{chrom}/{da_name}")
+    # loop coords are shared by all the sample chunks of the chrom, read from disk instead of the task args
+    loop_x, loop_y, loop_chunks = load_loop_coords(loop_coords_dir)
 
     bin1_chunk_size, bin2_chunk_size, *_ = ds[da_name].encoding["chunks"]
     bin1_idx = ds.get_index("bin1")
@@ -89,44 +132,69 @@ def save_sample_chunk(
 
     print(f'Saving {chrom} Sample {sample_start}-{sample_start + sample_chunk.size}')
 
-    cur_loop_idx_start = 0
-    for bin1_start in range(0, bin1_idx.size, bin1_chunk_size):
+    sample_end = sample_start + sample_chunk.size
+    for bin1_start, bin2_start, loop_start, loop_end in loop_chunks.tolist():
         bin1_chunk = bin1_idx[bin1_start: bin1_start + bin1_chunk_size]
-        for bin2_start in range(0, bin2_idx.size, bin2_chunk_size):
-            bin2_chunk = bin2_idx[bin2_start: bin2_start + bin2_chunk_size]
-            loop_chunk = loop_mask.sel(
-                {"bin1": bin1_chunk, "bin2": bin2_chunk}
-            ).to_pandas()
-            loop_x, loop_y = np.where(loop_chunk)
-            if loop_x.size == 0:
-                continue
-
-            # turn 2D matrix shape into 1D pixel shape
-            # matrix_data.shape = [bin1, bin2, sample, value_type]
-            matrix_data = (
-                ds[da_name]
-                .sel(
-                    {
-                        "bin1": bin1_chunk,
-                        "bin2": bin2_chunk,
-                        "sample_id": sample_chunk,
-                        f"{da_name}_value_type": value_types,
-                    }
-                )
-                .values
+        bin2_chunk = bin2_idx[bin2_start: bin2_start + bin2_chunk_size]
+
+        # turn 2D matrix shape into 1D pixel shape
+        # matrix_data.shape = [bin1, bin2, sample, value_type]
+        matrix_data = (
+            ds[da_name]
+            .sel(
+                {
+                    "bin1": bin1_chunk,
+                    "bin2": bin2_chunk,
+                    "sample_id": sample_chunk,
+                    f"{da_name}_value_type": value_types,
+                }
             )
-            # loop_pixel_data.shape = [loop, sample, value_type]
-            loop_pixel_data = matrix_data[loop_x, loop_y, ...]
-
-            # save data to zarr at chunk location
-            cur_loop_idx_end = cur_loop_idx_start + loop_x.size
-            sample_end = sample_start + sample_chunk.size
-            output_da[
-            cur_loop_idx_start:cur_loop_idx_end, sample_start:sample_end, :
-            ] = loop_pixel_data
-
-            # update loop idx
-            cur_loop_idx_start = cur_loop_idx_end
+            .values
+        )
+        # loop_pixel_data.shape = [loop, sample, value_type]
+        loop_pixel_data = matrix_data[loop_x[loop_start:loop_end] - bin1_start,
+                                      loop_y[loop_start:loop_end] - bin2_start, ...]
+
+        # save data to zarr at chunk location
+        output_da[loop_start:loop_end, sample_start:sample_end, :] = loop_pixel_data
+    return
+
+
+def _run_tasks(func, tasks, executor=None, cpu=1):
+    """
+    Run tasks with the executor.
+
+    Parameters
+    ----------
+    func
+        Function to run.
+    tasks
+        List of kwargs dict of each task.
+    executor
+        None or "process" to use a local ProcessPoolExecutor with cpu workers;
+        "ray" to use ray remote tasks on the connected ray cluster;
+        or a concurrent.futures.Executor instance.
+    cpu
+        Number of workers of the local ProcessPoolExecutor.
+    """
+    if executor == 'ray':
+        import ray
+        remote_func = ray.remote(func)
+        # noinspection PyArgumentList
+        ray.get([remote_func.remote(**task_kwargs) for task_kwargs in tasks])
+        return
+
+    if executor is None or executor == 'process':
+        # use spawn, forked workers may deadlock on the locks held by dask threads in the parent process
+        with ProcessPoolExecutor(cpu, mp_context=multiprocessing.get_context('spawn')) as pool:
+            _run_tasks(func, tasks, executor=pool)
+        return
+
+    if not isinstance(executor, Executor):
+        raise ValueError(f'Unknown executor {executor}, use "process", "ray" or a concurrent.futures.Executor.')
+    futures = [executor.submit(func, **task_kwargs) for task_kwargs in tasks]
+    for future in as_completed(futures):
+        future.result()
     return
 
 
@@ -138,43 +206,80 @@ def create_loop_ds(
         chroms,
         value_types,
         min_loop_count=1,
-        loop_chunk_size=50000
+        loop_chunk_size=50000,
+        executor=None,
+        cpu=1
 ):
+    """
+    Extract loop pixels from CoolDS into a loop dataset.
+
+    Parameters
+    ----------
+    cool_ds_paths
+        List of CoolDS paths, concatenated along the sample_id dimension.
+    loop_position_ds_path
+        Path to the loop position dataset with "loop" count array for each chrom.
+    output_path
+        Path to the output loop dataset.
+    da_name
+        Data array name in CoolDS.
+    chroms
+        Chromosomes to save.
+    value_types
+        Value types to save.
+    min_loop_count
+        Pixels with loop count >= min_loop_count are saved.
+    loop_chunk_size
+        Chunk size of the loop dimension.
+    executor
+        None or "process" to use a local ProcessPoolExecutor with cpu workers;
+        "ray" to use ray remote tasks on the connected ray cluster;
+        or a concurrent.futures.Executor instance.
+    cpu
+        Number of workers when using the local ProcessPoolExecutor.
+    """
     pathlib.Path(output_path).mkdir(exist_ok=True, parents=True)
     value_types = pd.Index(value_types)
+    # loop coords of each chrom are saved once here, the workers memory-map them
+    # instead of receiving a pickled copy with every task
+    coords_root = pathlib.Path(output_path) / '.loop_coords'
 
-    futures = []
+    tasks = []
     for chrom in chroms:
         print(f'Init {chrom} empty zarr dataset')
         ds = load_cool_ds_chrom(cool_ds_paths, chrom)
         loop_ds = xr.open_zarr(f"{loop_position_ds_path}/{chrom}/")
         loop_mask = loop_ds["loop"] >= min_loop_count
+        # loop coords are computed once and shared by all the sample chunk tasks
+        loop_x, loop_y, loop_chunks = get_loop_coords(cool_ds=ds, loop_mask=loop_mask, da_name=da_name)
         init_empty_loop_array(
             cool_ds=ds,
-            loop_mask=loop_mask,
+            loop_x=loop_x,
+            loop_y=loop_y,
             value_types=value_types,
             da_name=da_name,
             output_path=output_path,
             chrom=chrom,
             loop_chunk_size=loop_chunk_size
         )
+        save_loop_coords(loop_x, loop_y, loop_chunks, coords_root / chrom)
 
         # save sample chunks in parallel
         sample_idx = ds.get_index("sample_id")
         *_, sample_chunk_size, _ = ds[da_name].encoding["chunks"]
         for sample_start in range(0, sample_idx.size, sample_chunk_size):
             sample_chunk = sample_idx[sample_start: sample_start + sample_chunk_size]
-            # noinspection PyArgumentList
-            future = save_sample_chunk.remote(
+            task_kwargs = dict(
                 output_path=output_path,
                 cool_ds_paths=cool_ds_paths,
-                loop_position_ds_path=loop_position_ds_path,
                 sample_chunk=sample_chunk,
                 sample_start=sample_start,
                 chrom=chrom,
                 da_name=da_name,
                 value_types=value_types,
+                loop_coords_dir=str(coords_root / chrom)
             )
-            futures.append(future)
-    ray.get(futures)
+            tasks.append(task_kwargs)
+    _run_tasks(save_sample_chunk, tasks, executor=executor, cpu=cpu)
+    shutil.rmtree(coords_root, ignore_errors=True)
     return
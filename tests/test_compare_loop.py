@@ -0,0 +1,108 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.__main__ import main
+from schicluster.loop.compare_loop import compare_loops, read_loop_bedpe
+
+DIST = 20000
+
+
+def _random_loops(rng, chroms, n):
+    # anchors on a 10 kb grid, so many anchor distances are exactly DIST
+    chrom = rng.choice(chroms, n)
+    x = rng.integers(0, 40, n) * 10000
+    y = x + rng.integers(2, 30, n) * 10000
+    return pd.DataFrame({0: chrom, 1: x, 2: x + 10000, 3: chrom, 4: y, 5: y + 10000})
+
+
+@pytest.fixture()
+def loop_paths(tmp_path):
+    rng = np.random.default_rng(31)
+    loops = {'a': _random_loops(rng, ['chr1', 'chr2'], 150),
+             'b': _random_loops(rng, ['chr1', 'chr2', 'chr3'], 120),
+             # chrX only has loops in set c
+             'c': _random_loops(rng, ['chr1', 'chrX'], 90)}
+    # trans loops are ignored
+    trans = pd.DataFrame([['chr1', 100000, 110000, 'chr2', 100000, 110000]])
+    loops['a'] = pd.concat([loops['a'], trans], ignore_index=True)
+    paths = {}
+    for name, df in loops.items():
+        paths[name] = str(tmp_path / f'{name}.bedpe')
+        df.to_csv(paths[name], sep='\t', header=False, index=False)
+    return paths
+
+
+def _brute_force_match(query, reference, dist):
+    matched = []
+    for _, loop in query.iterrows():
+        same_chrom = reference[reference[0] == loop[0]]
+        matched.append(((same_chrom[1] - loop[1]).abs().le(dist)
+                        & (same_chrom[4] - loop[4]).abs().le(dist)).any())
+    return np.array(matched, dtype=bool)
+
+
+@pytest.mark.parametrize('dist, chroms', [(DIST, None), (DIST - 1, None), (0, None), (DIST, ['chr2', 'chrX'])])
+def test_compare_loops_matches_brute_force(loop_paths, dist, chroms):
+    overlap, specific = compare_loops(loop_paths, dist=dist, chroms=chroms)
+    loops = {name: read_loop_bedpe(path, chroms=chroms) for name, path in loop_paths.items()}
+    assert overlap.shape[0] == 6
+    for query, query_loops in loops.items():
+        any_matched = np.zeros(query_loops.shape[0], dtype=bool)
+        for reference, reference_loops in loops.items():
+            if query == reference:
+                continue
+            expected = _brute_force_match(query_loops, reference_loops, dist)
+            any_matched |= expected
+            row = overlap.set_index(['query', 'reference']).loc[(query, reference)]
+            assert row['n_query'] == query_loops.shape[0]
+            assert row['n_overlap'] == expected.sum()
+        pd.testing.assert_frame_equal(specific[query], query_loops[~any_matched])
+
+
+def test_distance_boundary(tmp_path):
+    # anchors exactly DIST apart match, DIST + 1 apart do not
+    paths = {}
+    for name, rows in [('q', [['chr1', 100000, 110000, 'chr1', 500000, 510000],
+                              ['chr1', 200000, 210000, 'chr1', 700000, 710000]]),
+                       ('r', [['chr1', 100000 + DIST, 110000, 'chr1', 500000 - DIST, 510000],
+                              ['chr1', 200000 - DIST - 1, 210000, 'chr1', 700000, 710000],
+                              # same anchors on another chrom never match
+                              ['chr2', 200000, 210000, 'chr2', 700000, 710000]])]:
+        paths[name] = str(tmp_path / f'{name}.bedpe')
+        pd.DataFrame(rows).to_csv(paths[name], sep='\t', header=False, index=False)
+    overlap, specific = compare_loops(paths, dist=DIST)
+    overlap = overlap.set_index(['query', 'reference'])
+    assert overlap.loc[('q', 'r'), 'n_overlap'] == 1
+    assert overlap.loc[('r', 'q'), 'n_overlap'] == 1
+    assert specific['q'][1].tolist() == [200000]
+    assert specific['r'][0].tolist() == ['chr1', 'chr2']
+
+
+def test_compare_loops_rejects_duplicated_names(tmp_path, loop_paths):
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    copy = other_dir / 'a.bedpe'
+    copy.write_text(open(loop_paths['a']).read())
+    with pytest.raises(ValueError, match='same set name'):
+        compare_loops([loop_paths['a'], str(copy)])
+    with pytest.raises(ValueError, match='At least two'):
+        compare_loops([loop_paths['a']])
+
+
+def test_compare_loop_cli(tmp_path, loop_paths, monkeypatch):
+    output_prefix = str(tmp_path / 'cmp')
+    monkeypatch.setattr(sys, 'argv', ['hicluster', 'compare-loop',
+                                      '--loop_paths', loop_paths['a'], loop_paths['b'], loop_paths['c'],
+                                      '--output_prefix', output_prefix,
+                                      '--dist', str(DIST),
+                                      '--chroms', 'chr1', 'chrX'])
+    main()
+    expected_overlap, expected_specific = compare_loops(loop_paths, dist=DIST, chroms=['chr1', 'chrX'])
+    overlap = pd.read_csv(f'{output_prefix}.overlap.tsv', sep='\t')
+    pd.testing.assert_frame_equal(overlap, expected_overlap)
+    for name, loops in expected_specific.items():
+        saved = pd.read_csv(f'{output_prefix}.{name}.specific.bedpe', sep='\t', header=None)
+        np.testing.assert_array_equal(saved.values, loops.values)
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.cool.contact_distance import compute_decay, contact_distance
+
+RESOLUTION = 10000
+# chr3 is in the chrom sizes but has no contact
+CHROM_SIZES = pd.DataFrame({1: [3000000, 1200000, 800000]}, index=pd.Index(['chr1', 'chr2', 'chr3'], name=0))
+
+
+def _baseline_compute_decay(cell_name, contact_path, bins, chrom_sizes, resolution, chrom1=1, chrom2=5, pos1=2,
+                            pos2=6):
+    # the per-chrom pandas implementation before vectorization, kept as the reference
+    data = pd.read_csv(contact_path, sep='\t', header=None, index_col=None)
+    data = data.loc[(data[chrom1] == data[chrom2]) & data[chrom1].isin(chrom_sizes.index)]
+    hist = np.histogram(np.abs(data[pos2] - data[pos1]), bins)[0]
+    data[[pos1, pos2]] = data[[pos1, pos2]] // resolution
+    data = data.groupby(by=[chrom1, pos1, pos2])[chrom2].count().reset_index()
+    data = data.loc[data[pos1] != data[pos2], chrom1].value_counts()
+    return [pd.DataFrame(data).set_axis([cell_name], axis=1),
+            pd.DataFrame(hist, columns=[cell_name])]
+
+
+def _distance_bins():
+    nbins = np.floor(np.log2(CHROM_SIZES[1].values.max() / 2500) / 0.125)
+    return 2500 * np.exp2(0.125 * np.arange(nbins + 1))
+
+
+def _write_contacts(path, seed, bins):
+    rng = np.random.default_rng(seed)
+    n = 3000
+    chrom = rng.choice(['chr1', 'chr2', 'chrM'], n, p=[0.6, 0.35, 0.05])
+    pos1 = rng.integers(0, 1000000, n)
+    pos2 = np.abs(pos1 + (rng.choice([-1, 1], n) * np.exp(rng.uniform(0, 15, n))).astype(int))
+    contacts = pd.DataFrame({0: 'read', 1: chrom, 2: pos1, 3: '+', 4: '-',
+                             5: np.where(rng.random(n) < 0.1, 'chr2', chrom), 6: pos2})
+    # distances around the edges of the distance bins (every 8th edge is an integer),
+    # around the right edge of the last bin, below the first bin,
+    # repeated pixels and diagonal pixels
+    edges = np.concatenate([np.floor(bins[::4]), np.ceil(bins[::4]),
+                            [np.floor(bins[-1]), np.ceil(bins[-1]), 10, 0, 0]]).astype(int)
+    extra = pd.DataFrame({0: 'read', 1: 'chr1', 2: 5000, 3: '+', 4: '-', 5: 'chr1', 6: 5000 + edges})
+    contacts = pd.concat([contacts, extra, extra.iloc[:3]], ignore_index=True)
+    contacts.to_csv(path, sep='\t', header=False, index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_compute_decay_matches_baseline(tmp_path, seed):
+    bins = _distance_bins()
+    contact_path = _write_contacts(tmp_path / 'cell.tsv', seed, bins)
+    sparsity, decay, chrom_decay = compute_decay('cell', contact_path, bins, CHROM_SIZES, RESOLUTION,
+                                                 chrom_decay=True)
+    expected_sparsity, expected_decay = _baseline_compute_decay('cell', contact_path, bins, CHROM_SIZES,
+                                                                RESOLUTION)
+    np.testing.assert_array_equal(decay, expected_decay['cell'].values)
+    # the baseline only has the chroms with contacts, in value_counts order
+    np.testing.assert_array_equal(sparsity,
+                                  expected_sparsity['cell'].reindex(CHROM_SIZES.index).fillna(0).values)
+    assert sparsity[2] == 0
+    np.testing.assert_array_equal(chrom_decay.sum(axis=0), decay)
+
+
+def test_contact_distance_keeps_cell_order(tmp_path):
+    bins = _distance_bins()
+    cells = {f'cell{i}': _write_contacts(tmp_path / f'cell{i}.tsv', i + 10, bins) for i in range(4)}
+    contact_table = tmp_path / 'contact_table.tsv'
+    pd.Series(cells).to_csv(contact_table, sep='\t', header=False)
+    chrom_size_path = tmp_path / 'chrom_sizes.tsv'
+    CHROM_SIZES.to_csv(chrom_size_path, sep='\t', header=False)
+
+    output_prefix = str(tmp_path / 'out')
+    contact_distance(str(contact_table), str(chrom_size_path), RESOLUTION, output_prefix,
+                     chrom1=1, chrom2=5, pos1=2, pos2=6, cpu=2, chrom_decay=True)
+    sparsity = pd.read_hdf(f'{output_prefix}_chromsparsity.hdf5')
+    decay = pd.read_hdf(f'{output_prefix}_decay.hdf5')
+    chrom_decay = pd.read_hdf(f'{output_prefix}_chromdecay.hdf5')
+    assert sparsity.index.tolist() == list(cells)
+    for cell, contact_path in cells.items():
+        expected_sparsity, expected_decay = _baseline_compute_decay(cell, contact_path, bins, CHROM_SIZES,
+                                                                    RESOLUTION)
+        np.testing.assert_array_equal(decay.loc[cell].values, expected_decay[cell].values)
+        np.testing.assert_array_equal(sparsity.loc[cell].values,
+                                      expected_sparsity[cell].reindex(sparsity.columns).fillna(0).values)
+        np.testing.assert_array_equal(chrom_decay.loc[cell].groupby(level='bin').sum().values,
+                                      expected_decay[cell].values)
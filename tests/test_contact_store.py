@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.cool.contact_store import ContactStore, index_contacts, is_contact_store, read_contacts
+
+CHROM_SIZES = {'chr1': 2000000, 'chr2': 1000000, 'chr10': 500000}
+
+
+def _write_contacts(path, seed, n=2000):
+    rng = np.random.default_rng(seed)
+    chroms = np.array(list(CHROM_SIZES) + ['chrM'])
+    contacts = pd.DataFrame({0: 'read',
+                             1: rng.choice(chroms, n),
+                             2: rng.integers(1, 500000, n),
+                             3: '+',
+                             4: '-',
+                             5: rng.choice(chroms, n),
+                             6: rng.integers(1, 500000, n)})
+    contacts.to_csv(path, sep='\t', header=False, index=False)
+    return contacts
+
+
+@pytest.fixture()
+def indexed(tmp_path):
+    chrom_size_path = tmp_path / 'chrom_sizes.tsv'
+    pd.Series(CHROM_SIZES).to_csv(chrom_size_path, sep='\t', header=False)
+    cell_paths = {}
+    for i in range(3):
+        path = tmp_path / f'cell{i}.tsv'
+        _write_contacts(path, seed=i)
+        cell_paths[f'cell{i}'] = str(path)
+    empty_path = tmp_path / 'empty.tsv'
+    empty_path.touch()
+    cell_paths['empty'] = str(empty_path)
+    contact_table = tmp_path / 'contact_table.tsv'
+    pd.Series(cell_paths).to_csv(contact_table, sep='\t', header=False)
+
+    output_dir = tmp_path / 'stores'
+    index_contacts(str(contact_table), str(output_dir), chrom_size_path=str(chrom_size_path), cpu=2)
+    store_table = pd.read_csv(output_dir / 'contact_table.tsv', sep='\t', header=None, index_col=0)[1]
+    return cell_paths, store_table
+
+
+def _sort(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_contact_table_keeps_cell_order(indexed):
+    cell_paths, store_table = indexed
+    assert store_table.index.tolist() == list(cell_paths)
+    assert all(is_contact_store(path) for path in store_table)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'cis': True}, {'chroms': ['chr1', 'chr10']}])
+def test_store_round_trip(indexed, kwargs):
+    cell_paths, store_table = indexed
+    for cell, contact_path in cell_paths.items():
+        if cell == 'empty':
+            continue
+        # the store only keeps contacts on the chrom size file chroms
+        expected = read_contacts(contact_path, **{'chroms': list(CHROM_SIZES), **kwargs})
+        result = read_contacts(store_table[cell], **kwargs)
+        assert list(result.columns) == [1, 2, 5, 6]
+        pd.testing.assert_frame_equal(_sort(result), _sort(expected), check_dtype=False)
+
+
+def test_store_fetch_and_all_columns(indexed):
+    cell_paths, store_table = indexed
+    contacts = pd.read_csv(cell_paths['cell0'], sep='\t', header=None)
+    store = ContactStore(store_table['cell0'])
+
+    pos1, pos2 = store.fetch('chr2', 'chr10')
+    expected = contacts[(contacts[1] == 'chr2') & (contacts[5] == 'chr10')]
+    assert pos1.dtype == np.int32
+    # contacts keep the original order inside each chrom pair
+    np.testing.assert_array_equal(pos1, expected[2].values)
+    np.testing.assert_array_equal(pos2, expected[6].values)
+    assert store.fetch('chrM')[0].size == 0
+
+    result = store.to_dataframe(all_columns=True)
+    assert list(result.columns) == list(range(7))
+    assert (result[0] == '.').all()
+
+
+def test_empty_store(indexed):
+    _, store_table = indexed
+    store = ContactStore(store_table['empty'])
+    assert store.n_contacts == 0
+    assert store.fetch('chr1')[0].size == 0
+    assert store.to_dataframe().shape == (0, 4)
@@ -0,0 +1,538 @@
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cooler
+import numpy as np
+import pandas as pd
+import pytest
+import zarr
+
+from schicluster.zarr import ChunkCache, CoolDS, generate_cool_ds, load_chunk_occupancy, read_band_matrix, \
+    write_cool_ds_matrices
+from schicluster.zarr import cool_ds as cool_ds_module
+from schicluster.zarr.cool_ds import CoolDSSingleMatrixWriter, _cool_chunk_occupancy, _save_row_band_worker, \
+    consolidate_metadata_atomic
+
+CHROM_SIZES = {'chr1': 600000, 'chr2': 400000}
+RESOLUTION = 10000
+MAX_DISTANCE = 150000
+WRITE_KWARGS = dict(trans_matrix=True, cooler_bin_size=RESOLUTION, bin_chunk_size=16, sample_chunk_size=2, cpu=2)
+
+
+def _make_cool(path, seed, n=1500):
+    rng = np.random.default_rng(seed)
+    bins = cooler.binnify(pd.Series(CHROM_SIZES), RESOLUTION)
+    bin1 = rng.integers(0, bins.shape[0], n)
+    bin2 = rng.integers(0, bins.shape[0], n)
+    pixels = pd.DataFrame({'bin1_id': np.minimum(bin1, bin2),
+                           'bin2_id': np.maximum(bin1, bin2)}).drop_duplicates()
+    pixels = pixels.sort_values(['bin1_id', 'bin2_id'])
+    pixels['count'] = rng.random(pixels.shape[0]).astype(np.float32)
+    cooler.create_cooler(str(path), bins, pixels, ordered=True, dtypes={'count': np.float32})
+
+
+@pytest.fixture()
+def cool_table(tmp_path):
+    rows = []
+    for i in range(5):
+        for j, value_type in enumerate(['Q', 'E']):
+            path = tmp_path / f'cell{i}.{value_type}.cool'
+            _make_cool(path, seed=i * 2 + j)
+            rows.append([f'cell{i}', value_type, str(path), 'real'])
+    cool_table = pd.DataFrame(rows)
+    chrom_size_path = tmp_path / 'chrom_sizes.tsv'
+    pd.Series(CHROM_SIZES).to_csv(chrom_size_path, sep='\t', header=False)
+    return cool_table, str(chrom_size_path)
+
+
+def _reference(cool_table, sample, value_type, region1, region2, max_distance=None):
+    path = cool_table.loc[(cool_table[0] == sample) & (cool_table[1] == value_type), 2].iloc[0]
+    matrix = cooler.Cooler(path).matrix(balance=False).fetch(region1, region2)
+    if max_distance is not None and region1 == region2:
+        idx = np.arange(matrix.shape[0])
+        matrix = np.where(np.abs(idx[:, None] - idx[None, :]) <= max_distance // RESOLUTION, matrix, 0)
+    return matrix
+
+
+def _check_occupancy(matrix_path):
+    occupancy = load_chunk_occupancy(matrix_path, 'real')
+    keys = {tuple(map(int, k.split('.'))) for k in os.listdir(f'{matrix_path}/real') if not k.startswith('.')}
+    assert keys == set(map(tuple, np.argwhere(occupancy)))
+
+
+def test_band_layout(tmp_path, cool_table):
+    cool_table, chrom_size_path = cool_table
+    table_path = tmp_path / 'cool_table.csv'
+    cool_table.to_csv(table_path, header=False, index=False)
+    output_dir = tmp_path / 'band'
+    generate_cool_ds(str(output_dir), str(table_path), {'real': ['Q', 'E']}, chrom_size_path,
+                     max_distance=MAX_DISTANCE, **WRITE_KWARGS)
+
+    for chrom, size in CHROM_SIZES.items():
+        matrix_path = f'{output_dir}/{chrom}'
+        root = zarr.open(matrix_path, mode='r')
+        assert root['real'].attrs['layout'] == 'band'
+        # band layout stores the diagonals up to max_distance
+        assert root['real'].shape[1] == MAX_DISTANCE // RESOLUTION + 1
+        n_bins = root.attrs['chrom1_n_bins']
+        full = read_band_matrix(matrix_path, 'real', 0, n_bins, 0, n_bins)
+        sub = read_band_matrix(matrix_path, 'real', 7, 30, 12, 40)
+        for sample_idx, sample in enumerate(root['sample_id'][:]):
+            for value_idx, value_type in enumerate(['Q', 'E']):
+                expected = np.triu(_reference(cool_table, sample, value_type, chrom, chrom, MAX_DISTANCE))
+                np.testing.assert_allclose(full[:, :, sample_idx, value_idx], expected)
+                np.testing.assert_allclose(sub[:, :, sample_idx, value_idx], expected[7:30, 12:40])
+        _check_occupancy(matrix_path)
+
+    # trans matrix keeps the full layout, the region reader fills the lower triangle of cis band
+    ds = CoolDS(output_dir)
+    for region1, region2 in [('chr1:50000-400000', 'chr1:100000-600000'), ('chr2', 'chr1:0-300000')]:
+        data = ds.fetch(region1, region2)
+        for sample_idx, sample in enumerate(ds.sample_ids):
+            for value_idx, value_type in enumerate(['Q', 'E']):
+                expected = _reference(cool_table, sample, value_type, region1, region2)
+                if region1.split(':')[0] == region2.split(':')[0]:
+                    bin1 = data.bin1.values[:, None]
+                    bin2 = data.bin2.values[None, :]
+                    expected = np.where(np.abs(bin1 - bin2) <= MAX_DISTANCE // RESOLUTION, expected, 0)
+                np.testing.assert_allclose(data.values[:, :, sample_idx, value_idx], expected)
+
+
+@pytest.mark.parametrize('max_distance', [None, MAX_DISTANCE])
+def test_append_mode(tmp_path, cool_table, max_distance):
+    cool_table, chrom_size_path = cool_table
+    table_a = tmp_path / 'cool_table_a.csv'
+    table_b = tmp_path / 'cool_table_b.csv'
+    cool_table[cool_table[0].isin(['cell0', 'cell1', 'cell2'])].to_csv(table_a, header=False, index=False)
+    # cell2 already exists in the dataset and is skipped
+    cool_table[cool_table[0].isin(['cell2', 'cell3', 'cell4'])].to_csv(table_b, header=False, index=False)
+
+    output_dir = tmp_path / 'append'
+    generate_cool_ds(str(output_dir), str(table_a), {'real': ['Q', 'E']}, chrom_size_path,
+                     mode='w', max_distance=max_distance, **WRITE_KWARGS)
+    generate_cool_ds(str(output_dir), str(table_b), {'real': ['Q', 'E']}, chrom_size_path,
+                     mode='a', max_distance=max_distance, **WRITE_KWARGS)
+
+    ds = CoolDS(output_dir)
+    # new samples are appended after the existing ones
+    assert set(ds.sample_ids[:3]) == {'cell0', 'cell1', 'cell2'}
+    assert set(ds.sample_ids[3:]) == {'cell3', 'cell4'}
+    for region1, region2 in [('chr1', None), ('chr2', None), ('chr1', 'chr2'), ('chr2', 'chr1')]:
+        data = ds.fetch(region1, region2)
+        for sample_idx, sample in enumerate(ds.sample_ids):
+            for value_idx, value_type in enumerate(['Q', 'E']):
+                expected = _reference(cool_table, sample, value_type, region1, region2 or region1,
+                                      max_distance)
+                np.testing.assert_allclose(data.values[:, :, sample_idx, value_idx], expected)
+        name = region1 if region2 is None else f'{region1}-{region2}'
+        _check_occupancy(f'{output_dir}/{name}')
+        root = zarr.open_consolidated(f'{output_dir}/{name}', mode='r')
+        assert root['real'].shape[2] == 5
+        assert root['sample_id'][:].tolist() == ds.sample_ids.tolist()
+
+
+def test_interrupted_append(tmp_path, cool_table, monkeypatch):
+    cool_table, chrom_size_path = cool_table
+    # a sparse sample, most of its chunks are empty
+    for seed, value_type in enumerate(['Q', 'E']):
+        path = tmp_path / f'sparse.{value_type}.cool'
+        _make_cool(path, seed=100 + seed, n=5)
+        cool_table.loc[cool_table.shape[0]] = ['sparse', value_type, str(path), 'real']
+    paths = {}
+    for name, samples in [('a', ['cell0', 'cell1', 'cell2']), ('b', ['cell3', 'cell4']), ('c', ['sparse'])]:
+        paths[name] = tmp_path / f'cool_table_{name}.csv'
+        cool_table[cool_table[0].isin(samples)].to_csv(paths[name], header=False, index=False)
+    output_dir = tmp_path / 'interrupted'
+    generate_cool_ds(str(output_dir), str(paths['a']), {'real': ['Q', 'E']}, chrom_size_path,
+                     mode='w', **WRITE_KWARGS)
+
+    # the data of cell3 and cell4 is written, but the append stops before the samples are committed
+    def _interrupt(self):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(CoolDSSingleMatrixWriter, '_commit_append', _interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            generate_cool_ds(str(output_dir), str(paths['b']), {'real': ['Q', 'E']}, chrom_size_path,
+                             mode='a', **WRITE_KWARGS)
+    assert set(CoolDS(output_dir).sample_ids) == {'cell0', 'cell1', 'cell2'}
+
+    # the rerun appends a different sample, which goes to the slot half written with cell3
+    generate_cool_ds(str(output_dir), str(paths['c']), {'real': ['Q', 'E']}, chrom_size_path,
+                     mode='a', **WRITE_KWARGS)
+    ds = CoolDS(output_dir)
+    assert ds.sample_ids[-1] == 'sparse' and ds.sample_ids.size == 4
+    for region1, region2 in [('chr1', None), ('chr2', 'chr1')]:
+        data = ds.fetch(region1, region2)
+        for sample_idx, sample in enumerate(ds.sample_ids):
+            for value_idx, value_type in enumerate(['Q', 'E']):
+                expected = _reference(cool_table, sample, value_type, region1, region2 or region1)
+                np.testing.assert_allclose(data.values[:, :, sample_idx, value_idx], expected)
+        name = region1 if region2 is None else f'{region1}-{region2}'
+        _check_occupancy(f'{output_dir}/{name}')
+        assert zarr.open_consolidated(f'{output_dir}/{name}', mode='r')['real'].shape[2] == 4
+
+
+LABEL_CHROM_SIZES = pd.Series({'chr1': 230000, 'chr2': 95000, 'chr3': 170000})
+LABEL_SAMPLES = ['s0', 's1', 's2', 's3', 's4', 'empty', 'chr2only']
+
+
+def _label_values(sample_idx, bin1, bin2):
+    # every pixel value encodes its own sample and genome bins, so a misplaced pixel never matches
+    return 1 + sample_idx * 10000 + bin1 * 100 + bin2
+
+
+@pytest.fixture(scope='module')
+def labelled_cools(tmp_path_factory):
+    """Seven cools with labelled pixels, one without pixels and one with chr2 cis pixels only."""
+    tmp_path = tmp_path_factory.mktemp('labelled')
+    rng = np.random.default_rng(33)
+    bins = cooler.binnify(LABEL_CHROM_SIZES, RESOLUTION)
+    bin_chrom = bins['chrom'].astype(str).values
+    bin1, bin2 = np.triu_indices(bins.shape[0])
+    rows = []
+    for sample_idx, sample in enumerate(LABEL_SAMPLES):
+        if sample == 'empty':
+            keep = np.zeros(bin1.size, dtype=bool)
+        elif sample == 'chr2only':
+            keep = (bin_chrom[bin1] == 'chr2') & (bin_chrom[bin2] == 'chr2') & (rng.random(bin1.size) < 0.3)
+        else:
+            keep = rng.random(bin1.size) < 0.05
+        pixels = pd.DataFrame({'bin1_id': bin1[keep], 'bin2_id': bin2[keep],
+                               'count': _label_values(sample_idx, bin1[keep], bin2[keep]).astype(np.float64)})
+        path = tmp_path / f'{sample}.cool'
+        cooler.create_cooler(str(path), bins, pixels, ordered=True, dtypes={'count': np.float64})
+        rows.append([sample, 'E', str(path), 'real'])
+    return pd.DataFrame(rows, columns=['sample', 'value_type', 'path', 'cool_type'])
+
+
+def _labelled_dense(cool_path, chrom1, chrom2):
+    return cooler.Cooler(cool_path).matrix(balance=False).fetch(chrom1, chrom2)
+
+
+@pytest.mark.parametrize('chrom1, chrom2, max_distance', [('chr3', 'chr1', None),
+                                                           ('chr1', 'chr3', None),
+                                                           ('chr2', 'chr2', None),
+                                                           ('chr1', 'chr1', 60000)])
+def test_single_writer_matches_dense(tmp_path, labelled_cools, chrom1, chrom2, max_distance):
+    # bin_chunk_size 7 does not divide any chrom, sample_chunk_size 3 splits the samples unevenly
+    path = str(tmp_path / 'matrix')
+    CoolDSSingleMatrixWriter(path, labelled_cools, {'real': ['E']}, LABEL_CHROM_SIZES, chrom1, chrom2,
+                             cooler_bin_size=RESOLUTION, bin_chunk_size=7, sample_chunk_size=3,
+                             data_dtype='float64', max_distance=max_distance, cpu=2)
+    root = zarr.open(path, mode='r')
+    z = root['real']
+    assert z.dtype == np.float64
+    n_bins1 = root.attrs['chrom1_n_bins']
+    n_bins2 = root.attrs['chrom2_n_bins']
+    if max_distance is None:
+        stored = z[:]
+    else:
+        assert z.shape[1] == max_distance // RESOLUTION + 1
+        stored = read_band_matrix(path, 'real', 0, n_bins1, 0, n_bins2)
+    paths = labelled_cools.set_index('sample')['path']
+    for sample_idx, sample in enumerate(root['sample_id'][:]):
+        expected = _labelled_dense(paths[sample], chrom1, chrom2)
+        if chrom1 == chrom2:
+            expected = np.triu(expected)
+            if max_distance is not None:
+                expected = np.triu(expected) - np.triu(expected, max_distance // RESOLUTION + 1)
+        np.testing.assert_array_equal(stored[:, :, sample_idx, 0], expected)
+    assert not stored[:, :, root['sample_id'][:].tolist().index('empty')].any()
+
+
+def test_save_row_band_worker_fans_out_one_row_chunk(tmp_path, labelled_cools):
+    # one task reads rows 7-13 of chr1 and writes them to the cis matrix, the chr1-chr3 rows
+    # and the transposed chr3-chr1 columns, into sample slots 3-5 of the second value type
+    n_bins = {'chr1': 23, 'chr3': 17}
+    targets = []
+    for chrom1, chrom2 in [('chr1', 'chr1'), ('chr1', 'chr3'), ('chr3', 'chr1')]:
+        zarr_path = str(tmp_path / f'{chrom1}-{chrom2}')
+        zarr.open(zarr_path, mode='w', shape=(n_bins[chrom1], n_bins[chrom2], 6, 2),
+                  chunks=(7, 7, 3, 1), dtype='float64')
+        targets.append((zarr_path, chrom1, chrom2, n_bins[chrom1], n_bins[chrom2], None))
+    cool_paths = labelled_cools['path'].iloc[[0, 5, 2]].tolist()
+    n_chunks = _save_row_band_worker(cool_paths, 'chr1', 7, 14, targets, sample_start=3, value_idx=1,
+                                     bin_chunk_size=7, data_dtype='float64')
+
+    expected_chunks = 0
+    for zarr_path, chrom1, chrom2, _, _, _ in targets:
+        stored = zarr.open(zarr_path, mode='r')[:]
+        assert not stored[..., 0].any() and not stored[:, :, :3].any()
+        for slot, cool_path in enumerate(cool_paths):
+            expected = _labelled_dense(cool_path, chrom1, chrom2)
+            if chrom1 == chrom2:
+                expected = np.triu(expected)
+            judge = np.zeros_like(expected, dtype=bool)
+            if chrom1 == 'chr1':
+                judge[7:14] = True
+            else:
+                judge[:, 7:14] = True
+            np.testing.assert_array_equal(stored[:, :, 3 + slot, 1], np.where(judge, expected, 0))
+        occupied = stored[..., 3:, 1].any(axis=-1)
+        expected_chunks += np.unique(np.argwhere(occupied) // 7, axis=0).shape[0]
+    assert n_chunks == expected_chunks > 0
+
+
+def _brute_force_occupancy(cool_path, chrom1, chrom2, bin_chunk_size, n_diag):
+    dense = _labelled_dense(cool_path, chrom1, chrom2)
+    if chrom1 == chrom2:
+        dense = np.triu(dense)
+    rows, cols = np.nonzero(dense)
+    if n_diag is not None:
+        cols = cols - rows
+        rows, cols = rows[cols < n_diag], cols[cols < n_diag]
+    return {(row // bin_chunk_size, col // bin_chunk_size) for row, col in zip(rows, cols)}
+
+
+def test_cool_chunk_occupancy_matches_brute_force(labelled_cools):
+    pairs = [('chr1', 'chr1'), ('chr3', 'chr1'), ('chr1', 'chr3'), ('chr2', 'chr2'), ('chr2', 'chr3')]
+    n_diags = [4, None, None, None, None]
+    for cool_path in labelled_cools['path']:
+        results = _cool_chunk_occupancy(cool_path, pairs, bin_chunk_size=5, n_diags=n_diags)
+        for (chrom1, chrom2), n_diag, (chunk_pairs, row_chrom) in zip(pairs, n_diags, results):
+            # chr1 is before chr3 in the cool, so chr3-chr1 pixels are stored with chr1 as the row
+            assert row_chrom == ('chr1' if (chrom1, chrom2) == ('chr3', 'chr1') else chrom1)
+            assert chunk_pairs.shape[1] == 2
+            assert set(map(tuple, chunk_pairs)) == _brute_force_occupancy(cool_path, chrom1, chrom2, 5, n_diag)
+
+
+def test_empty_chunks_are_not_written(tmp_path, labelled_cools):
+    # neither sample has chr1-chr3 pixels, the matrix has no chunk on disk at all
+    cool_table = labelled_cools[labelled_cools['sample'].isin(['empty', 'chr2only'])]
+    for chrom1, chrom2 in [('chr1', 'chr3'), ('chr2', 'chr2')]:
+        path = str(tmp_path / f'{chrom1}-{chrom2}')
+        CoolDSSingleMatrixWriter(path, cool_table, {'real': ['E']}, LABEL_CHROM_SIZES, chrom1, chrom2,
+                                 cooler_bin_size=RESOLUTION, bin_chunk_size=4, sample_chunk_size=1, cpu=1)
+        _check_occupancy(path)
+        occupancy = load_chunk_occupancy(path, 'real')
+        sample_ids = zarr.open(path, mode='r')['sample_id'][:].tolist()
+        if chrom1 == 'chr1':
+            assert not occupancy.any()
+        else:
+            # only the sample chunk of chr2only is occupied
+            assert not occupancy[:, :, sample_ids.index('empty')].any()
+            assert occupancy[:, :, sample_ids.index('chr2only')].any()
+
+
+def test_missing_occupancy_reads_all_chunks(tmp_path, labelled_cools):
+    # a CoolDS written before the occupancy index has every chunk marked as occupied
+    path = tmp_path / 'cool_ds' / 'chr2'
+    CoolDSSingleMatrixWriter(str(path), labelled_cools, {'real': ['E']}, LABEL_CHROM_SIZES, 'chr2',
+                             cooler_bin_size=RESOLUTION, bin_chunk_size=3, sample_chunk_size=4, cpu=1)
+    before = CoolDS(path.parent).fetch('chr2').values
+    root = zarr.open(str(path), mode='r+')
+    del root['real'].attrs['occupancy']
+    consolidate_metadata_atomic(path)
+    occupancy = load_chunk_occupancy(path, 'real')
+    assert occupancy.all() and occupancy.shape == root['real'].cdata_shape
+    # absent chunks are read as the fill value, the result does not change
+    np.testing.assert_array_equal(CoolDS(path.parent).fetch('chr2').values, before)
+
+
+def test_chunk_cache_lru_eviction():
+    loads = []
+
+    def _loader(key, size=10):
+        def _load():
+            loads.append(key)
+            return np.full(size, len(loads), dtype=np.float64)
+        return _load
+
+    # room for three 80-byte chunks
+    cache = ChunkCache(max_bytes=250)
+    for key in ['a', 'b', 'c']:
+        cache.get(key, _loader(key))
+    first_a = cache.get('a', _loader('a'))
+    # d evicts b, the least recently used chunk, a is kept since it was just read
+    cache.get('d', _loader('d'))
+    assert cache.get('a', _loader('a')) is first_a
+    cache.get('b', _loader('b'))
+    assert loads == ['a', 'b', 'c', 'd', 'b']
+    assert not first_a.flags.writeable
+    assert cache.stats == {'hits': 2, 'misses': 5, 'hit_rate': 2 / 7, 'n_chunks': 3, 'n_bytes': 240,
+                           'max_bytes': 250}
+
+    # a chunk larger than the cache is returned but never cached
+    big = cache.get('big', _loader('big', size=100))
+    assert big.size == 100 and cache.stats['n_chunks'] == 3
+    cache.get('big', _loader('big', size=100))
+    assert loads.count('big') == 2
+
+    cache.clear()
+    assert cache.stats == {'hits': 0, 'misses': 0, 'hit_rate': 0., 'n_chunks': 0, 'n_bytes': 0, 'max_bytes': 250}
+
+
+def test_chunk_cache_shared_by_threads():
+    cache = ChunkCache(max_bytes=1024 ** 2)
+    n_load = []
+    lock = threading.Lock()
+
+    def _load(key):
+        with lock:
+            n_load.append(key)
+        return np.arange(key, key + 50)
+
+    def _query(i):
+        key = i % 4
+        chunk = cache.get(key, lambda: _load(key))
+        return chunk[0] == key
+
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(_query, range(400)))
+    stats = cache.stats
+    assert stats['hits'] + stats['misses'] == 400
+    # concurrent misses of the same key may load twice, but only one copy is kept
+    assert stats['misses'] == len(n_load) and stats['n_chunks'] == 4
+    assert stats['n_bytes'] == 4 * np.arange(50).nbytes
+
+
+@pytest.fixture(scope='module')
+def labelled_cool_ds(tmp_path_factory, labelled_cools):
+    """CoolDS of the labelled cools, value type T of each sample is the E cool of the next sample."""
+    tmp_path = tmp_path_factory.mktemp('labelled_ds')
+    t_table = labelled_cools.copy()
+    t_table['value_type'] = 'T'
+    t_table['path'] = np.roll(labelled_cools['path'].values, -1)
+    table_path = tmp_path / 'cool_table.csv'
+    pd.concat([labelled_cools, t_table]).to_csv(table_path, header=False, index=False)
+    chrom_size_path = tmp_path / 'chrom_sizes.tsv'
+    LABEL_CHROM_SIZES.to_csv(chrom_size_path, sep='\t', header=False)
+    output_dir = tmp_path / 'cool_ds'
+    generate_cool_ds(str(output_dir), str(table_path), {'real': ['E', 'T']}, str(chrom_size_path),
+                     trans_matrix=True, cooler_bin_size=RESOLUTION, bin_chunk_size=6, sample_chunk_size=2,
+                     data_dtype='float64', cpu=2)
+    # only chr1-chr3 is kept, chr3-chr1 queries read it transposed
+    shutil.rmtree(output_dir / 'chr3-chr1')
+    paths = {(row.sample, row.value_type): row.path for row in pd.concat([labelled_cools, t_table]).itertuples()}
+    return output_dir, paths
+
+
+@pytest.mark.parametrize('region1, region2', [('chr3:35000-121000', 'chr1:0-90000'),
+                                              ('chr1:50000-150000', 'chr1:0-200000'),
+                                              ('chr2', None)])
+def test_fetch_sample_and_value_type_subsets(labelled_cool_ds, region1, region2):
+    output_dir, paths = labelled_cool_ds
+    # a small cache, chunks are evicted during the query
+    ds = CoolDS(output_dir, cache_bytes=5000)
+    samples = ['s3', 'chr2only', 's0']
+    data = ds.fetch(region1, region2, samples=samples, value_types='T')
+    assert data.dims == ('bin1', 'bin2', 'sample_id', 'value_type')
+    assert data.get_index('sample_id').tolist() == samples
+    assert data.get_index('value_type').tolist() == ['T']
+    for sample_idx, sample in enumerate(samples):
+        expected = cooler.Cooler(paths[(sample, 'T')]).matrix(balance=False).fetch(region1, region2)
+        np.testing.assert_array_equal(data.values[:, :, sample_idx, 0], expected)
+
+    # aggregation over the selected samples only
+    both = ds.fetch(region1, region2, samples=samples)
+    np.testing.assert_array_equal(ds.fetch(region1, region2, samples=samples, agg='sum').values,
+                                  both.values.sum(axis=2))
+    np.testing.assert_allclose(ds.fetch(region1, region2, samples=samples, agg='mean').values,
+                               both.values.mean(axis=2))
+    np.testing.assert_array_equal(both.sel(value_type='T').values, data.values[..., 0])
+    assert ds.cache.stats['n_bytes'] <= 5000
+
+
+def test_fetch_shared_cache_and_errors(labelled_cool_ds, labelled_cools, tmp_path):
+    output_dir, paths = labelled_cool_ds
+    # a second dataset with a different chunk grid shares the cache without mixing up chunks
+    other_dir = tmp_path / 'other'
+    CoolDSSingleMatrixWriter(str(other_dir / 'chr2'), labelled_cools, {'real': ['E']}, LABEL_CHROM_SIZES,
+                             'chr2', cooler_bin_size=RESOLUTION, bin_chunk_size=6, sample_chunk_size=2,
+                             data_dtype='float64', cpu=1)
+    cache = ChunkCache()
+    ds = CoolDS(output_dir, cache=cache)
+    other = CoolDS(other_dir, cache=cache)
+    first = ds.fetch('chr2', value_types=['E'], agg='sum')
+    misses = cache.stats['misses']
+    assert misses > 0
+    other_data = other.fetch('chr2', agg='sum')
+    assert cache.stats['misses'] > misses
+    np.testing.assert_array_equal(other_data.values, first.values)
+    # repeated overlapping queries are served from the cache
+    hits, misses = cache.stats['hits'], cache.stats['misses']
+    ds.fetch('chr2:20000-60000', value_types='E')
+    assert cache.stats['hits'] > hits and cache.stats['misses'] == misses
+
+    with pytest.raises(KeyError, match='missing'):
+        ds.fetch('chr2', samples=['s0', 'missing'])
+    with pytest.raises(KeyError, match='Q'):
+        ds.fetch('chr2', value_types='Q')
+    with pytest.raises(ValueError, match='Unknown agg'):
+        ds.fetch('chr2', agg='max')
+
+
+def _matrix_writer(path, cool_table, chrom1, chrom2, execute, bin_chunk_size=5, max_distance=None, mode='w'):
+    return CoolDSSingleMatrixWriter(str(path), cool_table, {'real': ['E']}, LABEL_CHROM_SIZES, chrom1, chrom2,
+                                    mode=mode, cooler_bin_size=RESOLUTION, bin_chunk_size=bin_chunk_size,
+                                    sample_chunk_size=3, max_distance=max_distance, cpu=1, execute=execute)
+
+
+def test_shared_scheduler_matches_single_writers(tmp_path, labelled_cools, monkeypatch, capsys):
+    # all the pairs of three chroms, chr2 cis has its own chunk grid, chr1 cis is a band,
+    # the chr3 pairs only get a sample subset, so the writers fall in three groups
+    subset = labelled_cools[labelled_cools['sample'].isin(['s1', 's4', 'chr2only'])]
+    specs = {}
+    for chrom1 in LABEL_CHROM_SIZES.index:
+        for chrom2 in LABEL_CHROM_SIZES.index:
+            specs[(chrom1, chrom2)] = dict(cool_table=subset if 'chr3' in (chrom1, chrom2) else labelled_cools,
+                                           bin_chunk_size=4 if chrom1 == chrom2 == 'chr2' else 5,
+                                           max_distance=50000 if chrom1 == chrom2 == 'chr1' else None)
+
+    # run the tasks in threads to record them
+    submitted = []
+
+    def _record_worker(**kwargs):
+        submitted.append(kwargs)
+        return _save_row_band_worker(**kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(cool_ds_module, 'ProcessPoolExecutor', ThreadPoolExecutor)
+        m.setattr(cool_ds_module, '_save_row_band_worker', _record_worker)
+        writers = [_matrix_writer(tmp_path / 'shared' / f'{chrom1}-{chrom2}', chrom1=chrom1, chrom2=chrom2,
+                                  execute=False, **spec)
+                   for (chrom1, chrom2), spec in specs.items()]
+        write_cool_ds_matrices(writers, cpu=3)
+
+    # each sample range reads a row chunk once, and the task writes every pair of its group with that row chrom
+    task_keys = [(tuple(task['cool_paths']), task['row_chrom'], task['bin_start'], task['bin_chunk_size'])
+                 for task in submitted]
+    assert len(task_keys) == len(set(task_keys))
+    groups = {pair: (id(spec['cool_table']), spec['bin_chunk_size']) for pair, spec in specs.items()}
+    for task in submitted:
+        task_pairs = {(chrom1, chrom2) for _, chrom1, chrom2, *_ in task['targets']}
+        task_groups = {groups[pair] for pair in task_pairs}
+        assert len(task_groups) == 1
+        group = task_groups.pop()
+        assert task_pairs == {pair for pair in specs if groups[pair] == group and task['row_chrom'] in pair}
+    # a chr3 row chunk of the sample subset is fanned out to all the five chr3 pairs
+    assert max(len(task['targets']) for task in submitted) == 5
+
+    for (chrom1, chrom2), spec in specs.items():
+        name = f'{chrom1}-{chrom2}'
+        single = _matrix_writer(tmp_path / 'single' / name, chrom1=chrom1, chrom2=chrom2, execute=True, **spec)
+        shared = zarr.open(str(tmp_path / 'shared' / name), mode='r')
+        expected = zarr.open(single.path, mode='r')
+        assert shared['sample_id'][:].tolist() == expected['sample_id'][:].tolist()
+        np.testing.assert_array_equal(shared['real'][:], expected['real'][:])
+        assert shared['real'].attrs['occupancy'] == expected['real'].attrs['occupancy']
+        assert shared['real'].chunks == expected['real'].chunks
+        _check_occupancy(str(tmp_path / 'shared' / name))
+        assert (tmp_path / 'shared' / name / '.log' / '_WRITE_SUCCESS').exists()
+
+    # a writer without new samples is skipped, the other writers of the call still append
+    capsys.readouterr()
+    rest = labelled_cools[~labelled_cools['sample'].isin(subset['sample'])]
+    appenders = [_matrix_writer(tmp_path / 'shared' / 'chr3-chr3', subset, 'chr3', 'chr3', execute=False, mode='a'),
+                 _matrix_writer(tmp_path / 'shared' / 'chr1-chr3', rest, 'chr1', 'chr3', execute=False, mode='a')]
+    write_cool_ds_matrices(appenders, cpu=2)
+    assert 'No new samples to append' in capsys.readouterr().out
+    assert zarr.open(str(tmp_path / 'shared' / 'chr3-chr3'), mode='r')['real'].shape[2] == 3
+    appended = zarr.open(str(tmp_path / 'shared' / 'chr1-chr3'), mode='r')
+    paths = labelled_cools.set_index('sample')['path']
+    for sample_idx, sample in enumerate(appended['sample_id'][:]):
+        np.testing.assert_array_equal(appended['real'][:, :, sample_idx, 0],
+                                      _labelled_dense(paths[sample], 'chr1', 'chr3'))
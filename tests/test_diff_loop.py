@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import zarr
+
+from schicluster.diff.loop import _one_way_anova_arrays, chunked_one_way_anova, one_way_anova
+
+N_LOOP = 103
+GROUPS = ['g0', 'g1', 'g2', 'g3', 'g4']
+
+
+@pytest.fixture(scope='module')
+def loop_ds_path(tmp_path_factory):
+    """Group mean and mean square of each loop, stored with a loop chunk size of 25."""
+    path = tmp_path_factory.mktemp('anova') / 'loop_ds'
+    rng = np.random.default_rng(30)
+    group_n = rng.integers(3, 40, len(GROUPS))
+    mean = rng.gamma(2, 1, (N_LOOP, len(GROUPS)))
+    # within group variance is positive, so x2 > x ** 2
+    mean2 = mean ** 2 + rng.gamma(1, 0.5, (N_LOOP, len(GROUPS)))
+    # the second chrom has fewer loops than a chunk
+    for chrom, n_loop in [('chr1', N_LOOP), ('chr2', 11)]:
+        data = np.stack([mean, mean2, mean * 3], axis=-1)[:n_loop].astype(np.float32)
+        ds = xr.Dataset({'real': (('loop', 'sample_id', 'real_value_type'), data)},
+                        coords={'sample_id': GROUPS,
+                                'real_value_type': ['E', 'E2', 'T'],
+                                'group_n': ('sample_id', group_n),
+                                'loop_bin1_id': ('loop', np.arange(n_loop)),
+                                'loop_bin2_id': ('loop', np.arange(n_loop) + 7)})
+        ds.to_zarr(f'{path}/{chrom}', mode='w', encoding={'real': {'chunks': (25, 5, 3)}})
+    return str(path)
+
+
+@pytest.mark.parametrize('loop_chunk_size, cpu', [(None, 1), (10, 2), (1000, 1)])
+def test_chunked_anova_matches_whole_array(tmp_path, loop_ds_path, loop_chunk_size, cpu):
+    output_path = str(tmp_path / 'anova')
+    chunked_one_way_anova(loop_ds_path, output_path, ['chr1', 'chr2'], 'real', 'E',
+                          loop_chunk_size=loop_chunk_size, cpu=cpu)
+    for chrom in ['chr1', 'chr2']:
+        loop_ds = xr.open_zarr(f'{loop_ds_path}/{chrom}').load()
+        x = loop_ds['real'].sel(real_value_type='E').values.astype(np.float64)
+        x2 = loop_ds['real'].sel(real_value_type='E2').values.astype(np.float64)
+        f, p = _one_way_anova_arrays(x, x2, loop_ds['group_n'].values.astype(np.float64))
+
+        result = zarr.open_consolidated(f'{output_path}/{chrom}', mode='r')
+        np.testing.assert_allclose(result['F'][:], f, rtol=1e-10)
+        np.testing.assert_allclose(result['P'][:], p, rtol=1e-10)
+        np.testing.assert_array_equal(result['loop_bin2_id'][:], loop_ds['loop_bin2_id'].values)
+        # the whole array ANOVA is the same as the xarray implementation
+        xr_f, xr_p = one_way_anova(loop_ds, 'real', 'E')
+        np.testing.assert_allclose(f, xr_f.values, rtol=1e-5)
+
+
+def test_chunked_anova_merges_groups(tmp_path, loop_ds_path):
+    group_map = pd.Series(['a', 'b', 'a', 'c', 'b'], index=GROUPS)
+    output_path = str(tmp_path / 'anova')
+    chunked_one_way_anova(loop_ds_path, output_path, ['chr1'], 'real', 'E',
+                          group_map=group_map, loop_chunk_size=17)
+
+    loop_ds = xr.open_zarr(f'{loop_ds_path}/chr1').load()
+    n = loop_ds['group_n'].to_pandas()
+    merged = {}
+    for value_type in ['E', 'E2']:
+        # sum over the cells of the merged groups, then divide by the merged cell number
+        total = loop_ds['real'].sel(real_value_type=value_type).to_pandas().astype(np.float64) * n
+        merged[value_type] = total.T.groupby(group_map).sum().T / n.groupby(group_map).sum()
+    f, p = _one_way_anova_arrays(merged['E'].values, merged['E2'].values,
+                                 n.groupby(group_map).sum().values.astype(np.float64))
+    result = zarr.open_consolidated(f'{output_path}/chr1', mode='r')
+    np.testing.assert_allclose(result['F'][:], f, rtol=1e-8)
+    np.testing.assert_allclose(result['P'][:], p, rtol=1e-8)
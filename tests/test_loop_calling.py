@@ -0,0 +1,105 @@
+import cooler
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+from statsmodels.stats.multitest import multipletests
+
+from schicluster.loop.loop_calling import (_holm_sidak, call_loops, evaluate_candidate_filter,
+                                           filter_loop_candidates)
+from schicluster.loop.loop_store import read_loop_table
+
+CHROM_SIZES = {'chr1': 1500000, 'chr2': 1000000}
+RESOLUTION = 10000
+N_CELLS = 20
+
+
+@pytest.fixture(scope='module')
+def group_prefix(tmp_path_factory):
+    """E, T and Q group cools with a few strong pixels on top of a gamma background."""
+    tmp_path = tmp_path_factory.mktemp('group')
+    rng = np.random.default_rng(28)
+    bins = cooler.binnify(pd.Series(CHROM_SIZES), RESOLUTION)
+    xs, ys = [], []
+    offset = 0
+    for size in CHROM_SIZES.values():
+        n_bins = size // RESOLUTION
+        x, y = np.triu_indices(n_bins, 1)
+        near = (y - x) < 60
+        xs.append(x[near] + offset)
+        ys.append(y[near] + offset)
+        offset += n_bins
+    x, y = np.concatenate(xs), np.concatenate(ys)
+    for name in ['E', 'T', 'Q']:
+        value = rng.gamma(2, 0.5, x.size)
+        value[rng.random(x.size) < 0.02] *= 6
+        if name == 'T':
+            value -= 1
+        for suffix, count in [('', value), ('2', value ** 2 + rng.gamma(2, 0.5, x.size))]:
+            path = f'{tmp_path}/g.{name}{suffix}.cool'
+            pixels = pd.DataFrame({'bin1_id': x, 'bin2_id': y, 'count': count.astype(np.float32)})
+            cooler.create_cooler(path, bins, pixels, ordered=True, dtypes={'count': np.float32})
+            with h5py.File(path, 'a') as f:
+                f.attrs['group_n_cells'] = N_CELLS
+    return f'{tmp_path}/g'
+
+
+def test_local_max_pad_matches_window_scan():
+    rng = np.random.default_rng(0)
+    # small integer values, so there are ties and the >= comparison matters
+    E = np.triu(rng.integers(0, 4, (40, 40)), 1).astype(float)
+    loop = np.where(E > 0)
+    for pad in [1, 3]:
+        keep = filter_loop_candidates(E, loop, local_max_pad=pad)
+        expect = [E[x, y] >= E[max(x - pad, 0):x + pad + 1, max(y - pad, 0):y + pad + 1].max()
+                  for x, y in zip(*loop)]
+        np.testing.assert_array_equal(keep, expect)
+
+
+def test_top_frac_and_zscore_per_diagonal():
+    E = np.zeros((6, 6))
+    # diagonal 1 has 5 pixels, diagonal 2 has constant E
+    E[np.arange(5), np.arange(1, 6)] = [5, 1, 4, 2, 3]
+    E[np.arange(4), np.arange(2, 6)] = 7
+    loop = np.where(E > 0)
+    keep = filter_loop_candidates(E, loop, top_frac=0.5)
+    # ceil(5 * 0.5) = 3 pixels on diagonal 1, ceil(4 * 0.5) = 2 pixels on diagonal 2
+    kept = pd.Series(E[loop][keep]).groupby(loop[1][keep] - loop[0][keep]).apply(sorted)
+    assert kept[1] == [3, 4, 5]
+    assert kept[2] == [7, 7]
+    # constant diagonal has z-score 0 everywhere
+    keep = filter_loop_candidates(E, loop, min_e_zscore=0.5)
+    assert set(E[loop][keep]) == {4, 5}
+
+
+def test_holm_sidak_with_untested_candidates():
+    rng = np.random.default_rng(1)
+    p_values = rng.random(30) ** 4
+    p_values[5] = 1
+    np.testing.assert_allclose(_holm_sidak(p_values, 30), multipletests(p_values)[1])
+    # the candidates removed by the pre-filter are counted as p-value 1 tests
+    padded = np.concatenate([p_values, np.ones(12)])
+    np.testing.assert_allclose(_holm_sidak(p_values, 42), multipletests(padded)[1][:30])
+
+
+def test_prefilter_only_tests_kept_candidates(tmp_path, group_prefix):
+    call_loops(group_prefix, RESOLUTION, f'{tmp_path}/all')
+    call_loops(group_prefix, RESOLUTION, f'{tmp_path}/kept', top_frac=0.2, local_max_pad=1)
+    total = read_loop_table(f'{tmp_path}/all.totalloop_info.zarr')
+    kept = read_loop_table(f'{tmp_path}/kept.totalloop_info.zarr')
+    assert 0 < kept.shape[0] < total.shape[0] * 0.2
+    assert list(kept.columns) == list(total.columns)
+
+    merged = kept.merge(total, on=['chrom', 'x1', 'y1'], suffixes=('_kept', '_all'))
+    assert merged.shape[0] == kept.shape[0]
+    # statistics of the tested pixels do not depend on the pre-filter
+    np.testing.assert_allclose(merged['local_pval_kept'], merged['local_pval_all'])
+    np.testing.assert_allclose(merged['E_donut_kept'], merged['E_donut_all'])
+    # the adjustment is over all the candidates, so it is never less strict than the unfiltered run
+    assert (merged['local_qval_kept'] >= merged['local_qval_all'] - 1e-12).all()
+    assert (merged['global_qval_kept'] >= merged['global_qval_all'] - 1e-12).all()
+
+    report = evaluate_candidate_filter(group_prefix, list(CHROM_SIZES), top_frac=0.2, local_max_pad=1)
+    assert report.loc['total', 'candidates'] == total.shape[0]
+    assert report.loc['total', 'candidates_kept'] == kept.shape[0]
+    assert report.loc['total', 'shared_loops'] == report.loc['total', 'filtered_loops']
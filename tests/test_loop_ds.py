@@ -0,0 +1,119 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cooler
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from schicluster.zarr import generate_cool_ds
+from schicluster.zarr.loop_ds import create_loop_ds, get_loop_coords
+
+CHROM_SIZES = {'chr1': 500000, 'chr2': 330000}
+RESOLUTION = 10000
+
+
+@pytest.fixture(scope='module')
+def cool_ds_paths(tmp_path_factory):
+    """Two CoolDS with 3 and 2 samples, read together along sample_id."""
+    tmp_path = tmp_path_factory.mktemp('cool_ds')
+    rng = np.random.default_rng(36)
+    bins = cooler.binnify(pd.Series(CHROM_SIZES), RESOLUTION)
+    chrom_size_path = tmp_path / 'chrom_sizes.tsv'
+    pd.Series(CHROM_SIZES).to_csv(chrom_size_path, sep='\t', header=False)
+    paths = []
+    for ds_idx, samples in enumerate([['a0', 'a1', 'a2'], ['b0', 'b1']]):
+        rows = []
+        for sample in samples:
+            for value_type in ['Q', 'E']:
+                bin1 = rng.integers(0, bins.shape[0], 2000)
+                bin2 = rng.integers(0, bins.shape[0], 2000)
+                pixels = pd.DataFrame({'bin1_id': np.minimum(bin1, bin2),
+                                       'bin2_id': np.maximum(bin1, bin2)}).drop_duplicates()
+                pixels = pixels.sort_values(['bin1_id', 'bin2_id'])
+                pixels['count'] = rng.random(pixels.shape[0]).astype(np.float32)
+                cool_path = str(tmp_path / f'{sample}.{value_type}.cool')
+                cooler.create_cooler(cool_path, bins, pixels, ordered=True, dtypes={'count': np.float32})
+                rows.append([sample, value_type, cool_path, 'real'])
+        table_path = tmp_path / f'cool_table_{ds_idx}.csv'
+        pd.DataFrame(rows).to_csv(table_path, header=False, index=False)
+        path = str(tmp_path / f'ds{ds_idx}')
+        generate_cool_ds(path, str(table_path), {'real': ['Q', 'E']}, str(chrom_size_path),
+                         cooler_bin_size=RESOLUTION, bin_chunk_size=12, sample_chunk_size=2, cpu=1)
+        paths.append(path)
+
+    # loop count of each pixel, sparse and irregular across the bin chunks
+    loop_path = str(tmp_path / 'loop_position')
+    for chrom, size in CHROM_SIZES.items():
+        n_bins = size // RESOLUTION + (size % RESOLUTION > 0)
+        count = rng.poisson(0.3, (n_bins, n_bins)) * (rng.random((n_bins, n_bins)) < 0.2)
+        xr.Dataset({'loop': (('bin1', 'bin2'), count)}).to_zarr(f'{loop_path}/{chrom}', mode='w')
+    return paths, loop_path
+
+
+@pytest.mark.parametrize('executor', ['process', 'thread'])
+def test_create_loop_ds(tmp_path, cool_ds_paths, executor):
+    paths, loop_path = cool_ds_paths
+    output_path = str(tmp_path / 'loop_ds')
+    with ThreadPoolExecutor(3) as pool:
+        create_loop_ds(paths, loop_path, output_path, 'real', list(CHROM_SIZES), ['E'],
+                       min_loop_count=1, loop_chunk_size=7,
+                       executor=pool if executor == 'thread' else 'process', cpu=2)
+    # the memory-mapped loop coords are removed after all the tasks are done
+    assert not os.path.exists(f'{output_path}/.loop_coords')
+
+    for chrom in CHROM_SIZES:
+        matrix = xr.concat([xr.open_zarr(f'{path}/{chrom}', decode_cf=False)['real'] for path in paths],
+                           dim='sample_id')
+        loop_count = xr.open_zarr(f'{loop_path}/{chrom}')['loop'].values
+        loop_ds = xr.open_zarr(f'{output_path}/{chrom}')
+        x = loop_ds['loop_bin1_id'].values
+        y = loop_ds['loop_bin2_id'].values
+        assert sorted(zip(x, y)) == sorted(zip(*np.nonzero(loop_count >= 1)))
+        expected = matrix.sel(real_value_type=['E']).values[x, y]
+        np.testing.assert_array_equal(loop_ds['real'].values, expected)
+        assert loop_ds.get_index('sample_id').tolist() == matrix.get_index('sample_id').tolist()
+        assert set(loop_ds.get_index('sample_id')[:3]) == {'a0', 'a1', 'a2'}
+
+
+def _brute_force_loop_coords(mask, bin1_chunk_size, bin2_chunk_size):
+    # walk the bin chunks in row major order, the loops inside a chunk in row major order
+    loop_x, loop_y, loop_chunks = [], [], []
+    for bin1_start in range(0, mask.shape[0], bin1_chunk_size):
+        for bin2_start in range(0, mask.shape[1], bin2_chunk_size):
+            block = mask[bin1_start:bin1_start + bin1_chunk_size, bin2_start:bin2_start + bin2_chunk_size]
+            x, y = np.nonzero(block)
+            if x.size == 0:
+                continue
+            loop_chunks.append([bin1_start, bin2_start, len(loop_x), len(loop_x) + x.size])
+            loop_x += (x + bin1_start).tolist()
+            loop_y += (y + bin2_start).tolist()
+    return np.array(loop_x, dtype=int), np.array(loop_y, dtype=int), np.array(loop_chunks, dtype=int).reshape(-1, 4)
+
+
+@pytest.mark.parametrize('chunks, density, lazy', [((7, 5), 0.15, False),
+                                                   ((4, 4), 0.6, True),
+                                                   ((1, 19), 0.3, False),
+                                                   ((100, 100), 0.1, True),
+                                                   ((6, 6), 0, False)])
+def test_get_loop_coords_matches_chunk_walk(chunks, density, lazy):
+    # a 23 x 19 trans-like matrix, the chunk sizes do not divide the bins
+    rng = np.random.default_rng(37)
+    mask = rng.random((23, 19)) < density
+    coords = {'bin1': np.arange(23), 'bin2': np.arange(19)}
+    cool_ds = xr.Dataset({'real': (('bin1', 'bin2'), np.zeros((23, 19), dtype=np.float32))}, coords=coords)
+    cool_ds['real'].encoding['chunks'] = chunks
+    loop_mask = xr.DataArray(mask, dims=['bin1', 'bin2'], coords=coords)
+    if lazy:
+        loop_mask = loop_mask.chunk({'bin1': 5, 'bin2': 5})
+
+    loop_x, loop_y, loop_chunks = get_loop_coords(cool_ds, loop_mask, 'real')
+    expected_x, expected_y, expected_chunks = _brute_force_loop_coords(mask, *chunks)
+    np.testing.assert_array_equal(loop_x, expected_x)
+    np.testing.assert_array_equal(loop_y, expected_y)
+    np.testing.assert_array_equal(loop_chunks, expected_chunks)
+    assert loop_chunks.shape == (expected_chunks.shape[0], 4)
+    # the chunk ranges tile the loop dimension without gaps
+    assert loop_chunks[:, 2].tolist() == np.concatenate([[0], loop_chunks[:-1, 3]])[:len(loop_chunks)].tolist()
+    assert (loop_chunks[-1, 3] if loop_chunks.size else 0) == mask.sum()
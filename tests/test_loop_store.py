@@ -0,0 +1,105 @@
+import operator
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.loop import loop_store
+from schicluster.loop.loop_store import read_loop_table, save_loop_table
+
+CHUNK_SIZE = 50
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+             '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+
+
+@pytest.fixture()
+def total_loops():
+    rng = np.random.default_rng(0)
+    n = 6000
+    x1 = rng.integers(0, 500, n) * 10000
+    distance = rng.integers(5, 300, n) * 10000
+    return pd.DataFrame({'chrom': rng.choice(['chr1', 'chr2', 'chr3'], n),
+                         'x1': x1,
+                         'x2': x1 + 10000,
+                         'y1': x1 + distance,
+                         'y2': x1 + distance + 10000,
+                         'distance': distance,
+                         'local_qval': rng.random(n),
+                         'global_qval': rng.random(n),
+                         'bkfilter': rng.random(n) < 0.5})
+
+
+def _sort(df):
+    return df.sort_values(['chrom', 'x1', 'y1']).reset_index(drop=True)
+
+
+def _expected(total_loops, chroms=None, filters=(), columns=None):
+    judge = np.ones(total_loops.shape[0], dtype=bool)
+    if chroms is not None:
+        judge &= total_loops['chrom'].isin(chroms).values
+    for col, op, value in filters:
+        judge &= OPERATORS[op](total_loops[col].values, value)
+    data = total_loops.loc[judge]
+    if columns is not None:
+        data = data[columns + ['chrom']]
+    return _sort(data)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'filters': [('bkfilter', '==', True), ('distance', '>=', 1000000), ('distance', '<', 2000000)]},
+    {'chroms': ['chr2'], 'filters': [('local_qval', '<', 0.1)], 'columns': ['x1', 'y1', 'local_qval']},
+])
+def test_read_loop_table(tmp_path, total_loops, kwargs):
+    path = tmp_path / 'loops.totalloop_info.zarr'
+    save_loop_table(total_loops, path, chunk_size=CHUNK_SIZE)
+    result = read_loop_table(path, **kwargs)
+    expected = _expected(total_loops, chroms=kwargs.get('chroms'), filters=kwargs.get('filters', ()),
+                         columns=kwargs.get('columns'))
+    pd.testing.assert_frame_equal(_sort(result)[expected.columns], expected, check_dtype=False)
+
+    region = read_loop_table(path, region=('chr1', 1000000, 3000000))
+    expected = _expected(total_loops, chroms=['chr1'], filters=[('x1', '>=', 1000000), ('y2', '<=', 3000000)])
+    pd.testing.assert_frame_equal(_sort(region)[expected.columns], expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('kwargs, expected_filters', [
+    ({'filters': [('distance', '>=', 2000000)]}, [('distance', '>=', 2000000)]),
+    ({'region': ('chr1', 1000000, 2500000)}, [('x1', '>=', 1000000), ('y2', '<=', 2500000)]),
+])
+def test_zone_map_skips_chunks(tmp_path, monkeypatch, total_loops, kwargs, expected_filters):
+    path = tmp_path / 'loops.totalloop_info.zarr'
+    save_loop_table(total_loops, path, chunk_size=CHUNK_SIZE, distance_band=1000000)
+
+    # record the chunks read by each chromosome
+    selected = []
+
+    def _select_chunks(zone_maps, n_loops, chunk_size, filters):
+        chunk_ids = loop_store_select_chunks(zone_maps, n_loops, chunk_size, filters)
+        selected.append((len(chunk_ids), (n_loops + chunk_size - 1) // chunk_size))
+        return chunk_ids
+
+    loop_store_select_chunks = loop_store._select_chunks
+    monkeypatch.setattr(loop_store, '_select_chunks', _select_chunks)
+
+    result = read_loop_table(path, **kwargs)
+    chroms = [kwargs['region'][0]] if 'region' in kwargs else None
+    expected = _expected(total_loops, chroms=chroms, filters=expected_filters)
+    assert expected.shape[0] > 0
+    pd.testing.assert_frame_equal(_sort(result)[expected.columns], expected, check_dtype=False)
+
+    n_read = sum(n for n, _ in selected)
+    n_total = sum(n for _, n in selected)
+    # at most half of the chunks are read
+    assert 0 < n_read <= n_total / 2
+
+
+def test_read_legacy_hdf(tmp_path, total_loops):
+    pytest.importorskip('tables')
+    total_loops.to_hdf(tmp_path / 'loops.totalloop_info.hdf', key='data')
+    filters = [('bkfilter', '==', True), ('distance', '<', 1500000)]
+    # the zarr path falls back to the legacy hdf file with the same prefix
+    result = read_loop_table(tmp_path / 'loops.totalloop_info.zarr', chroms=['chr1', 'chr3'],
+                             filters=filters, columns=['x1', 'y1', 'distance'])
+    expected = _expected(total_loops, chroms=['chr1', 'chr3'], filters=filters, columns=['x1', 'y1', 'distance'])
+    pd.testing.assert_frame_equal(_sort(result)[expected.columns], expected, check_dtype=False)
@@ -0,0 +1,74 @@
+import cooler
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.cool.contact_store import index_contacts
+from schicluster.cool.merge import merge_cell_raw
+
+CHROM_SIZES = pd.Series({'chr1': 1000000, 'chr2': 620000})
+RESOLUTION = 50000
+MIN_POS_DIST = 2500
+
+
+@pytest.fixture(scope='module')
+def cell_table(tmp_path_factory):
+    """Ten cells of different sizes, one of them is converted to a contact store."""
+    tmp_path = tmp_path_factory.mktemp('cells')
+    rng = np.random.default_rng(50)
+    cell_paths = {}
+    for i in range(10):
+        # cell5 only has contacts dropped by the filters
+        n = 3 if i == 5 else rng.integers(20, 400)
+        chrom1 = rng.choice(['chr1', 'chr2', 'chrM'], n, p=[0.6, 0.35, 0.05])
+        chrom2 = np.where(rng.random(n) < 0.8, chrom1, rng.choice(['chr1', 'chr2'], n))
+        size1 = CHROM_SIZES.reindex(chrom1).fillna(16000).values.astype(int)
+        size2 = CHROM_SIZES.reindex(chrom2).fillna(16000).values.astype(int)
+        pos1 = rng.integers(1, size1 + 1)
+        pos2 = np.where(rng.random(n) < 0.2, pos1 + rng.integers(0, 3000, n), rng.integers(1, size2 + 1))
+        pos2 = np.minimum(pos2, size2)
+        if i == 5:
+            chrom1, chrom2, pos2 = np.array(['chrM', 'chr1', 'chr1']), np.array(['chrM', 'chr1', 'chr1']), pos1 + 100
+        contacts = pd.DataFrame({0: 'read', 1: chrom1, 2: pos1, 3: '+', 4: '-', 5: chrom2, 6: pos2})
+        path = tmp_path / f'cell{i}.tsv'
+        contacts.to_csv(path, sep='\t', header=False, index=False)
+        cell_paths[f'cell{i}'] = str(path)
+
+    chrom_size_path = tmp_path / 'chrom_sizes.tsv'
+    CHROM_SIZES.to_csv(chrom_size_path, sep='\t', header=False)
+    store_table = tmp_path / 'store_table.tsv'
+    pd.Series({'cell3': cell_paths['cell3']}).to_csv(store_table, sep='\t', header=False)
+    index_contacts(str(store_table), str(tmp_path / 'stores'), chrom_size_path=str(chrom_size_path), cpu=1)
+    text_paths = dict(cell_paths)
+    cell_paths['cell3'] = pd.read_csv(tmp_path / 'stores' / 'contact_table.tsv', sep='\t', header=None,
+                                      index_col=0).loc['cell3', 1]
+
+    table_path = tmp_path / 'cell_table.tsv'
+    pd.Series(cell_paths).to_csv(table_path, sep='\t', header=False)
+    return str(table_path), str(chrom_size_path), text_paths
+
+
+def _flat_sum(text_paths, bins):
+    """Bin and count the contacts of all the cells at once with pandas."""
+    chrom_offset = pd.Series(bins.groupby('chrom', observed=True).size().cumsum().shift(fill_value=0))
+    contacts = pd.concat([pd.read_csv(path, sep='\t', header=None) for path in text_paths.values()])
+    contacts = contacts[contacts[1].isin(CHROM_SIZES.index) & contacts[5].isin(CHROM_SIZES.index)]
+    contacts = contacts[((contacts[2] - contacts[6]).abs() > MIN_POS_DIST) | (contacts[1] != contacts[5])]
+    bin1 = contacts[1].map(chrom_offset) + (contacts[2] - 1) // RESOLUTION
+    bin2 = contacts[5].map(chrom_offset) + (contacts[6] - 1) // RESOLUTION
+    matrix = np.zeros((bins.shape[0], bins.shape[0]))
+    np.add.at(matrix, (np.minimum(bin1, bin2), np.maximum(bin1, bin2)), 1)
+    # diagonal is counted twice, the same as the upper triangle plus its transpose
+    return matrix + np.diag(np.diag(matrix))
+
+
+@pytest.mark.parametrize('batch_n, chunk_size, cpu', [(3, 7, 2), (4, 10 ** 6, 3), (1, 13, 2), (100, 50, 1)])
+def test_tree_reduction_matches_flat_sum(tmp_path, cell_table, batch_n, chunk_size, cpu):
+    table_path, chrom_size_path, text_paths = cell_table
+    output_file = str(tmp_path / 'merged.cool')
+    merge_cell_raw(table_path, chrom_size_path, output_file, resolution=RESOLUTION, min_pos_dist=MIN_POS_DIST,
+                   cpu=cpu, batch_n=batch_n, chunk_size=chunk_size)
+    cool = cooler.Cooler(output_file)
+    expected = _flat_sum(text_paths, cool.bins()[:])
+    np.testing.assert_array_equal(np.triu(cool.matrix(balance=False)[:]), expected)
+    assert cool.info['nnz'] == np.count_nonzero(expected)
@@ -0,0 +1,141 @@
+import pathlib
+
+import cooler
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import coo_matrix
+
+from schicluster.cool import get_chrom_offsets
+from schicluster.loop import merge_cell_to_group
+from schicluster.loop.merge_cell_to_group import MultiCoolChromReader, save_matrix_types_by_chrom
+
+CHROM_SIZES = pd.Series({'chrA': 230000, 'chrB': 170000})
+RESOLUTION = 10000
+
+
+def _random_pixels(rng, bins, n):
+    bin1 = rng.integers(0, bins.shape[0], n)
+    bin2 = rng.integers(0, bins.shape[0], n)
+    pixels = pd.DataFrame({'bin1_id': np.minimum(bin1, bin2),
+                           'bin2_id': np.maximum(bin1, bin2)}).drop_duplicates()
+    pixels = pixels.sort_values(['bin1_id', 'bin2_id']).reset_index(drop=True)
+    pixels['count'] = rng.integers(1, 9, pixels.shape[0]).astype(np.float32)
+    return pixels
+
+
+def _dense(pixels, bins):
+    matrix = np.zeros((bins.shape[0], bins.shape[0]))
+    np.add.at(matrix, (pixels['bin1_id'], pixels['bin2_id']), pixels['count'])
+    return matrix + np.triu(matrix, 1).T
+
+
+@pytest.fixture()
+def inputs(tmp_path):
+    """A single cell cool, a group cool with group_n_cells and two cells in a scool."""
+    rng = np.random.default_rng(26)
+    bins = cooler.binnify(CHROM_SIZES, RESOLUTION)
+    paths, dense, scales = [], [], []
+    for name, group_n_cells in [('cell', None), ('group', 7)]:
+        pixels = _random_pixels(rng, bins, 300)
+        path = str(tmp_path / f'{name}.cool')
+        cooler.create_cooler(path, bins, pixels, ordered=True, dtypes={'count': np.float32})
+        if group_n_cells is not None:
+            with h5py.File(path, 'a') as f:
+                f.attrs['group_n_cells'] = group_n_cells
+        paths.append(path)
+        dense.append(_dense(pixels, bins))
+        scales.append(group_n_cells or 1)
+    cell_pixels = {f'sc{i}': _random_pixels(rng, bins, 100) for i in range(2)}
+    scool_path = str(tmp_path / 'cells.scool')
+    cooler.create_scool(scool_path, bins, cell_pixels, ordered=True, dtypes={'count': np.float32})
+    for cell, pixels in cell_pixels.items():
+        paths.append(f'{scool_path}::/cells/{cell}')
+        dense.append(_dense(pixels, bins))
+        scales.append(1)
+    total = sum(matrix * scale for matrix, scale in zip(dense, scales))
+    return paths, total, bins
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_fetch_sum(inputs, n_threads):
+    paths, total, bins = inputs
+    offsets = {chrom: np.flatnonzero(bins['chrom'].values == chrom)[[0, -1]] + [0, 1]
+               for chrom in CHROM_SIZES.index}
+    with MultiCoolChromReader(paths, n_threads=n_threads) as reader:
+        # the group cool counts as 7 cells
+        assert reader.n_cells == 10
+        for chrom, (start, end) in offsets.items():
+            matrix = reader.fetch_sum(chrom)
+            np.testing.assert_allclose(matrix.toarray(), np.triu(total[start:end, start:end]))
+            # pixels are sorted and unique, as required by cooler.create_cooler
+            keys = matrix.row.astype(np.int64) * matrix.shape[1] + matrix.col
+            assert (np.diff(keys) > 0).all()
+        (a_start, a_end), (b_start, b_end) = offsets['chrA'], offsets['chrB']
+        np.testing.assert_allclose(reader.fetch_sum('chrA', 'chrB').toarray(),
+                                   total[a_start:a_end, b_start:b_end])
+        # trans matrix in the reversed order is the transpose, no triangle is dropped
+        np.testing.assert_allclose(reader.fetch_sum('chrB', 'chrA').toarray(),
+                                   total[b_start:b_end, a_start:a_end])
+
+        # a row block of the cis matrix, triu_k is the global diagonal shifted into the block coordinates
+        block = reader.fetch_sum_region(('chrA', 50000, 120000), 'chrA', triu_k=5)
+        expected = np.triu(total[a_start:a_end, a_start:a_end], 0)[5:12]
+        np.testing.assert_allclose(block.toarray(), expected)
+    # closing again after the context manager is a no-op
+    reader.close()
+
+
+def test_sum_matrices_keeps_shape_of_empty_inputs():
+    matrices = [coo_matrix((3, 4)), coo_matrix(([2.0, 1.0], ([2, 2], [3, 3])), shape=(3, 4))]
+    result = MultiCoolChromReader.sum_matrices(matrices)
+    assert result.shape == (3, 4)
+    assert result.nnz == 1 and result.data[0] == 3
+
+
+def test_save_matrix_types_by_chrom(tmp_path):
+    rng = np.random.default_rng(27)
+    # chrC has no pixel in any input
+    chrom_sizes = pd.Series({'chrA': 120000, 'chrB': 90000, 'chrC': 40000})
+    bins = cooler.binnify(chrom_sizes, RESOLUTION)
+    bin_chrom = bins['chrom'].astype(str).values
+    has_pixel = bin_chrom != 'chrC'
+    same_chrom = bin_chrom[:, None] == bin_chrom[None, :]
+    cool_lists = {}
+    expected = {}
+    for matrix_type in ['E', 'T2']:
+        inputs = []
+        total = 0
+        for chunk, group_n_cells in enumerate([2, 3, 4]):
+            pixels = _random_pixels(rng, bins[has_pixel], 60)
+            path = str(tmp_path / f'chunk{chunk}.{matrix_type}.cool')
+            cooler.create_cooler(path, bins, pixels, ordered=True, dtypes={'count': np.float32})
+            with h5py.File(path, 'a') as f:
+                f.attrs['group_n_cells'] = group_n_cells
+            inputs.append(path)
+            total = total + _dense(pixels, bins) * group_n_cells
+        output_cool = str(tmp_path / f'group.{matrix_type}.cool')
+        cool_lists[output_cool] = inputs
+        # only the cis blocks are merged, then averaged over the total cells
+        expected[output_cool] = np.where(same_chrom, total, 0) / 9
+
+    save_matrix_types_by_chrom(cool_lists, bins, chrom_sizes, get_chrom_offsets(bins), total_cells=9, cpu=2)
+    for output_cool, matrix in expected.items():
+        cool = cooler.Cooler(output_cool)
+        np.testing.assert_allclose(cool.matrix(balance=False)[:], matrix, rtol=1e-6)
+        assert cool.info['nnz'] == np.count_nonzero(np.triu(matrix))
+        with h5py.File(output_cool, 'r') as f:
+            assert f.attrs['group_n_cells'] == 9
+        # the chromosome parts are removed after concatenation
+        assert not pathlib.Path(f'{output_cool}_parts').exists()
+
+
+def test_close_worker_readers(inputs):
+    paths, *_ = inputs
+    reader = merge_cell_to_group._get_worker_reader(paths[:2])
+    # the same input list reuses the opened reader
+    assert merge_cell_to_group._get_worker_reader(paths[:2]) is reader
+    merge_cell_to_group._close_worker_readers()
+    assert merge_cell_to_group._WORKER_READERS == {}
+    assert reader._h5s == []
@@ -0,0 +1,77 @@
+import cooler
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.cool import get_chrom_offsets
+from schicluster.loop.merge_raw_matrix import _chrom_sum_iterator, _save_single_matrix_type
+
+# chrom sizes are not multiples of the resolution, the last bin of each chrom is partial
+CHROM_SIZES = pd.Series({'chr1': 265000, 'chr2': 93000, 'chr3': 151000})
+RESOLUTION = 10000
+
+
+@pytest.fixture(scope='module')
+def cells(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('raw')
+    rng = np.random.default_rng(32)
+    bins = cooler.binnify(CHROM_SIZES, RESOLUTION)
+    n_bins = bins.shape[0]
+    cell_pixels = {}
+    total = np.zeros((n_bins, n_bins))
+    for i in range(4):
+        bin1 = rng.integers(0, n_bins, 400)
+        bin2 = rng.integers(0, n_bins, 400)
+        pixels = pd.DataFrame({'bin1_id': np.minimum(bin1, bin2), 'bin2_id': np.maximum(bin1, bin2)})
+        pixels = pixels.value_counts().rename('count').reset_index().sort_values(['bin1_id', 'bin2_id'])
+        cell_pixels[f'cell{i}'] = pixels
+        np.add.at(total, (pixels['bin1_id'], pixels['bin2_id']), pixels['count'])
+    scool_path = str(tmp_path / 'raw.scool')
+    cooler.create_scool(scool_path, bins, cell_pixels, ordered=True)
+    cell_urls = [f'{scool_path}::/cells/{cell}' for cell in cell_pixels]
+    return cell_urls, bins, total
+
+
+def _to_dense(pixel_dfs, n_bins):
+    pixels = pd.concat(pixel_dfs, ignore_index=True)
+    keys = pixels['bin1_id'].values.astype(np.int64) * n_bins + pixels['bin2_id'].values
+    # pixels are emitted sorted and unique, as required by cooler.create_cooler(ordered=True)
+    assert (np.diff(keys) > 0).all()
+    dense = np.zeros((n_bins, n_bins))
+    dense[pixels['bin1_id'], pixels['bin2_id']] = pixels['count']
+    return dense
+
+
+@pytest.mark.parametrize('trans_chunk_size, n_threads', [(1, 1), (35000, 2), (100000, 1), (10 ** 9, 1)])
+def test_trans_row_blocks_match_full_sum(cells, trans_chunk_size, n_threads):
+    cell_urls, bins, total = cells
+    chrom_offset = get_chrom_offsets(bins)
+    pixel_dfs = list(_chrom_sum_iterator(cell_urls, CHROM_SIZES, chrom_offset, add_trans=True,
+                                         n_threads=n_threads, trans_chunk_size=trans_chunk_size))
+    # one block per chunk_bins rows of each chrom
+    chunk_bins = max(1, trans_chunk_size // RESOLUTION)
+    n_chrom_bins = np.ceil(CHROM_SIZES / RESOLUTION).astype(int)
+    assert len(pixel_dfs) == int(np.ceil(n_chrom_bins / chunk_bins).sum())
+    np.testing.assert_allclose(_to_dense(pixel_dfs, bins.shape[0]), total)
+
+
+def test_cis_only_and_saved_cool(tmp_path, cells):
+    cell_urls, bins, total = cells
+    chrom_offset = get_chrom_offsets(bins)
+    bin_chrom = bins['chrom'].astype(str).values
+    cis_total = np.where(bin_chrom[:, None] == bin_chrom[None, :], total, 0)
+    pixel_dfs = list(_chrom_sum_iterator(cell_urls, CHROM_SIZES, chrom_offset, add_trans=False))
+    np.testing.assert_allclose(_to_dense(pixel_dfs, bins.shape[0]), cis_total)
+
+    cool_path = str(tmp_path / 'group.cool')
+    _save_single_matrix_type(cool_path, bins, cell_urls, CHROM_SIZES, chrom_offset, add_trans=True)
+    cool = cooler.Cooler(cool_path)
+    np.testing.assert_allclose(np.triu(cool.matrix(balance=False)[:]), total)
+    assert cool.info['nnz'] == np.count_nonzero(total)
+
+
+def test_trans_chunk_size_must_be_positive(cells):
+    cell_urls, bins, _ = cells
+    with pytest.raises(ValueError, match='trans_chunk_size'):
+        next(_chrom_sum_iterator(cell_urls, CHROM_SIZES, get_chrom_offsets(bins), add_trans=True,
+                                 trans_chunk_size=0))
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.cool.contact_store import index_contacts, is_contact_store
+from schicluster.cool.remove_blacklist import duplicated_contacts, filter_contacts
+
+CHROM_SIZES = {'chr1': 2000000, 'chr2': 1000000}
+
+
+@pytest.fixture()
+def contact_path(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 5000
+    chroms = np.array(list(CHROM_SIZES))
+    chrom1 = rng.choice(chroms, n)
+    chrom2 = np.where(rng.random(n) < 0.8, chrom1, rng.choice(chroms, n))
+    size1 = pd.Series(CHROM_SIZES)[chrom1].values
+    size2 = pd.Series(CHROM_SIZES)[chrom2].values
+    contacts = pd.DataFrame({0: [f'read{i}' for i in range(n)],
+                             1: chrom1,
+                             2: rng.integers(1, size1),
+                             3: '+',
+                             4: '-',
+                             5: chrom2,
+                             6: rng.integers(1, size2)})
+    # add some duplicated contacts with different read names
+    dup = contacts.sample(500, random_state=0).copy()
+    dup[0] = dup[0] + '_dup'
+    contacts = pd.concat([contacts, dup]).sample(frac=1, random_state=1)
+    path = tmp_path / 'contacts.tsv'
+    contacts.to_csv(path, sep='\t', header=False, index=False)
+    return str(path)
+
+
+@pytest.fixture()
+def chrom_size_path(tmp_path):
+    path = tmp_path / 'chrom_sizes.tsv'
+    pd.Series(CHROM_SIZES).to_csv(path, sep='\t', header=False)
+    return str(path)
+
+
+def _read_contacts(path):
+    return pd.read_csv(path, sep='\t', header=None, index_col=None)
+
+
+def _sort(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_2d_blacklist_matches_brute_force(tmp_path, contact_path, chrom_size_path):
+    resolution = 10000
+    blacklist_2d = pd.DataFrame([['chr1', 100000, 400000, 'chr1', 300000, 900000],
+                                 ['chr1', 1500000, 1503000, 'chr2', 200000, 350000],
+                                 ['chr2', 10000, 500000, 'chr2', 10000, 500000],
+                                 ['chr2', 600000, 650000, 'chr1', 0, 80000]])
+    blacklist_2d_path = str(tmp_path / 'blacklist.bedpe')
+    blacklist_2d.to_csv(blacklist_2d_path, sep='\t', header=False, index=False)
+
+    result = filter_contacts(contact_path,
+                             chrom_size_path=chrom_size_path,
+                             blacklist_2d_path=blacklist_2d_path,
+                             remove_duplicates=False,
+                             resolution_2d=resolution)
+
+    contacts = _read_contacts(contact_path)
+    is_bad = np.zeros(contacts.shape[0], dtype=bool)
+    for chrom1, start1, end1, chrom2, start2, end2 in blacklist_2d.values:
+        # regions are turned into bins, at least one bin on each side
+        bin1_start, bin1_end = start1 // resolution, max(end1 // resolution, start1 // resolution + 1)
+        bin2_start, bin2_end = start2 // resolution, max(end2 // resolution, start2 // resolution + 1)
+        for c1, p1, c2, p2 in [(1, 2, 5, 6), (5, 6, 1, 2)]:
+            is_bad |= ((contacts[c1] == chrom1) & (contacts[c2] == chrom2)
+                       & (contacts[p1] // resolution >= bin1_start) & (contacts[p1] // resolution < bin1_end)
+                       & (contacts[p2] // resolution >= bin2_start) & (contacts[p2] // resolution < bin2_end)).values
+    expected = contacts[~is_bad]
+    assert is_bad.sum() > 0
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+
+
+def test_1d_blacklist_matches_brute_force(tmp_path, contact_path, chrom_size_path):
+    # overlapping and nested regions are merged by the interval index
+    blacklist_1d = pd.DataFrame([['chr1', 100000, 300000],
+                                 ['chr1', 250000, 400000],
+                                 ['chr1', 260000, 270000],
+                                 ['chr1', 1000000, 1000001],
+                                 ['chr2', 500000, 800000],
+                                 ['chrUn', 0, 100000]])
+    blacklist_1d_path = str(tmp_path / 'blacklist.bed')
+    blacklist_1d.to_csv(blacklist_1d_path, sep='\t', header=False, index=False)
+
+    result = filter_contacts(contact_path,
+                             chrom_size_path=chrom_size_path,
+                             blacklist_1d_path=blacklist_1d_path,
+                             remove_duplicates=False)
+
+    contacts = _read_contacts(contact_path)
+    is_bad = np.zeros(contacts.shape[0], dtype=bool)
+    for chrom, start, end in blacklist_1d.values:
+        for c, p in [(1, 2), (5, 6)]:
+            is_bad |= ((contacts[c] == chrom) & (contacts[p] >= start) & (contacts[p] < end)).values
+    expected = contacts[~is_bad]
+    assert is_bad.sum() > 0
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+
+
+def test_remove_duplicates_matches_pandas(contact_path, chrom_size_path):
+    result = filter_contacts(contact_path,
+                             chrom_size_path=chrom_size_path,
+                             remove_duplicates=True)
+
+    contacts = _read_contacts(contact_path)
+    expected = contacts[~contacts.duplicated(subset=[1, 2, 5, 6])]
+    assert expected.shape[0] < contacts.shape[0]
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+
+
+@pytest.mark.parametrize('max_pos', [100, 2 ** 61])
+def test_duplicated_contacts_matches_pandas(max_pos):
+    # the large positions can not be packed into int64 keys and use the pandas fallback
+    rng = np.random.default_rng(1)
+    n = 2000
+    contacts = pd.DataFrame({'chrom1': rng.choice(['chr1', 'chr2', None], n),
+                             'pos1': rng.integers(0, 20, n) * (max_pos // 20),
+                             'chrom2': rng.choice(['chr1', 'chr2'], n),
+                             'pos2': rng.integers(0, 20, n) * (max_pos // 20)})
+    judge = duplicated_contacts(contacts, 'chrom1', 'pos1', 'chrom2', 'pos2')
+    expected = contacts.duplicated(subset=['chrom1', 'pos1', 'chrom2', 'pos2']).values
+    assert expected.sum() > 0
+    np.testing.assert_array_equal(judge, expected)
+
+
+def test_contact_store_input(tmp_path, contact_path, chrom_size_path):
+    contact_table = tmp_path / 'contact_table.tsv'
+    pd.Series({'cell': contact_path}).to_csv(contact_table, sep='\t', header=False)
+    index_contacts(str(contact_table), str(tmp_path / 'stores'), chrom_size_path=chrom_size_path, cpu=1)
+    store_table = pd.read_csv(tmp_path / 'stores' / 'contact_table.tsv', sep='\t', header=None, index_col=0)
+    store_path = store_table.loc['cell', 1]
+    assert is_contact_store(store_path)
+
+    # the store gives the same filtered chrom and pos columns as the text file
+    expected = filter_contacts(contact_path, chrom_size_path=chrom_size_path)[[1, 2, 5, 6]]
+    result = filter_contacts(store_path, chrom_size_path=chrom_size_path)
+    assert list(result.columns) == [1, 2, 5, 6]
+    pd.testing.assert_frame_equal(_sort(result), _sort(expected), check_dtype=False)
+
+    # saving a store would lose the read name and strand columns
+    output_path = tmp_path / 'filtered.tsv.gz'
+    with pytest.raises(ValueError, match='contact store'):
+        filter_contacts(store_path, chrom_size_path=chrom_size_path, output_path=str(output_path))
+    assert not output_path.exists()
@@ -0,0 +1,121 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cooler
+import numpy as np
+import pandas as pd
+import pytest
+
+from schicluster.cool.scool import (_compact_pixels, _iter_batch_results, _pixels_from_compact, count_pixels,
+                                    generate_scool)
+from schicluster.cool.utilities import get_chrom_offsets
+
+CHROM_SIZES = {'chr1': 2000000, 'chr2': 1500000}
+RESOLUTIONS = [100000, 250000]
+
+
+@pytest.fixture()
+def scool_inputs(tmp_path):
+    rng = np.random.default_rng(0)
+    chrom_size_path = tmp_path / 'chrom_sizes.tsv'
+    pd.Series(CHROM_SIZES).to_csv(chrom_size_path, sep='\t', header=False)
+
+    cell_paths = {}
+    for i in range(5):
+        n = 3000
+        chroms = np.array(list(CHROM_SIZES) + ['chrM'])
+        chrom1 = rng.choice(chroms, n, p=[0.6, 0.35, 0.05])
+        chrom2 = np.where(rng.random(n) < 0.8, chrom1, rng.choice(chroms, n, p=[0.6, 0.35, 0.05]))
+        pos1 = rng.integers(0, 1000000, n)
+        pos2 = np.where(chrom1 == chrom2, pos1 + rng.integers(-20000, 20000, n), rng.integers(0, 1000000, n))
+        contacts = pd.DataFrame({0: 'read', 1: chrom1, 2: np.abs(pos2), 3: '+',
+                                 4: '-', 5: chrom2, 6: np.abs(pos1)})
+        path = tmp_path / f'cell{i}.tsv'
+        contacts.to_csv(path, sep='\t', header=False, index=False)
+        cell_paths[f'cell{i}'] = str(path)
+    # empty contacts file
+    empty_path = tmp_path / 'empty.tsv'
+    empty_path.touch()
+    cell_paths['empty'] = str(empty_path)
+
+    contacts_table = tmp_path / 'contacts_table.tsv'
+    pd.Series(cell_paths).to_csv(contacts_table, sep='\t', header=False)
+    return str(contacts_table), str(chrom_size_path), cell_paths
+
+
+def _expected_pixels(contact_path, resolution, min_pos_dist=2500):
+    try:
+        contacts = pd.read_csv(contact_path, sep='\t', header=None).drop_duplicates(subset=[1, 2, 5, 6])
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame({'bin1_id': [], 'bin2_id': [], 'count': []}, dtype=np.int64)
+    contacts = contacts[contacts[1].isin(CHROM_SIZES) & contacts[5].isin(CHROM_SIZES)
+                        & (contacts[2] > 0) & (contacts[6] > 0)]
+    contacts = contacts[((contacts[2] - contacts[6]).abs() > min_pos_dist) | (contacts[1] != contacts[5])]
+    bins = cooler.binnify(pd.Series(CHROM_SIZES), resolution)
+    offsets = get_chrom_offsets(bins)
+    bin1 = contacts[1].map(offsets) + (contacts[2] - 1) // resolution
+    bin2 = contacts[5].map(offsets) + (contacts[6] - 1) // resolution
+    pixels = pd.DataFrame({'bin1_id': np.minimum(bin1, bin2), 'bin2_id': np.maximum(bin1, bin2)})
+    pixels = pixels.groupby(['bin1_id', 'bin2_id']).size().rename('count').reset_index()
+    return pixels.astype(np.int64)
+
+
+def test_compact_pixels_round_trip():
+    pixel_df = count_pixels(np.array([5, 1, 3, 1, 2 ** 33]), np.array([1, 5, 3, 5, 7]))
+    arrays = _compact_pixels(pixel_df)
+    # bin ids larger than int32 keep int64
+    assert [a.dtype for a in arrays] == [np.int32, np.int64, np.int32]
+    pd.testing.assert_frame_equal(_pixels_from_compact(arrays).astype(np.int64), pixel_df)
+
+    pixel_df = count_pixels(np.array([5, 1]), np.array([1, 9]))
+    assert all(a.dtype == np.int32 for a in _compact_pixels(pixel_df))
+    assert all(a.dtype == np.int32 for a in _compact_pixels(count_pixels([], [])))
+
+
+@pytest.mark.parametrize('single_pass', [True, False])
+def test_generate_scool_matches_brute_force(tmp_path, scool_inputs, single_pass):
+    contacts_table, chrom_size_path, cell_paths = scool_inputs
+    output_prefix = str(tmp_path / f'out_{single_pass}')
+    # small batches with more batches than the pending window of the pool
+    generate_scool(contacts_table,
+                   output_prefix=output_prefix,
+                   chrom_size_path=chrom_size_path,
+                   resolutions=RESOLUTIONS,
+                   cpu=2,
+                   batch_n=1,
+                   single_pass=single_pass)
+
+    for resolution, resolution_str in zip(RESOLUTIONS, ['100K', '250K']):
+        scool_path = f'{output_prefix}.{resolution_str}.scool'
+        assert set(cooler.fileops.list_scool_cells(scool_path)) == {f'/cells/{cell}' for cell in cell_paths}
+        for cell, contact_path in cell_paths.items():
+            pixels = cooler.Cooler(f'{scool_path}::/cells/{cell}').pixels()[:]
+            expected = _expected_pixels(contact_path, resolution)
+            pd.testing.assert_frame_equal(pixels.astype(np.int64).reset_index(drop=True), expected)
+
+
+class _CountingExecutor(ThreadPoolExecutor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.n_submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def _slow_square(x):
+    # later batches finish first
+    time.sleep(0.002 * (10 - x % 10))
+    return x * x
+
+
+@pytest.mark.parametrize('n_batches, max_pending', [(0, 2), (3, 5), (25, 4)])
+def test_iter_batch_results_bounds_pending(n_batches, max_pending):
+    with _CountingExecutor(3) as exe:
+        results = []
+        for result in _iter_batch_results(exe, _slow_square, ({'x': i} for i in range(n_batches)), max_pending):
+            results.append(result)
+            # the futures of the yielded results are not held, at most max_pending batches are in flight
+            assert exe.n_submitted - len(results) <= max_pending
+    assert results == [i * i for i in range(n_batches)]